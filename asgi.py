@@ -0,0 +1,5 @@
+from website import create_app
+from website.aio import NotesASGI
+
+# uvicorn asgi:app --workers 4, or gunicorn with SERVER_MODE=asgi (see gunicorn.conf.py)
+app = NotesASGI(create_app())
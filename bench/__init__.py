@@ -0,0 +1 @@
+'''Benchmark harness for the NoteMaster endpoints, see bench/run.py'''
@@ -0,0 +1,328 @@
+import argparse
+import http.client
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from http.cookies import SimpleCookie
+from urllib.parse import urlencode, urlsplit
+from sqlalchemy import select
+from website import create_app, db
+from website.models import Note
+from .seed import seed, bench_email, PASSWORD
+
+
+'''Latency and throughput benchmarks for the hot NoteMaster endpoints.
+
+    python -m bench.run --profiles 10,1000,100000 --output bench.json
+    python -m bench.run --mode http --workers 4 --output bench.json     # needs gunicorn
+    python -m bench.run compare old.json new.json --threshold 10
+    python -m bench.run startup --runs 10                               # cold start, see bench/startup.py
+'''
+
+
+class InProcessClient:
+    '''Drives the WSGI app directly, measuring the app without any network or server overhead'''
+
+    def __init__(self, app):
+        self.client = app.test_client()
+        self.last_headers = {}
+
+    def request(self, method, path, form=None, json_body=None, headers=None):
+        response = self.client.open(path, method=method, data=form, json=json_body, headers=headers)
+        self.last_headers = response.headers
+        return response.status_code
+
+
+class HttpClient:
+    '''One keep-alive connection to a running server, carrying the session cookie between requests'''
+
+    def __init__(self, base_url):
+        parts = urlsplit(base_url)
+        self.connection = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=60)
+        self.cookies = SimpleCookie()
+        self.last_headers = {}
+
+    def request(self, method, path, form=None, json_body=None, headers=None):
+        headers = dict(headers or {})
+        body = None
+        if form is not None:
+            body = urlencode(form)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        elif json_body is not None:
+            body = json.dumps(json_body)
+            headers['Content-Type'] = 'application/json'
+        if self.cookies:
+            headers['Cookie'] = '; '.join('{}={}'.format(k, v.value) for k, v in self.cookies.items())
+        self.connection.request(method, path, body=body, headers=headers)
+        response = self.connection.getresponse()
+        response.read()
+        for value in response.headers.get_all('Set-Cookie') or ():
+            self.cookies.load(value)
+        self.last_headers = response.headers
+        return response.status
+
+
+def login(client, profile):
+    status = client.request('POST', '/login', form={'email': bench_email(profile), 'password': PASSWORD})
+    if status != 302:
+        raise RuntimeError('could not log in as {} (status {})'.format(bench_email(profile), status))
+
+
+# every scenario: (name, takes a profile, function(client, i, context) -> status)
+def _home(client, i, context):
+    return client.request('GET', '/')
+
+
+def _home_revalidate(client, i, context):
+    return client.request('GET', '/', headers={'If-None-Match': context['etag']})
+
+
+def _api_list(client, i, context):
+    return client.request('GET', '/api/notes')
+
+
+def _delete_note(client, i, context):
+    return client.request('POST', '/delete-note', json_body={'noteId': context['delete_ids'][i]})
+
+
+def _login(client, i, context):
+    return client.request('POST', '/login', form={'email': bench_email(context['profile']), 'password': PASSWORD})
+
+
+def _sign_up(client, i, context):
+    return client.request('POST', '/signup', form={'email': 'bench-signup-{}-{}@example.com'.format(context['run'], i),
+                                                   'firstName': 'Bench', 'password1': PASSWORD, 'password2': PASSWORD})
+
+
+SCENARIOS = {
+    'home': (True, _home),
+    'home_revalidate': (True, _home_revalidate),
+    'api_list': (True, _api_list),
+    'delete_note': (True, _delete_note),
+    'login': (True, _login),
+    'sign_up': (False, _sign_up),
+}
+AUTH_SCENARIOS = ('login', 'sign_up') # dominated by password hashing, run with --auth-requests
+
+
+def percentile(ordered, p):
+    '''Nearest-rank percentile of an already sorted list'''
+    if not ordered:
+        return 0.0
+    rank = math.ceil(p / 100.0 * len(ordered))
+    return ordered[min(max(rank, 1), len(ordered)) - 1]
+
+
+def summarize(scenario, profile, latencies, errors, elapsed):
+    ordered = sorted(latencies)
+    return {
+        'scenario': scenario,
+        'profile': profile,
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        'mean_ms': round(1000 * sum(ordered) / len(ordered), 3) if ordered else 0.0,
+        'p50_ms': round(1000 * percentile(ordered, 50), 3),
+        'p95_ms': round(1000 * percentile(ordered, 95), 3),
+        'p99_ms': round(1000 * percentile(ordered, 99), 3),
+    }
+
+
+def run_scenario(make_client, func, requests, concurrency, context, profile=None):
+    '''Send `requests` requests from `concurrency` threads, each with its own (logged in) client'''
+    latencies, errors = [], [0]
+    lock = threading.Lock()
+    counter = iter(range(requests))
+    clients = []
+    for _ in range(concurrency):
+        client = make_client()
+        if profile is not None:
+            login(client, profile)
+        clients.append(client)
+
+    def worker(client):
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            start = time.perf_counter()
+            try:
+                status = func(client, i, context)
+            except Exception:
+                status = 599
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                if status >= 400:
+                    errors[0] += 1
+
+    threads = [threading.Thread(target=worker, args=(client,)) for client in clients]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors[0], time.perf_counter() - start
+
+
+def run(args):
+    database_url = args.database_url or 'sqlite:///{}'.format(os.path.abspath(args.db))
+    config = {'SQLALCHEMY_DATABASE_URI': database_url, 'PASSWORD_HASH_WORKERS': args.hash_workers, 'RATELIMIT_ENABLED': False,
+              'MAINTENANCE_ENABLED': False}
+    app = create_app(config)
+    profiles = [int(p) for p in args.profiles.split(',')]
+    scenarios = args.scenarios.split(',') if args.scenarios else list(SCENARIOS)
+    seed_start = time.perf_counter()
+    users = seed(app, profiles, extra_notes=args.requests if 'delete_note' in scenarios else 0)
+    print('seeded {} in {:.1f}s'.format(users, time.perf_counter() - seed_start), file=sys.stderr)
+
+    if args.mode == 'http':
+        url = args.url or _start_server(args, database_url)
+        make_client = lambda: HttpClient(url)
+    else:
+        make_client = lambda: InProcessClient(app)
+
+    results = []
+    try:
+        for name in scenarios:
+            per_profile, func = SCENARIOS[name]
+            requests = args.auth_requests if name in AUTH_SCENARIOS else args.requests
+            for profile in (profiles if per_profile else [None]):
+                context = {'profile': profile, 'run': uuid.uuid4().hex[:8]}
+                if name == 'delete_note':
+                    context['delete_ids'] = _delete_ids(app, users[profile], requests)
+                if name == 'home_revalidate':
+                    context['etag'] = _etag(make_client(), profile)
+                latencies, errors, elapsed = run_scenario(make_client, func, requests, args.concurrency, context,
+                                                          profile=profile if name not in AUTH_SCENARIOS else None)
+                result = summarize(name, profile, latencies, errors, elapsed)
+                results.append(result)
+                print('{scenario:>16} {profile!s:>7}  {rps:>9} req/s  p50 {p50_ms:>9} ms  p95 {p95_ms:>9} ms  '
+                      'p99 {p99_ms:>9} ms  errors {errors}'.format(**result), file=sys.stderr)
+    finally:
+        while _SERVERS:
+            _SERVERS.pop().terminate()
+
+    return {
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'mode': args.mode,
+        'workers': args.workers if args.mode == 'http' else 1,
+        'concurrency': args.concurrency,
+        'database': database_url.split(':', 1)[0],
+        'results': results,
+    }
+
+
+def compare(old, new, threshold):
+    '''Print the change of every metric between two runs; returns True if a p95 or rps regressed past `threshold` %'''
+    regressed = False
+    before = {(r['scenario'], r['profile']): r for r in old['results']}
+    for result in new['results']:
+        previous = before.get((result['scenario'], result['profile']))
+        if previous is None:
+            continue
+        p95 = _change(previous['p95_ms'], result['p95_ms'])
+        rps = _change(previous['rps'], result['rps'])
+        slower = p95 > threshold or rps < -threshold
+        regressed = regressed or slower
+        print('{:>16} {!s:>7}  p95 {:+7.1f}%  rps {:+7.1f}%{}'.format(
+            result['scenario'], result['profile'], p95, rps, '  REGRESSION' if slower else ''))
+    return regressed
+
+
+def _change(before, after):
+    return 100.0 * (after - before) / before if before else 0.0
+
+
+def _delete_ids(app, user_id, count):
+    with app.app_context():
+        return list(db.session.execute(
+            select(Note.id).where(Note.user_id == user_id).order_by(Note.id.desc()).limit(count)
+        ).scalars())
+
+
+def _etag(client, profile):
+    login(client, profile)
+    client.request('GET', '/')
+    return client.last_headers.get('ETag', '')
+
+
+_SERVERS = []
+
+
+def _start_server(args, database_url):
+    port = args.port
+    command = args.server_cmd.format(workers=args.workers, port=port).split()
+    env = dict(os.environ, DATABASE_URL=database_url, PASSWORD_HASH_WORKERS=str(args.hash_workers), RATELIMIT_ENABLED='0',
+               MAINTENANCE_ENABLED='0')
+    _SERVERS.append(subprocess.Popen(command, env=env))
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            connection.request('GET', '/login')
+            connection.getresponse().read()
+            return 'http://127.0.0.1:{}'.format(port)
+        except OSError:
+            time.sleep(0.2)
+    _SERVERS.pop().terminate()
+    raise RuntimeError('server did not start: {}'.format(' '.join(command)))
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] == 'compare':
+        parser = argparse.ArgumentParser(prog='bench.run compare')
+        parser.add_argument('old')
+        parser.add_argument('new')
+        parser.add_argument('--threshold', type=float, default=10.0, help='allowed slowdown in percent')
+        args = parser.parse_args(argv[1:])
+        with open(args.old) as old, open(args.new) as new:
+            return 1 if compare(json.load(old), json.load(new), args.threshold) else 0
+    if argv and argv[0] == 'startup':
+        from .startup import main as startup_main
+        return startup_main(argv[1:])
+
+    parser = argparse.ArgumentParser(prog='bench.run')
+    parser.add_argument('--mode', choices=('inprocess', 'http'), default='inprocess')
+    parser.add_argument('--db', default='/tmp/notemaster-bench.db', help='SQLite file, reused between runs')
+    parser.add_argument('--database-url', help='benchmark another database instead of --db')
+    parser.add_argument('--profiles', default='10,1000,100000', help='notes per benchmark user')
+    parser.add_argument('--scenarios', help='comma separated subset of: ' + ','.join(SCENARIOS))
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--auth-requests', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--hash-workers', type=int, default=2)
+    parser.add_argument('--workers', type=int, default=4, help='server processes in http mode')
+    parser.add_argument('--port', type=int, default=5055)
+    parser.add_argument('--url', help='benchmark a server that is already running')
+    parser.add_argument('--server-cmd', default='gunicorn -w {workers} -b 127.0.0.1:{port} main:app')
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    args = parser.parse_args(argv)
+
+    report = json.dumps(run(args), indent=2)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(report + '\n')
+    else:
+        print(report)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,48 @@
+import random
+from sqlalchemy import insert, select
+from werkzeug.security import generate_password_hash
+from website import db
+from website.models import User, Note
+
+
+'''Deterministic benchmark data: one user per profile, each holding that many notes'''
+
+PASSWORD = 'bench-password'
+WORDS = ('note', 'milk', 'meeting', 'call', 'kitchen', 'project', 'idea', 'review', 'travel', 'book',
+         'garden', 'invoice', 'plumber', 'birthday', 'gym', 'recipe', 'deadline', 'lunch', 'draft', 'release')
+
+
+def bench_email(profile):
+    return 'bench-{}@example.com'.format(profile)
+
+
+def seed(app, profiles=(10, 1000, 100000), extra_notes=0, seed=42, batch_size=5000):
+    '''Create (or top up) a user with N notes for each N in `profiles`.
+
+    `extra_notes` more notes are added to every user so delete benchmarks have something to remove.
+    Returns {profile: user id}.
+    '''
+    rng = random.Random(seed)
+    with app.app_context():
+        db.create_all()
+        password = generate_password_hash(PASSWORD, method=app.config['PASSWORD_HASH_METHOD'])
+        users = {}
+        for profile in profiles:
+            user = User.query.filter_by(email=bench_email(profile)).first()
+            if user is None:
+                user = User(email=bench_email(profile), first_name='Bench', password=password)
+                db.session.add(user)
+                db.session.commit()
+            have = db.session.execute(select(db.func.count()).select_from(Note).where(Note.user_id == user.id)).scalar()
+            missing = profile + extra_notes - have
+            while missing > 0:
+                count = min(missing, batch_size)
+                db.session.execute(insert(Note), [{"user_id": user.id, "content": _sentence(rng)} for _ in range(count)])
+                db.session.commit()
+                missing -= count
+            users[profile] = user.id
+        return users
+
+
+def _sentence(rng):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 30)))
@@ -0,0 +1,52 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+'''Cold start timings: each run is a fresh interpreter, like a new worker after a deploy.
+
+    python -m bench.run startup --runs 10
+'''
+
+PHASES = ('import', 'create_app', 'first_request', 'second_request')
+
+
+def measure():
+    '''Time one cold start of this process: imports, create_app and the first requests'''
+    started = time.perf_counter()
+    from website import create_app
+    imported = time.perf_counter()
+    app = create_app({'PASSWORD_HASH_WORKERS': 0})
+    created = time.perf_counter()
+    client = app.test_client()
+    client.get('/login') # compiles (or loads) the templates
+    first = time.perf_counter()
+    client.get('/login')
+    second = time.perf_counter()
+    return dict(zip(PHASES, (imported - started, created - imported, first - created, second - first)))
+
+
+def run(runs):
+    '''Median and worst of every phase over `runs` fresh processes, in milliseconds'''
+    samples = []
+    for _ in range(runs):
+        output = subprocess.check_output([sys.executable, '-m', 'bench.startup'], cwd=os.getcwd())
+        samples.append(json.loads(output))
+    return {phase: {'median_ms': round(statistics.median(s[phase] for s in samples) * 1000, 2),
+                    'max_ms': round(max(s[phase] for s in samples) * 1000, 2)} for phase in PHASES}
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='bench.run startup')
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args(argv)
+    print(json.dumps(run(args.runs), indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    print(json.dumps(measure()))
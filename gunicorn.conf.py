@@ -0,0 +1,16 @@
+import multiprocessing
+import os
+
+# gunicorn reads this file on start: `gunicorn` serves main:app, `SERVER_MODE=asgi gunicorn` serves asgi:app
+bind = os.environ.get('BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+# import and create the app once in the master, workers fork from it instead of paying ~0.6s each
+preload_app = os.environ.get('PRELOAD_APP', '1') == '1'
+
+if os.environ.get('SERVER_MODE', 'wsgi') == 'asgi':
+    wsgi_app = 'asgi:app'
+    worker_class = 'uvicorn.workers.UvicornWorker' # one event loop per worker
+else:
+    wsgi_app = 'main:app'
+    worker_class = 'gthread'
+    threads = int(os.environ.get('WEB_THREADS', 4))
@@ -1,43 +1,167 @@
 
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
+import os
+import time
 from os import path
 from flask_login import LoginManager
-db = SQLAlchemy()
+from .database import database_uri, engine_options, configure_engine, shard_engines, shard_metadata, ShardSession, DEFAULT_SQLITE_PRAGMAS
+db = SQLAlchemy(session_options={'class_': ShardSession})
 DB_NAME = "/tmp/notemaster.db"
 
 
-def create_app():
+def create_app(test_config=None):
+    started = time.perf_counter()
     app = Flask(__name__)
     app.config['SECRET_KEY'] = 'my_secret_key'
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///{}'.format(DB_NAME)
+    app.config['SQLALCHEMY_DATABASE_URI'] = database_uri('sqlite:///{}'.format(DB_NAME))
+    app.config['SQLITE_PRAGMAS'] = dict(DEFAULT_SQLITE_PRAGMAS)
+    app.config['SHARD_DATABASE_URIS'] = [uri for uri in os.environ.get('SHARD_DATABASE_URLS', '').split(',') if uri] # shards 1..N, shard 0 is the database above
+    app.config['DB_POOL_SIZE'] = 5 # connections per worker process
+    app.config['DB_MAX_OVERFLOW'] = 10 # PostgreSQL only
+    app.config['DB_POOL_RECYCLE'] = 1800 # PostgreSQL only, seconds
+    app.config['NOTES_PAGE_SIZE'] = 50 # notes per page on the home page and in /api/notes
+    app.config['IMPORT_BATCH_SIZE'] = 1000 # notes per transaction in /api/notes/import
+    app.config['REVISION_SNAPSHOT_EVERY'] = 20 # full copy of an edited note every N revisions, deltas in between
+    app.config['CACHE_URL'] = os.environ.get('CACHE_URL') # e.g. redis://localhost:6379/0, in-process cache when unset
+    app.config['USER_CACHE_SIZE'] = 10000
+    app.config['USER_CACHE_TTL'] = 300 # seconds a worker may serve a user changed by another worker
+    app.config['FRAGMENT_CACHE_SIZE'] = 1000 # rendered note lists, keyed by user and notes version
+    app.config['FRAGMENT_CACHE_TTL'] = 600
+    app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256' # stored hashes with another method or cost are upgraded on login
+    app.config['PASSWORD_HASH_WORKERS'] = int(os.environ.get('PASSWORD_HASH_WORKERS', 2)) # processes per worker, 0 hashes inline
+    app.config['PASSWORD_HASH_QUEUE'] = 32 # hashes queued or running before auth requests get a 503
+    app.config['PASSWORD_HASH_TIMEOUT'] = 10 # seconds
+    app.config['RATELIMIT_ENABLED'] = os.environ.get('RATELIMIT_ENABLED', '1') == '1'
+    app.config['RATELIMIT_STORAGE_URL'] = os.environ.get('RATELIMIT_STORAGE_URL', app.config['CACHE_URL']) # shared counters in Redis, per process when unset
+    app.config['RATELIMIT_LOGIN_IP'] = (30, 60) # (requests, seconds): bursts of 30, refilled over a minute
+    app.config['RATELIMIT_LOGIN_EMAIL'] = (5, 60) # login attempts per account, whatever the source address
+    app.config['RATELIMIT_SIGNUP_IP'] = (10, 3600)
+    app.config['RATELIMIT_WRITE_USER'] = (120, 60) # note writes per user
+    app.config['PROXY_FIX_HOPS'] = int(os.environ.get('PROXY_FIX_HOPS', 0)) # reverse proxies in front of the app whose X-Forwarded-* headers are trusted
+    app.config['INGEST_MODE'] = os.environ.get('INGEST_MODE', 'sync') # 'queue' acknowledges new notes before a background group commit
+    app.config['INGEST_MAX_BATCH'] = 500 # notes per group commit
+    app.config['INGEST_MAX_DELAY'] = 0.05 # seconds a queued note may wait for its batch to fill
+    app.config['INGEST_SPOOL_DIR'] = '/tmp/notemaster-spool'
+    app.config['INGEST_SPOOL_FSYNC'] = True # fsync the spool before acknowledging, False trades durability for speed
+    app.config['INGEST_SPOOL_ROTATE'] = 1024 * 1024 # bytes before new notes go to a fresh spool file, the full one is deleted once committed
+    app.config['INGEST_MAX_RETRIES'] = 5 # retries of a failed group commit before its notes are tried one by one
+    app.config['INGEST_DEAD_LETTER'] = os.environ.get('INGEST_DEAD_LETTER') # notes that could not be inserted, dead-letter.ndjson in the spool dir by default
+    app.config['SSE_POLL_INTERVAL'] = 5 # seconds between checks for changes made by other processes, and keepalives
+    app.config['SSE_MAX_DURATION'] = 300 # seconds before a stream ends and the browser reconnects, frees the worker thread
+    app.config['SSE_MAX_STREAMS'] = int(os.environ.get('SSE_MAX_STREAMS', max(1, int(os.environ.get('WEB_THREADS', 4)) // 2))) # open streams per process, each holds a thread
+    app.config['MAINTENANCE_ENABLED'] = os.environ.get('MAINTENANCE_ENABLED', '1') == '1' # vacuum, analyze, purges and backups in one elected worker
+    app.config['MAINTENANCE_JOBS'] = {'purge': 3600, 'vacuum': 3600, 'analyze': 86400, 'fts_optimize': 86400, 'backup': 86400} # seconds between runs, 0 disables
+    app.config['MAINTENANCE_TICK'] = 60 # seconds between checks for due jobs
+    app.config['MAINTENANCE_LOCK_FILE'] = '/tmp/notemaster-maintenance.lock' # held by the worker that runs the jobs
+    app.config['MAINTENANCE_BACKUP_DIR'] = os.environ.get('BACKUP_DIR', '/tmp/notemaster-backups')
+    app.config['MAINTENANCE_BACKUP_KEEP'] = 7 # newest backups kept per database
+    app.config['MAINTENANCE_HISTORY_DAYS'] = 30 # maintenance_run rows kept
+    app.config['TEMPLATE_CACHE_DIR'] = os.environ.get('TEMPLATE_CACHE_DIR') # compiled templates shared by workers and restarts; by default Jinja's private per-user temp directory, '' disables
+    app.config['METRICS_ENABLED'] = os.environ.get('METRICS_ENABLED') == '1' # per-request timing, SQL stats and /metrics
+    app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN') # bearer token required by /metrics when set
+    app.config['METRICS_N_PLUS_ONE'] = 10 # same SELECT this many times in one request is logged as a likely N+1
+    app.config['PROFILE_SAMPLE_RATE'] = float(os.environ.get('PROFILE_SAMPLE_RATE', 0)) # share of requests run under cProfile
+    app.config['PROFILE_DIR'] = '/tmp/notemaster-profiles'
+    if test_config:
+        app.config.update(test_config)
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config)
+    if app.config['PROXY_FIX_HOPS']: # so remote_addr, and the per-IP rate limits, see the client rather than the proxy
+        from werkzeug.middleware.proxy_fix import ProxyFix
+        hops = app.config['PROXY_FIX_HOPS']
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=hops, x_proto=hops, x_host=hops)
 
     db.init_app(app) #link Flask app to db
+    with app.app_context():
+        app.extensions['shard_engines'] = [db.engine] + shard_engines(app.config) # indexed by User.shard
+        for engine in app.extensions['shard_engines']:
+            configure_engine(engine, app.config)
     
     from .views import views
     from .auth import auth
+    from .api import api
 
     app.register_blueprint(views, url_prefix='/')
     app.register_blueprint(auth, url_prefix='/')
+    app.register_blueprint(api, url_prefix='/api')
 
     from .models import User, Note
+    from .cache import init_user_cache, init_fragment_cache, load_cached_user
+    from .passwords import init_password_hasher
+    from .ingest import init_ingest
+    from .events import init_events
+    from .ratelimit import init_rate_limiter
+    from .shards import use_shard, shards_cli
+    from .assets import init_assets
+    from .maintenance import init_maintenance
 
     if not path.exists(DB_NAME):
         create_database(app)
+    else:
+        upgrade_database(app)
 
     login_manager = LoginManager()
     login_manager.login_view = 'auth.login'
     login_manager.init_app(app)
+    init_user_cache(app)
+    init_fragment_cache(app)
+    init_password_hasher(app)
+    init_ingest(app)
+    init_events(app)
+    init_rate_limiter(app)
+    app.cli.add_command(shards_cli)
+    init_assets(app)
+    init_maintenance(app)
+    if app.config['METRICS_ENABLED']:
+        from .metrics import init_metrics
+        init_metrics(app)
 
     @login_manager.user_loader
     def load_user(id):
-        return User.query.get(int(id))  # get user from db by its primary key
+        user = load_cached_user(int(id))  # get user from the cache, or from db by its primary key
+        if user is not None:
+            use_shard(user.shard) # the user's notes are read and written on their shard
+        return user
 
+    app.extensions['startup_seconds'] = time.perf_counter() - started
+    app.logger.info("App created in %.0f ms", app.extensions['startup_seconds'] * 1000)
     return app
 
 
 def create_database(app):
+    from .search import install_search_index
     with app.app_context():
         if not path.exists('website/'+DB_NAME):
-            db.create_all()
+            for shard, engine in enumerate(app.extensions['shard_engines']):
+                schema_of(shard).create_all(engine) # shards get the note tables only
+                if shard: # the search index is hooked on the main schema's note table
+                    with engine.begin() as connection:
+                        install_search_index(connection)
             print("Created database!")
+
+
+def schema_of(shard):
+    return db.metadata if shard == 0 else shard_metadata(db.metadata)
+
+
+def upgrade_database(app):
+    '''Add objects introduced after the database file was created, on the main database and every shard'''
+    from sqlalchemy import inspect, text
+    from .search import install_search_index
+    with app.app_context():
+        for shard, engine in enumerate(app.extensions['shard_engines']):
+            metadata = schema_of(shard)
+            metadata.create_all(engine) # new tables only, existing ones are left untouched
+            with engine.begin() as connection:
+                inspector = inspect(connection)
+                for table in metadata.sorted_tables:
+                    existing = {column['name'] for column in inspector.get_columns(table.name)}
+                    for column in table.columns:
+                        if column.name not in existing: # new columns are all nullable, so a plain ADD COLUMN works
+                            quote = connection.dialect.identifier_preparer.quote
+                            connection.execute(text('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                                quote(table.name), quote(column.name), column.type.compile(connection.dialect))))
+                for table in metadata.sorted_tables:
+                    for index in table.indexes:
+                        index.create(connection, checkfirst=True)
+                install_search_index(connection)
@@ -0,0 +1,220 @@
+import asyncio
+import json
+import math
+from http.cookies import SimpleCookie
+from urllib.parse import parse_qs
+from sqlalchemy import insert, delete
+from werkzeug.http import parse_etags, http_date
+from .models import Note, NoteChange, content_error, tags_error, tag_names
+from .pagination import notes_page_query, split_page, clamp_limit, date_bound, decode_cursor, DEFAULT_PAGE_SIZE
+from .changes import change_rows, version_query
+from .http_cache import notes_etag
+from .database import configure_engine, engine_options
+from .storage import prepare_rows, blob_insert
+from .tags import tag_query, set_note_tags, untag_notes
+from .revisions import drop_revisions
+from .ratelimit import retry_after
+
+
+'''Async serving mode.
+
+NotesASGI is an ASGI application: GET, POST and DELETE on /api/notes are answered by native async
+handlers on an async SQLAlchemy engine (aiosqlite for SQLite, asyncpg for PostgreSQL), so slow
+clients on the hottest endpoints only cost a coroutine. Writes take from the same per-user rate
+limit as the Flask views. Every other request goes to the Flask app
+through asgiref's WSGI adapter. Needs `asgiref` and `aiosqlite` (or `asyncpg`); see asgi.py.
+'''
+
+MAX_BODY = 10 * 1024 * 1024
+
+
+def async_database_uri(uri):
+    if uri.startswith('sqlite:'):
+        return 'sqlite+aiosqlite:' + uri[len('sqlite:'):]
+    if uri.startswith('postgresql:'):
+        return 'postgresql+asyncpg:' + uri[len('postgresql:'):]
+    return uri
+
+
+class NotesASGI:
+
+    def __init__(self, app):
+        from asgiref.wsgi import WsgiToAsgi
+        from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+        self.app = app
+        self.wsgi = WsgiToAsgi(app)
+        self.engine = create_async_engine(async_database_uri(app.config['SQLALCHEMY_DATABASE_URI']), **engine_options(app.config))
+        configure_engine(self.engine.sync_engine, app.config) # same pragmas as the sync engine
+        self.sessions = async_sessionmaker(self.engine, expire_on_commit=False)
+        self.serializer = app.session_interface.get_signing_serializer(app)
+        self.sharded = bool(app.config['SHARD_DATABASE_URIS']) # the async engine only reaches the main database
+        self.handlers = {'GET': self.list_notes, 'POST': self.create_notes, 'DELETE': self.delete_notes}
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] == 'http' and scope['path'] == '/api/notes' and scope['method'] in self.handlers:
+            user_id = self.session_user(scope)
+            # anonymous requests (or a remember-me login), write-behind mode and sharding are left to Flask
+            if user_id is not None and not self.sharded and not (scope['method'] == 'POST' and self.app.extensions.get('note_writer')):
+                return await self.handlers[scope['method']](scope, receive, send, user_id)
+        await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.engine.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def session_user(self, scope):
+        '''The user id Flask-Login keeps in the signed session cookie, or None'''
+        cookies = SimpleCookie(_header(scope, b'cookie'))
+        morsel = cookies.get(self.app.config['SESSION_COOKIE_NAME'])
+        if morsel is None:
+            return None
+        try:
+            session = self.serializer.loads(morsel.value, max_age=int(self.app.permanent_session_lifetime.total_seconds()))
+            return int(session['_user_id'])
+        except Exception:
+            return None
+
+    async def list_notes(self, scope, receive, send, user_id):
+        query = parse_qs(scope['query_string'].decode())
+        async with self.sessions() as session:
+            row = (await session.execute(version_query(user_id))).first()
+            version, changed_at = (row.seq, row.date) if row else (0, None)
+            etag = notes_etag(user_id, version)
+            headers = [(b'etag', '"{}"'.format(etag).encode()), (b'cache-control', b'private, no-cache')]
+            if changed_at is not None:
+                headers.append((b'last-modified', http_date(changed_at).encode()))
+            if parse_etags(_header(scope, b'if-none-match')).contains(etag):
+                return await _send(send, 304, None, headers)
+            try:
+                limit = clamp_limit(int(query.get('limit', [self.app.config.get('NOTES_PAGE_SIZE', DEFAULT_PAGE_SIZE)])[0]))
+            except ValueError:
+                return await _send(send, 400, {"error": "limit must be an integer."})
+            try:
+                after = decode_cursor(query['after'][0]) if 'after' in query else None
+            except ValueError:
+                return await _send(send, 400, {"error": "after must be a cursor returned as next."})
+            try:
+                start, end = date_bound(query.get('from', [None])[0]), date_bound(query.get('to', [None])[0])
+            except ValueError:
+                return await _send(send, 400, {"error": "from and to must be ISO 8601 dates."})
+            tag_id, tag = None, tag_names(query.get('tag', []))[:1]
+            if tag:
+                tag_id = await session.scalar(tag_query(user_id, tag[0]))
+                if tag_id is None: # no note has it
+                    return await _send(send, 200, {"notes": [], "next": None}, headers)
+            notes, next_cursor = split_page((await session.scalars(notes_page_query(user_id, after, limit, tag_id, start, end))).all(), limit)
+            return await _send(send, 200, {"notes": [note.to_dict() for note in notes], "next": next_cursor}, headers)
+
+    async def create_notes(self, scope, receive, send, user_id):
+        if await self.rate_limited(send, user_id):
+            return
+        items = await self.read_list(receive, send, 'notes')
+        if items is None:
+            return
+        results, rows, positions = [], [], []
+        for i, item in enumerate(items):
+            error = content_error(item.get("content") if isinstance(item, dict) else None)
+            if error is None and "tags" in item:
+                error = tags_error(item["tags"])
+            results.append({"status": "error", "error": error} if error else None)
+            if not error:
+                rows.append({"content": item["content"], "user_id": user_id})
+                positions.append(i)
+        async with self.sessions() as session:
+            if rows:
+                rows, blobs = prepare_rows(rows)
+                if blobs:
+                    await session.execute(blob_insert(self.engine.dialect.name), blobs)
+                created = await session.execute(insert(Note).returning(Note.id, sort_by_parameter_order=True), rows)
+                for i, note_id in zip(positions, created.scalars()):
+                    results[i] = {"status": "created", "id": note_id}
+                tagged = {results[i]["id"]: items[i]["tags"] for i in positions if items[i].get("tags")}
+                if tagged:
+                    await session.run_sync(lambda sync_session: set_note_tags(user_id, tagged, sync_session))
+                await session.execute(insert(NoteChange), change_rows(user_id, [results[i]["id"] for i in positions], "upsert"))
+                await session.commit()
+                self.app.extensions['change_broker'].publish(user_id)
+        await _send(send, 200, {"create": results})
+
+    async def delete_notes(self, scope, receive, send, user_id):
+        if await self.rate_limited(send, user_id):
+            return
+        ids = await self.read_list(receive, send, 'ids')
+        if ids is None:
+            return
+        valid = [note_id for note_id in ids if isinstance(note_id, int)]
+        deleted = set()
+        async with self.sessions() as session:
+            if valid:
+                deleted = set((await session.execute(
+                    delete(Note).where(Note.id.in_(valid), Note.user_id == user_id).returning(Note.id)
+                )).scalars())
+                if deleted:
+                    await session.run_sync(lambda sync_session: untag_notes(sorted(deleted), sync_session))
+                    await session.run_sync(lambda sync_session: drop_revisions(sorted(deleted), sync_session))
+                    await session.execute(insert(NoteChange), change_rows(user_id, sorted(deleted), "delete"))
+                await session.commit()
+                if deleted:
+                    self.app.extensions['change_broker'].publish(user_id)
+        await _send(send, 200, {"delete": [{"status": "deleted" if note_id in deleted else "not_found", "id": note_id} for note_id in ids]})
+
+    async def rate_limited(self, send, user_id):
+        '''Answer 429 with Retry-After, as the Flask views do, once the user's writes are used up'''
+        if not self.app.config['RATELIMIT_ENABLED']:
+            return False
+        if self.app.extensions['rate_limiter'].blocking:
+            wait = await asyncio.to_thread(retry_after, self.app, 'RATELIMIT_WRITE_USER', user_id)
+        else:
+            wait = retry_after(self.app, 'RATELIMIT_WRITE_USER', user_id)
+        if not wait:
+            return False
+        await _send(send, 429, {"error": "Too many requests."}, [(b'retry-after', str(math.ceil(wait)).encode())])
+        return True
+
+    async def read_list(self, receive, send, key):
+        '''The JSON list under `key` in the request body; answers 400 itself and returns None if invalid'''
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if len(body) > MAX_BODY:
+                await _send(send, 413, {"error": "Request body too large."})
+                return None
+            if not message.get('more_body'):
+                break
+        try:
+            data = json.loads(body or b'null')
+        except ValueError:
+            data = None
+        if not isinstance(data, dict) or not isinstance(data.get(key), list):
+            await _send(send, 400, {"error": 'Expected a JSON object with a "{}" list.'.format(key)})
+            return None
+        limit = self.app.config.get('NOTES_BATCH_LIMIT', 1000)
+        if len(data[key]) > limit:
+            await _send(send, 400, {"error": "At most {} items per request.".format(limit)})
+            return None
+        return data[key]
+
+
+def _header(scope, name):
+    for key, value in scope['headers']:
+        if key == name:
+            return value.decode('latin-1')
+    return ''
+
+
+async def _send(send, status, body, headers=()):
+    payload = b'' if body is None else json.dumps(body).encode('utf-8')
+    headers = list(headers)
+    if body is not None:
+        headers += [(b'content-type', b'application/json'), (b'content-length', str(len(payload)).encode())]
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': payload})
@@ -0,0 +1,340 @@
+from flask import Blueprint, request, jsonify, current_app, Response, stream_with_context
+from flask_login import login_required, current_user
+from sqlalchemy import insert, update, delete, select
+from .models import Note, content_error, tags_error
+from .pagination import notes_page, date_bound, decode_cursor, DEFAULT_PAGE_SIZE
+from .search import search_notes
+from .changes import record_changes, notes_version, notes_version_info, changes_since
+from .http_cache import notes_etag, not_modified, set_validators
+from .transfer import FORMATS, export_notes, import_notes
+from .ingest import enqueue_note
+from .storage import prepare_rows, save_blobs, full_content
+from .revisions import record_revisions, list_revisions, materialize, drop_revisions
+from .tags import find_tag, user_tags, set_note_tags, untag_notes
+from .events import change_stream
+from .ratelimit import rate_limit, by_user
+from werkzeug.exceptions import TooManyRequests
+from . import db
+
+
+'''JSON API blueprint for our application'''
+
+api = Blueprint('api', __name__)
+
+
+@api.route('/notes', methods=['GET'])
+@login_required
+def list_notes():
+    '''One page of the current user's notes; pass ?after=<next> to get the following page.
+    ?tag=<name>, ?from=<date> and ?to=<date> (exclusive) filter them.'''
+    try:
+        start, end = date_bound(request.args.get('from')), date_bound(request.args.get('to'))
+    except ValueError:
+        raise BatchError("from and to must be ISO 8601 dates.")
+    try:
+        after = decode_cursor(request.args['after']) if 'after' in request.args else None
+    except ValueError:
+        raise BatchError("after must be a cursor returned as next.")
+    version, changed_at = notes_version_info(current_user.id)
+    etag = notes_etag(current_user.id, version)
+    response = not_modified(etag, changed_at)
+    if response:
+        return response
+    limit = request.args.get('limit', current_app.config.get('NOTES_PAGE_SIZE', DEFAULT_PAGE_SIZE), type=int)
+    tag = request.args.get('tag')
+    tag_id = find_tag(current_user.id, tag) if tag else None
+    if tag and tag_id is None:
+        notes, next_cursor = [], None # no note has it
+    else:
+        notes, next_cursor = notes_page(current_user.id, after=after, limit=limit,
+                                        tag_id=tag_id, start=start, end=end)
+    return set_validators(jsonify({"notes": [note.to_dict() for note in notes], "next": next_cursor}), etag, changed_at)
+
+
+@api.route('/notes/<int:note_id>', methods=['GET'])
+@login_required
+def get_note(note_id):
+    '''One note with its full content; listings only carry a preview of long notes'''
+    note = Note.query.filter_by(id=note_id, user_id=current_user.id).first()
+    if note is None:
+        return jsonify({"error": "Note not found."}), 404
+    return jsonify(dict(note.to_dict(), content=full_content(note), truncated=False))
+
+
+@api.route('/tags', methods=['GET'])
+@login_required
+def tags():
+    '''The current user's tags and how many notes carry each, read from maintained counters'''
+    return jsonify({"tags": user_tags(current_user.id)})
+
+
+@api.route('/notes/<int:note_id>/revisions', methods=['GET'])
+@login_required
+def note_revisions(note_id):
+    '''Edit history of a note, newest first; empty until it is first edited'''
+    if not _owned_ids([note_id]):
+        return jsonify({"error": "Note not found."}), 404
+    return jsonify({"id": note_id, "revisions": list_revisions(note_id)})
+
+
+@api.route('/notes/<int:note_id>/revisions/<int:number>', methods=['GET'])
+@login_required
+def note_revision(note_id, number):
+    '''The full text of one revision of a note'''
+    revision = materialize(note_id, number) if _owned_ids([note_id]) else None
+    if revision is None:
+        return jsonify({"error": "Revision not found."}), 404
+    content, date = revision
+    return jsonify({"id": note_id, "number": number, "content": content, "date": date.isoformat() if date else None})
+
+
+@api.route('/notes/changes', methods=['GET'])
+@login_required
+def note_changes():
+    '''Notes changed since ?since=<version>; answers 304 when the If-None-Match version is current'''
+    version = notes_version(current_user.id)
+    etag = 'v{}'.format(version)
+    if etag in request.if_none_match:
+        return '', 304, {'ETag': '"{}"'.format(etag)}
+    version, changes = changes_since(current_user.id, request.args.get('since', 0, type=int))
+    response = jsonify({"version": version, "changes": changes})
+    response.set_etag('v{}'.format(version))
+    return response
+
+
+@api.route('/notes/events', methods=['GET'])
+@login_required
+def note_events():
+    '''Server-Sent Events feed of note changes after Last-Event-ID, ?since=<version>, or from now on'''
+    since = request.headers.get('Last-Event-ID', type=int)
+    if since is None:
+        since = request.args.get('since', type=int)
+    if since is None:
+        since = notes_version(current_user.id)
+    broker = current_app.extensions['change_broker']
+    if not broker.open_stream(): # every stream this process may hold a thread for is taken
+        return jsonify({"error": "Too many open streams."}), 503, {'Retry-After': str(current_app.config['SSE_MAX_DURATION'])}
+    stream = change_stream(broker, current_user.id, since,
+                           current_app.config['SSE_POLL_INTERVAL'], current_app.config['SSE_MAX_DURATION'])
+    response = Response(stream_with_context(stream), mimetype='text/event-stream')
+    response.call_on_close(broker.close_stream) # also when the stream never started
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no' # nginx must not buffer the stream
+    return response
+
+
+@api.route('/notes/search', methods=['GET'])
+@login_required
+def search():
+    '''Ranked full-text search: ?q=<words>&offset=<next>'''
+    limit = min(max(request.args.get('limit', 20, type=int), 1), 100)
+    results, next_offset = search_notes(current_user.id, request.args.get('q', ''), limit=limit,
+                                        offset=max(request.args.get('offset', 0, type=int), 0))
+    return jsonify({"results": results, "next": next_offset})
+
+
+@api.route('/notes/export', methods=['GET'])
+@login_required
+def export():
+    '''Stream every note of the current user: ?format=ndjson (default) or csv'''
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in FORMATS:
+        raise BatchError("Unknown format.")
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    response = Response(stream_with_context(export_notes(current_user.id, fmt)), mimetype=mimetype)
+    response.headers['Content-Disposition'] = 'attachment; filename=notes.{}'.format(fmt)
+    return response
+
+
+@api.route('/notes/import', methods=['POST'])
+@login_required
+@rate_limit(('RATELIMIT_WRITE_USER', by_user))
+def import_():
+    '''Import notes from an uploaded "file" or the raw request body, ?format=ndjson|csv&batch_size=N'''
+    upload = request.files.get('file')
+    fmt = request.args.get('format') or ('csv' if upload and upload.filename.endswith('.csv') else 'ndjson')
+    if fmt not in FORMATS:
+        raise BatchError("Unknown format.")
+    batch_size = min(max(request.args.get('batch_size', current_app.config['IMPORT_BATCH_SIZE'], type=int), 1), 10000)
+    summary = import_notes(current_user.id, upload.stream if upload else request.stream, fmt, batch_size)
+    return jsonify(summary)
+
+
+@api.route('/notes', methods=['POST'])
+@login_required
+@rate_limit(('RATELIMIT_WRITE_USER', by_user))
+def create_notes():
+    '''Create many notes at once: {"notes": [{"content": ..., "tags": [...]}, ...]}'''
+    items = _items("notes")
+    if current_app.extensions.get('note_writer'):
+        return _enqueue(items)
+    return _run_batch({"create": items})
+
+
+@api.route('/notes', methods=['PATCH'])
+@login_required
+@rate_limit(('RATELIMIT_WRITE_USER', by_user))
+def update_notes():
+    '''Update many notes at once: {"notes": [{"id": ..., "content": ..., "tags": [...]}, ...]}, either field may be left out'''
+    return _run_batch({"update": _items("notes")})
+
+
+@api.route('/notes', methods=['DELETE'])
+@login_required
+@rate_limit(('RATELIMIT_WRITE_USER', by_user))
+def delete_notes():
+    '''Delete many notes at once: {"ids": [...]}'''
+    return _run_batch({"delete": _items("ids")})
+
+
+@api.route('/notes/batch', methods=['POST'])
+@login_required
+@rate_limit(('RATELIMIT_WRITE_USER', by_user))
+def batch_notes():
+    '''Mixed batch: {"create": [...], "update": [...], "delete": [...]} applied in one transaction'''
+    data = request.get_json(silent=True) or {}
+    return _run_batch({op: data.get(op) or [] for op in ("create", "update", "delete")})
+
+
+class BatchError(Exception):
+    pass
+
+
+@api.errorhandler(BatchError)
+def batch_error(error):
+    return jsonify({"error": str(error)}), 400
+
+
+@api.errorhandler(TooManyRequests)
+def too_many_requests(error):
+    return jsonify({"error": "Too many requests."}), 429, {'Retry-After': str(error.retry_after)}
+
+
+def _items(key):
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get(key), list):
+        raise BatchError('Expected a JSON object with a "{}" list.'.format(key))
+    return data[key]
+
+
+def _run_batch(ops):
+    if not all(isinstance(items, list) for items in ops.values()):
+        raise BatchError("Batch operations must be lists.")
+    limit = current_app.config.get('NOTES_BATCH_LIMIT', 1000)
+    if sum(len(items) for items in ops.values()) > limit:
+        raise BatchError("At most {} items per request.".format(limit))
+
+    results = {}
+    try:
+        if ops.get("create"):
+            results["create"] = _create(ops["create"])
+        if ops.get("update"):
+            results["update"] = _update(ops["update"])
+        if ops.get("delete"):
+            results["delete"] = _delete(ops["delete"])
+        db.session.commit() # a single commit for the whole batch
+    except Exception:
+        db.session.rollback()
+        raise
+    return jsonify(results)
+
+
+def _enqueue(items):
+    # write-behind mode: notes are durable once spooled, ids are only known after the group commit
+    if len(items) > current_app.config.get('NOTES_BATCH_LIMIT', 1000):
+        raise BatchError("At most {} items per request.".format(current_app.config.get('NOTES_BATCH_LIMIT', 1000)))
+    results = []
+    for item in items:
+        error = _item_error(item)
+        if error:
+            results.append({"status": "error", "error": error})
+        else:
+            enqueue_note(current_app, current_user.id, item["content"], item.get("tags"))
+            results.append({"status": "queued"})
+    return jsonify({"create": results}), 202
+
+
+def _item_error(item, need_content=True):
+    if not isinstance(item, dict):
+        return content_error(None)
+    if "tags" in item:
+        error = tags_error(item["tags"])
+        if error or not (need_content or "content" in item):
+            return error # a tags-only update
+    return content_error(item.get("content"))
+
+
+def _create(items):
+    results = [None] * len(items)
+    rows, positions = [], []
+    for i, item in enumerate(items):
+        error = _item_error(item)
+        if error:
+            results[i] = {"status": "error", "error": error}
+        else:
+            rows.append({"content": item["content"], "user_id": current_user.id})
+            positions.append(i)
+    if rows:
+        rows, blobs = prepare_rows(rows)
+        save_blobs(blobs)
+        created = db.session.execute(insert(Note).returning(Note.id, sort_by_parameter_order=True), rows)
+        for i, note_id in zip(positions, created.scalars()):
+            results[i] = {"status": "created", "id": note_id}
+        set_note_tags(current_user.id, {results[i]["id"]: items[i]["tags"] for i in positions if items[i].get("tags")})
+        record_changes(current_user.id, [results[i]["id"] for i in positions], "upsert")
+    return results
+
+
+def _update(items):
+    results = [None] * len(items)
+    wanted = {}
+    for i, item in enumerate(items):
+        error = _item_error(item, need_content=False)
+        if error is None and not isinstance(item.get("id"), int):
+            error = "Missing note id."
+        if error:
+            results[i] = {"status": "error", "error": error}
+        else:
+            wanted[i] = item
+    owned = {note.id: note for note in Note.query.filter(
+        Note.id.in_([item["id"] for item in wanted.values()]), Note.user_id == current_user.id)}
+    rows, tagged = [], {}
+    for i, item in wanted.items():
+        if item["id"] in owned:
+            if "content" in item:
+                rows.append({"id": item["id"], "content": item["content"]})
+            if "tags" in item:
+                tagged[item["id"]] = item["tags"]
+            results[i] = {"status": "updated", "id": item["id"]}
+        else:
+            results[i] = {"status": "not_found", "id": item["id"]}
+    if rows:
+        edited = {row["id"]: row["content"] for row in rows} # the last one wins if a note is listed twice
+        record_revisions([owned[note_id] for note_id in edited], edited)
+        rows, blobs = prepare_rows(rows)
+        save_blobs(blobs)
+        db.session.execute(update(Note), rows) # bulk UPDATE ... WHERE id = ? executemany
+    set_note_tags(current_user.id, tagged)
+    record_changes(current_user.id, sorted({row["id"] for row in rows} | set(tagged)), "upsert")
+    return results
+
+
+def _delete(ids):
+    valid = [note_id for note_id in ids if isinstance(note_id, int)]
+    deleted = set()
+    if valid:
+        deleted = set(db.session.execute(
+            delete(Note).where(Note.id.in_(valid), Note.user_id == current_user.id).returning(Note.id)
+        ).scalars())
+        untag_notes(sorted(deleted))
+        drop_revisions(sorted(deleted))
+        record_changes(current_user.id, sorted(deleted), "delete")
+    return [{"status": "deleted" if note_id in deleted else "not_found", "id": note_id} for note_id in ids]
+
+
+def _owned_ids(ids):
+    if not ids:
+        return set()
+    return set(db.session.execute(
+        select(Note.id).where(Note.id.in_(ids), Note.user_id == current_user.id)
+    ).scalars())
@@ -1,6 +1,9 @@
-from flask import Blueprint, render_template, request, flash, redirect, url_for
+from flask import Blueprint, render_template, request, flash, redirect, url_for, current_app
 from .models import User
-from werkzeug.security import generate_password_hash, check_password_hash
+from .passwords import HashingBusy
+from .ratelimit import rate_limit, by_ip, by_email
+from .shards import choose_shard
+from werkzeug.exceptions import TooManyRequests
 from . import db
 from flask_login import login_user, login_required, logout_user, current_user
 
@@ -11,13 +14,21 @@ auth = Blueprint('auth', __name__)
 
 
 @auth.route('/login', methods=['GET', 'POST'])
+@rate_limit(('RATELIMIT_LOGIN_IP', by_ip), ('RATELIMIT_LOGIN_EMAIL', by_email))
 def login():
     if request.method == 'POST':
         email = request.form.get('email')
         pwd = request.form.get('password')
         user = User.query.filter_by(email=email).first()
         if user:
-            if check_password_hash(user.password, pwd):
+            try:
+                matches, new_hash = current_app.extensions['password_hasher'].verify(user.password, pwd)
+            except HashingBusy:
+                return busy("login.html")
+            if matches:
+                if new_hash: # stored with an older method or cost, upgrade it while we know the password
+                    user.password = new_hash
+                    db.session.commit()
                 flash("Logged In successfully. Welcome Back!", category="success")
                 login_user(user, remember=True)
                 return redirect(url_for('views.home'))
@@ -36,6 +47,7 @@ def logout():
     return redirect(url_for('auth.login'))
 
 @auth.route('/signup',  methods=['GET', 'POST'])
+@rate_limit(('RATELIMIT_SIGNUP_IP', by_ip))
 def sign_up():
     if request.method == "POST":
         email = request.form.get("email")
@@ -55,7 +67,11 @@ def sign_up():
         elif len(password1) < 8:
             flash("Passwords must be at least 8 characters.", category='error')
         else:
-            new_user = User(email=email, first_name=firstName, password=generate_password_hash(password1, method='pbkdf2:sha256'))
+            try:
+                password = current_app.extensions['password_hasher'].hash(password1)
+            except HashingBusy:
+                return busy("signup.html")
+            new_user = User(email=email, first_name=firstName, password=password, shard=choose_shard())
             db.session.add(new_user)
             db.session.commit()
             flash("Successfully Signed up. Welcome!", category='success')
@@ -63,3 +79,15 @@ def sign_up():
             return redirect(url_for('views.home')) # redirects to home page
 
     return render_template("signup.html", user=current_user)
+
+
+def busy(template):
+    flash("We are handling a lot of sign-ins right now. Please try again in a moment.", category="error")
+    return render_template(template, user=current_user), 503
+
+
+@auth.errorhandler(TooManyRequests)
+def too_many_attempts(error):
+    flash("Too many attempts. Please try again in a moment.", category="error")
+    template = "signup.html" if request.endpoint == 'auth.sign_up' else "login.html"
+    return render_template(template, user=current_user), 429, {'Retry-After': str(error.retry_after)}
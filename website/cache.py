@@ -0,0 +1,129 @@
+import json
+import time
+from collections import OrderedDict
+from threading import Lock
+from flask import current_app, has_app_context
+from markupsafe import Markup
+from sqlalchemy import event
+from sqlalchemy.orm import make_transient_to_detached
+from .models import User
+from . import db
+
+
+'''In-process and shared caches, and the cached Flask-Login user loader built on them'''
+
+USER_FIELDS = ('id', 'email', 'first_name', 'shard') # the password hash never leaves the database
+
+
+class LocalCache:
+    '''Thread-safe LRU cache whose entries also expire after `ttl` seconds'''
+
+    def __init__(self, maxsize=10000, ttl=300, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires < self.clock():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (self.clock() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False) # evict the least recently used entry
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class RedisCache:
+    '''Same interface as LocalCache, shared by every worker through Redis (needs the `redis` package)'''
+
+    def __init__(self, url, ttl=300, prefix='notemaster:'):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return None if value is None else json.loads(value)
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, json.dumps(value), ex=self.ttl)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+
+def make_cache(config, maxsize, ttl):
+    '''A RedisCache when CACHE_URL is configured, otherwise a LocalCache standing in for it'''
+    if config.get('CACHE_URL'):
+        return RedisCache(config['CACHE_URL'], ttl=ttl)
+    return LocalCache(maxsize=maxsize, ttl=ttl)
+
+
+def init_user_cache(app):
+    app.extensions['user_cache'] = make_cache(app.config, app.config['USER_CACHE_SIZE'], app.config['USER_CACHE_TTL'])
+
+
+def init_fragment_cache(app):
+    app.extensions['fragment_cache'] = make_cache(app.config, app.config['FRAGMENT_CACHE_SIZE'], app.config['FRAGMENT_CACHE_TTL'])
+
+
+def cached_fragment(key, render):
+    '''Rendered HTML for `key`, calling `render()` only on a miss; keys must embed a version so they never go stale'''
+    cache = current_app.extensions['fragment_cache']
+    html = cache.get(key)
+    if html is None:
+        html = str(render())
+        cache.set(key, html)
+    return Markup(html)
+
+
+def load_cached_user(user_id):
+    '''Return the User for a session without querying when its identity is cached'''
+    cache = current_app.extensions['user_cache']
+    data = cache.get(_user_key(user_id))
+    if data is None:
+        user = db.session.get(User, user_id)
+        if user is not None:
+            cache.set(_user_key(user_id), {field: getattr(user, field) for field in USER_FIELDS})
+        return user
+    user = User(**data)
+    make_transient_to_detached(user) # columns left out (the password) load lazily if ever read
+    return db.session.merge(user, load=False)
+
+
+def invalidate_user(user_id):
+    if has_app_context() and 'user_cache' in current_app.extensions:
+        current_app.extensions['user_cache'].delete(_user_key(user_id))
+
+
+def _user_key(user_id):
+    return 'user:{}'.format(user_id)
+
+
+@event.listens_for(User, 'after_insert')
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def _user_changed(mapper, connection, target):
+    # covers signup, password or profile changes and SQLite reusing the id of a deleted user
+    invalidate_user(target.id)
@@ -0,0 +1,61 @@
+from sqlalchemy import insert, select, delete, func
+from .models import Note, NoteChange
+from . import db
+
+
+'''Per-user change log of notes, so clients can fetch only what changed since their version'''
+
+
+def record_changes(user_id, note_ids, op):
+    '''Log writes to `note_ids`; call it inside the transaction that makes them'''
+    if note_ids:
+        db.session.execute(insert(NoteChange), change_rows(user_id, note_ids, op))
+        db.session.info.setdefault('changed_users', set()).add(user_id) # their SSE streams are woken on commit
+
+
+def change_rows(user_id, note_ids, op):
+    return [{"user_id": user_id, "note_id": note_id, "op": op} for note_id in note_ids]
+
+
+def notes_version(user_id):
+    '''Version of a user's notes: the seq of their latest change, 0 if there is none'''
+    return notes_version_info(user_id)[0]
+
+
+def notes_version_info(user_id):
+    '''(version, time of that change) for a user, (0, None) before their first note'''
+    row = db.session.execute(version_query(user_id)).first()
+    return (row.seq, row.date) if row else (0, None)
+
+
+def version_query(user_id):
+    return select(NoteChange.seq, NoteChange.date).where(NoteChange.user_id == user_id).order_by(NoteChange.seq.desc()).limit(1)
+
+
+def changes_since(user_id, since):
+    '''Return (version, changes) with one entry per note touched after `since`, holding its current state'''
+    rows = db.session.execute(
+        select(NoteChange.note_id, func.max(NoteChange.seq).label('seq'))
+        .where(NoteChange.user_id == user_id, NoteChange.seq > since)
+        .group_by(NoteChange.note_id)
+    ).all()
+    if not rows:
+        return notes_version(user_id), []
+    current = {note.id: note for note in Note.query.filter(Note.user_id == user_id, Note.id.in_([row.note_id for row in rows]))}
+    changes = []
+    for row in sorted(rows, key=lambda row: row.seq):
+        note = current.get(row.note_id)
+        if note is None:
+            changes.append({"op": "delete", "id": row.note_id, "seq": row.seq})
+        else:
+            changes.append({"op": "upsert", "id": row.note_id, "seq": row.seq, "note": note.to_dict()})
+    return changes[-1]["seq"], changes
+
+
+def compact_changes():
+    '''Delete log entries superseded by a later one for the same note; returns how many.
+    changes_since only reads the latest entry per note and versions are the latest seq, so clients cannot tell.'''
+    latest = select(func.max(NoteChange.seq)).group_by(NoteChange.user_id, NoteChange.note_id)
+    result = db.session.execute(delete(NoteChange).where(NoteChange.seq.not_in(latest)))
+    db.session.commit()
+    return result.rowcount
@@ -0,0 +1,128 @@
+import json
+import threading
+import time
+from collections import defaultdict
+from flask import current_app, has_app_context
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from .changes import changes_since
+from . import db
+
+
+'''Real-time note sync over Server-Sent Events.
+
+Every committed note change wakes the SSE streams of its user in this process through
+ChangeBroker, and the stream sends whatever note_change holds after the client's last seq.
+Changes committed by other processes are picked up when the stream re-checks the log every
+SSE_POLL_INTERVAL seconds, which also serves as keepalive.
+
+Under gthread a stream holds one worker thread for up to SSE_MAX_DURATION seconds, so a process
+serves at most SSE_MAX_STREAMS of them at once and answers 503 beyond that, keeping the rest of
+its threads for requests; pages then fall back to syncing when they are shown again.
+'''
+
+
+class Subscription:
+
+    def __init__(self, broker, user_id):
+        self.broker = broker
+        self.user_id = user_id
+        self._event = threading.Event()
+
+    def notify(self):
+        self._event.set()
+
+    def wait(self, timeout):
+        '''True if a change was published since the last wait, False on timeout'''
+        woken = self._event.wait(timeout)
+        self._event.clear()
+        return woken
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.broker.unsubscribe(self)
+
+
+class ChangeBroker:
+    '''In-process fanout of "user X has new changes" to that user's open streams'''
+
+    def __init__(self, max_streams=None):
+        self.max_streams = max_streams
+        self._lock = threading.Lock()
+        self._subscriptions = defaultdict(set)
+        self._open = 0
+
+    def open_stream(self):
+        '''Reserve a slot for a stream; False when max_streams are already open'''
+        with self._lock:
+            if self.max_streams is not None and self._open >= self.max_streams:
+                return False
+            self._open += 1
+            return True
+
+    def close_stream(self):
+        with self._lock:
+            self._open -= 1
+
+    def subscribe(self, user_id):
+        subscription = Subscription(self, user_id)
+        with self._lock:
+            self._subscriptions[user_id].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.user_id)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[subscription.user_id]
+
+    def publish(self, user_id):
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(user_id, ()))
+        for subscription in subscriptions:
+            subscription.notify()
+
+    def stats(self):
+        with self._lock:
+            return {"users": len(self._subscriptions), "streams": sum(len(s) for s in self._subscriptions.values()),
+                    "open": self._open}
+
+
+def init_events(app):
+    app.extensions['change_broker'] = ChangeBroker(app.config['SSE_MAX_STREAMS'])
+
+
+@event.listens_for(Session, 'after_commit')
+def _publish_changes(session):
+    # record_changes notes the users whose log it appended to in session.info
+    users = session.info.pop('changed_users', None)
+    if users and has_app_context() and 'change_broker' in current_app.extensions:
+        for user_id in users:
+            current_app.extensions['change_broker'].publish(user_id)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _drop_changes(session):
+    session.info.pop('changed_users', None)
+
+
+def change_stream(broker, user_id, since, poll_interval, max_duration):
+    '''SSE body: changes after seq `since` as they are committed, for up to `max_duration` seconds;
+    the browser then reconnects with Last-Event-ID and resumes where this left off'''
+    deadline = time.monotonic() + max_duration
+    with broker.subscribe(user_id) as subscription: # before the first read, so no commit falls in between
+        yield 'retry: 3000\n\n'
+        while True:
+            version, changes = changes_since(user_id, since)
+            db.session.close() # give the connection back while we wait
+            for change in changes:
+                yield 'id: {}\nevent: {}\ndata: {}\n\n'.format(change["seq"], change["op"], json.dumps(change))
+            since = max(since, version)
+            if time.monotonic() >= deadline:
+                return
+            if not subscription.wait(min(poll_interval, max(deadline - time.monotonic(), 0))):
+                yield ': ping\n\n'
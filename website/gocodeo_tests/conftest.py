@@ -0,0 +1,47 @@
+import pytest
+from flask import g
+from website import create_app, db
+from website.models import User
+
+
+'''Fixtures shared by the test modules: an app on a fresh database holding two users, and test
+clients logged in as them. A module changes the config by overriding `app_config`, and adds its
+own data by overriding `app` (or `client`) on top of these.'''
+
+
+@pytest.fixture
+def app_config():
+    '''Config overrides for the module's app'''
+    return {}
+
+
+@pytest.fixture
+def app(app_config):
+    app = create_app(dict({'TESTING': True, 'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:'}, **app_config))
+
+    @app.before_request
+    def forget_user():
+        g.pop('_login_user', None) # requests share the app context below, and with it g
+
+    with app.app_context():
+        db.create_all()
+        db.session.add_all([User(email='test@example.com', first_name='John', password='x'),
+                            User(email='other@example.com', first_name='Jane', password='x')])
+        db.session.commit()
+        yield app
+
+
+@pytest.fixture
+def login(app):
+    '''login(user_id) gives a test client whose session holds that user'''
+    def login(user_id):
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess['_user_id'] = str(user_id)
+        return client
+    return login
+
+
+@pytest.fixture
+def client(login):
+    return login(1)
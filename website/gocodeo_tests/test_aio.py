@@ -0,0 +1,93 @@
+import asyncio
+import pytest
+httpx = pytest.importorskip('httpx')
+pytest.importorskip('aiosqlite')
+from website import db
+from website.models import Note, Tag, NoteRevision
+from website.aio import NotesASGI, async_database_uri
+from website.changes import notes_version
+
+@pytest.fixture
+def app_config(tmp_path):
+    return {'SQLALCHEMY_DATABASE_URI': 'sqlite:///{}'.format(tmp_path / 'notes.db')} # shared with the async engine
+
+@pytest.fixture
+def asgi_app(app):
+    db.session.add(Note(content='not yours', user_id=2))
+    db.session.commit()
+    return NotesASGI(app)
+
+def request(asgi_app, method, path, user_id=1, **kwargs):
+    async def go():
+        cookies = {}
+        if user_id:
+            cookies['session'] = asgi_app.serializer.dumps({'_user_id': str(user_id)})
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=asgi_app), base_url='http://test', cookies=cookies) as client:
+            return await client.request(method, path, **kwargs)
+    return asyncio.run(go())
+
+# happy_path - test_async_database_uri - Test that database URLs are mapped to async drivers
+def test_async_database_uri():
+    assert async_database_uri('sqlite:////tmp/notemaster.db') == 'sqlite+aiosqlite:////tmp/notemaster.db'
+    assert async_database_uri('postgresql://u:p@db/notes') == 'postgresql+asyncpg://u:p@db/notes'
+
+# happy_path - test_async_create_list_delete - Test that the async handlers create, list and delete notes
+def test_async_create_list_delete(asgi_app):
+    created = request(asgi_app, 'POST', '/api/notes', json={'notes': [{'content': 'a'}, {'content': ''}, {'content': 'b'}]})
+    assert [r['status'] for r in created.json()['create']] == ['created', 'error', 'created']
+    listing = request(asgi_app, 'GET', '/api/notes?limit=1')
+    assert [n['content'] for n in listing.json()['notes']] == ['b']
+    assert listing.json()['next'] is not None
+    ids = [r['id'] for r in created.json()['create'] if 'id' in r]
+    deleted = request(asgi_app, 'DELETE', '/api/notes', json={'ids': ids + [1]})
+    assert [r['status'] for r in deleted.json()['delete']] == ['deleted', 'deleted', 'not_found']
+    with asgi_app.app.app_context():
+        assert Note.query.count() == 1
+        assert notes_version(1) == 4
+
+# happy_path - test_async_list_not_modified - Test that the async listing answers 304 for a current ETag
+def test_async_list_not_modified(asgi_app):
+    request(asgi_app, 'POST', '/api/notes', json={'notes': [{'content': 'a'}]})
+    etag = request(asgi_app, 'GET', '/api/notes').headers['etag']
+    assert request(asgi_app, 'GET', '/api/notes', headers={'If-None-Match': etag}).status_code == 304
+
+# edge_case - test_other_routes_go_to_flask - Test that anonymous and non-note requests are served by Flask
+def test_other_routes_go_to_flask(asgi_app):
+    assert request(asgi_app, 'GET', '/login', user_id=None).status_code == 200
+    assert request(asgi_app, 'GET', '/api/notes', user_id=None).status_code == 302
+
+# edge_case - test_async_malformed_body - Test that a body without the expected list is rejected
+def test_async_malformed_body(asgi_app):
+    assert request(asgi_app, 'POST', '/api/notes', json={'content': 'x'}).status_code == 400
+
+# happy_path - test_async_tags_and_filters - Test that the async handlers tag notes, filter by tag and count tags down on delete
+def test_async_tags_and_filters(asgi_app):
+    created = request(asgi_app, 'POST', '/api/notes', json={'notes': [{'content': 'a', 'tags': ['Work']}, {'content': 'b'},
+                                                                      {'content': 'c', 'tags': 'work'}]})
+    assert [r['status'] for r in created.json()['create']] == ['created', 'created', 'error']
+    listing = request(asgi_app, 'GET', '/api/notes?tag=work').json()
+    assert [(n['content'], n['tags']) for n in listing['notes']] == [('a', ['work'])]
+    assert request(asgi_app, 'GET', '/api/notes?tag=none').json()['notes'] == []
+    assert request(asgi_app, 'GET', '/api/notes?from=soon').status_code == 400
+    request(asgi_app, 'DELETE', '/api/notes', json={'ids': [created.json()['create'][0]['id']]})
+    with asgi_app.app.app_context():
+        assert Tag.query.one().note_count == 0
+
+# edge_case - test_async_delete_drops_revisions - Test that deleting through the async handler also drops the note's history
+def test_async_delete_drops_revisions(asgi_app):
+    note_id = request(asgi_app, 'POST', '/api/notes', json={'notes': [{'content': 'secret'}]}).json()['create'][0]['id']
+    request(asgi_app, 'PATCH', '/api/notes', json={'notes': [{'id': note_id, 'content': 'edited'}]}) # served by Flask
+    with asgi_app.app.app_context():
+        assert NoteRevision.query.count() == 2
+    request(asgi_app, 'DELETE', '/api/notes', json={'ids': [note_id]})
+    with asgi_app.app.app_context():
+        assert NoteRevision.query.count() == 0
+
+# happy_path - test_async_writes_are_rate_limited - Test that async writes share the per-user write limit and answer 429
+def test_async_writes_are_rate_limited(asgi_app):
+    asgi_app.app.config['RATELIMIT_WRITE_USER'] = (2, 60)
+    statuses = [request(asgi_app, 'POST', '/api/notes', json={'notes': [{'content': 'a'}]}).status_code for _ in range(2)]
+    limited = request(asgi_app, 'DELETE', '/api/notes', json={'ids': [2]})
+    assert statuses == [200, 200] and limited.status_code == 429
+    assert limited.json() == {'error': 'Too many requests.'} and int(limited.headers['retry-after']) == 30
+    assert request(asgi_app, 'GET', '/api/notes').status_code == 200
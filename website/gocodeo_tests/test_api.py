@@ -0,0 +1,62 @@
+import pytest
+from website import db
+from website.models import Note
+
+@pytest.fixture
+def app_config():
+    return {'NOTES_BATCH_LIMIT': 5}
+
+@pytest.fixture
+def app(app):
+    db.session.add(Note(content='not yours', user_id=2))
+    db.session.commit()
+    return app
+
+# happy_path - test_create_notes_batch - Test that several notes are created in one request with per-item results
+def test_create_notes_batch(client):
+    response = client.post('/api/notes', json={'notes': [{'content': 'a'}, {'content': ''}, {'content': 'b'}]})
+    assert response.status_code == 200
+    results = response.json['create']
+    assert [r['status'] for r in results] == ['created', 'error', 'created']
+    assert Note.query.filter_by(user_id=1).count() == 2
+    assert db.session.get(Note, results[2]['id']).content == 'b'
+
+# happy_path - test_update_notes_batch - Test that only the user's own notes are updated
+def test_update_notes_batch(client):
+    created = client.post('/api/notes', json={'notes': [{'content': 'a'}]}).json['create']
+    response = client.patch('/api/notes', json={'notes': [{'id': created[0]['id'], 'content': 'edited'}, {'id': 1, 'content': 'hijack'}]})
+    assert [r['status'] for r in response.json['update']] == ['updated', 'not_found']
+    assert db.session.get(Note, created[0]['id']).content == 'edited'
+    assert db.session.get(Note, 1).content == 'not yours'
+
+# happy_path - test_delete_notes_batch - Test that a list of ids is deleted with one statement
+def test_delete_notes_batch(client):
+    ids = [r['id'] for r in client.post('/api/notes', json={'notes': [{'content': 'a'}, {'content': 'b'}]}).json['create']]
+    response = client.delete('/api/notes', json={'ids': ids + [1]})
+    assert [r['status'] for r in response.json['delete']] == ['deleted', 'deleted', 'not_found']
+    assert Note.query.filter_by(user_id=1).count() == 0
+    assert db.session.get(Note, 1) is not None
+
+# happy_path - test_mixed_batch - Test that create, update and delete can be sent together
+def test_mixed_batch(client):
+    ids = [r['id'] for r in client.post('/api/notes', json={'notes': [{'content': 'a'}, {'content': 'b'}]}).json['create']]
+    response = client.post('/api/notes/batch', json={'create': [{'content': 'c'}], 'update': [{'id': ids[0], 'content': 'A'}], 'delete': [ids[1]]})
+    assert response.status_code == 200
+    assert sorted(n.content for n in Note.query.filter_by(user_id=1)) == ['A', 'c']
+
+# edge_case - test_clients_act_as_their_own_user - Test that clients of two users see only their own notes
+def test_clients_act_as_their_own_user(client, login):
+    client.post('/api/notes', json={'notes': [{'content': 'mine'}]})
+    assert [n['content'] for n in login(2).get('/api/notes').json['notes']] == ['not yours']
+    assert [n['content'] for n in client.get('/api/notes').json['notes']] == ['mine']
+
+# edge_case - test_batch_limit - Test that oversized batches are rejected before touching the database
+def test_batch_limit(client):
+    response = client.post('/api/notes', json={'notes': [{'content': 'x'}] * 6})
+    assert response.status_code == 400
+    assert Note.query.filter_by(user_id=1).count() == 0
+
+# edge_case - test_malformed_body - Test that a body without the expected list is rejected
+def test_malformed_body(client):
+    response = client.post('/api/notes', json={'content': 'x'})
+    assert response.status_code == 400
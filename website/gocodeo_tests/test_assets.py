@@ -0,0 +1,105 @@
+import gzip
+import os
+import click
+import pytest
+from website import create_app
+from website.assets import build_assets, build_id, compile_templates
+
+@pytest.fixture
+def app(tmp_path):
+    static = tmp_path / 'static'
+    (static / 'css').mkdir(parents=True)
+    (static / 'index.js').write_text('console.log("notes");\n' * 50)
+    (static / 'css' / 'site.css').write_text('body { margin: 0; }\n')
+    (static / 'logo.png').write_bytes(b'\x89PNG fake')
+    app = create_app({'TESTING': True, 'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:',
+                      'TEMPLATE_CACHE_DIR': str(tmp_path / 'templates')})
+    app.static_folder = str(static)
+    return app
+
+# happy_path - test_build_assets_fingerprints_and_compresses - Test that every static file gets a hashed copy and text files a .gz
+def test_build_assets_fingerprints_and_compresses(app):
+    manifest = build_assets(app)
+    assert set(manifest) == {'index.js', 'css/site.css', 'logo.png'}
+    assert manifest['index.js'].startswith('index.') and manifest['index.js'].endswith('.js')
+    dist = os.path.join(app.static_folder, 'dist')
+    with open(os.path.join(dist, manifest['index.js'] + '.gz'), 'rb') as f:
+        assert gzip.decompress(f.read()) == b'console.log("notes");\n' * 50
+    assert not os.path.exists(os.path.join(dist, manifest['logo.png'] + '.gz'))
+    assert build_assets(app) == manifest # same content, same names, dist itself is skipped
+
+# happy_path - test_asset_url_uses_manifest - Test that asset_url points at /static before a build and at the hashed copy after
+def test_asset_url_uses_manifest(app):
+    with app.test_request_context():
+        assert app.jinja_env.globals['asset_url']('index.js') == '/static/index.js'
+    manifest = build_assets(app)
+    app.extensions['asset_manifest'] = manifest
+    with app.test_request_context():
+        assert app.jinja_env.globals['asset_url']('index.js') == '/assets/' + manifest['index.js']
+        assert app.jinja_env.globals['asset_url']('missing.js') == '/static/missing.js'
+
+# happy_path - test_assets_are_served_compressed_and_immutable - Test that the gzip copy is served to browsers that accept it
+def test_assets_are_served_compressed_and_immutable(app):
+    built = build_assets(app)['index.js']
+    client = app.test_client()
+    response = client.get('/assets/' + built, headers={'Accept-Encoding': 'gzip, deflate'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.mimetype in ('text/javascript', 'application/javascript')
+    assert gzip.decompress(response.data) == b'console.log("notes");\n' * 50
+    assert 'immutable' in response.headers['Cache-Control'] and 'max-age=31536000' in response.headers['Cache-Control']
+    assert 'Accept-Encoding' in response.headers['Vary']
+    response.close()
+    plain = client.get('/assets/' + built)
+    assert 'Content-Encoding' not in plain.headers
+    assert plain.data == b'console.log("notes");\n' * 50
+    plain.close()
+
+# edge_case - test_unknown_asset_is_404 - Test that a name missing from the build is not found
+def test_unknown_asset_is_404(app):
+    build_assets(app)
+    assert app.test_client().get('/assets/index.000000000000.js').status_code == 404
+
+# happy_path - test_compile_templates_fills_bytecode_cache - Test that templates are compiled into TEMPLATE_CACHE_DIR
+def test_compile_templates_fills_bytecode_cache(app):
+    names = compile_templates(app)
+    assert 'base.html' in names
+    assert len(os.listdir(app.config['TEMPLATE_CACHE_DIR'])) >= len(names)
+
+# edge_case - test_compile_templates_without_cache_dir - Test that compiling without a cache directory is refused
+def test_compile_templates_without_cache_dir():
+    app = create_app({'TESTING': True, 'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:', 'TEMPLATE_CACHE_DIR': ''})
+    assert app.jinja_env.bytecode_cache is None
+    with pytest.raises(click.UsageError):
+        compile_templates(app)
+
+# edge_case - test_default_template_cache_is_private - Test that the default bytecode cache lives in a directory only this user can write
+def test_default_template_cache_is_private():
+    app = create_app({'TESTING': True, 'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:'})
+    info = os.stat(app.jinja_env.bytecode_cache.directory)
+    assert info.st_uid == os.getuid() and info.st_mode & 0o777 == 0o700
+
+# happy_path - test_startup_time_is_recorded - Test that create_app records how long it took
+def test_startup_time_is_recorded(app):
+    assert 0 < app.extensions['startup_seconds'] < 30
+
+# happy_path - test_build_keeps_previous_build - Test that a rebuild keeps the files of the build before it and drops older ones
+def test_build_keeps_previous_build(app):
+    dist = os.path.join(app.static_folder, 'dist')
+    script = os.path.join(app.static_folder, 'index.js')
+    first = build_assets(app)['index.js']
+    with open(script, 'a') as f:
+        f.write('console.log("v2");\n')
+    second = build_assets(app)['index.js']
+    assert os.path.exists(os.path.join(dist, first)) and os.path.exists(os.path.join(dist, first + '.gz'))
+    with open(script, 'a') as f:
+        f.write('console.log("v3");\n')
+    third = build_assets(app)['index.js']
+    assert len({first, second, third}) == 3
+    assert not os.path.exists(os.path.join(dist, first)) and not os.path.exists(os.path.join(dist, first + '.gz'))
+    assert os.path.exists(os.path.join(dist, second)) and os.path.exists(os.path.join(dist, third))
+
+# happy_path - test_build_id_follows_manifest - Test that the build id changes with the manifest and is empty before a build
+def test_build_id_follows_manifest(app):
+    assert build_id({}) == ''
+    assert build_id({'index.js': 'index.1.js'}) != build_id({'index.js': 'index.2.js'})
+    assert len(build_id(build_assets(app))) == 12
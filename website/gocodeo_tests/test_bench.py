@@ -0,0 +1,25 @@
+import json
+from bench.run import percentile, summarize, compare, main
+
+# happy_path - test_percentile_nearest_rank - Test that percentiles use the nearest-rank method
+def test_percentile_nearest_rank():
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 99) == 99
+    assert percentile([], 95) == 0.0
+
+# happy_path - test_compare_flags_regression - Test that a slower p95 beyond the threshold is reported
+def test_compare_flags_regression():
+    old = {'results': [summarize('home', 10, [0.010] * 10, 0, 1.0)]}
+    new = {'results': [summarize('home', 10, [0.015] * 10, 0, 1.0)]}
+    assert compare(old, new, threshold=10)
+    assert not compare(old, old, threshold=10)
+
+# happy_path - test_inprocess_run - Test that a small in-process run produces a JSON report for every scenario
+def test_inprocess_run(tmp_path):
+    output = tmp_path / 'bench.json'
+    assert main(['--db', str(tmp_path / 'bench.db'), '--profiles', '5', '--requests', '4', '--auth-requests', '1',
+                 '--concurrency', '2', '--hash-workers', '0', '--output', str(output)]) == 0
+    report = json.loads(output.read_text())
+    assert {r['scenario'] for r in report['results']} == {'home', 'home_revalidate', 'api_list', 'delete_note', 'login', 'sign_up'}
+    assert all(r['errors'] == 0 and r['requests'] > 0 for r in report['results'])
@@ -0,0 +1,69 @@
+import pytest
+from sqlalchemy import event
+from website import db
+from website.models import User
+from website.cache import LocalCache, load_cached_user
+
+@pytest.fixture
+def queries(app):
+    statements = []
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(db.engine, 'before_cursor_execute', record)
+    yield statements
+    event.remove(db.engine, 'before_cursor_execute', record)
+
+# happy_path - test_local_cache_lru_eviction - Test that the least recently used entry is evicted first
+def test_local_cache_lru_eviction():
+    cache = LocalCache(maxsize=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    assert cache.get('a') == 1
+    assert cache.get('b') is None
+    assert cache.get('c') == 3
+
+# happy_path - test_local_cache_ttl - Test that entries expire after the ttl
+def test_local_cache_ttl():
+    now = [0]
+    cache = LocalCache(ttl=10, clock=lambda: now[0])
+    cache.set('a', 1)
+    now[0] = 5
+    assert cache.get('a') == 1
+    now[0] = 11
+    assert cache.get('a') is None
+
+# happy_path - test_cached_user_skips_query - Test that a cached user is served without a SELECT
+def test_cached_user_skips_query(app, queries):
+    assert load_cached_user(1).email == 'test@example.com'
+    db.session.remove()
+    del queries[:]
+    user = load_cached_user(1)
+    assert user.first_name == 'John'
+    assert user.is_authenticated
+    assert queries == []
+
+# happy_path - test_cached_user_password_loads_lazily - Test that the password hash is not cached but still readable
+def test_cached_user_password_loads_lazily(app):
+    db.session.get(User, 1).password = 'stored-hash'
+    db.session.commit()
+    load_cached_user(1)
+    assert 'stored-hash' not in str(app.extensions['user_cache'].get('user:1'))
+    db.session.remove()
+    assert load_cached_user(1).password == 'stored-hash'
+
+# edge_case - test_user_update_invalidates_cache - Test that changing a user drops its cache entry
+def test_user_update_invalidates_cache(app):
+    load_cached_user(1)
+    user = db.session.get(User, 1)
+    user.first_name = 'Johnny'
+    db.session.commit()
+    db.session.remove()
+    assert app.extensions['user_cache'].get('user:1') is None
+    assert load_cached_user(1).first_name == 'Johnny'
+
+# edge_case - test_missing_user - Test that unknown ids return None and are not cached
+def test_missing_user(app):
+    assert load_cached_user(42) is None
+    assert app.extensions['user_cache'].get('user:42') is None
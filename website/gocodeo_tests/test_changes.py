@@ -0,0 +1,44 @@
+from website.changes import notes_version, changes_since
+
+# happy_path - test_changes_since_version - Test that only notes touched after a version are returned, in their current state
+def test_changes_since_version(client):
+    ids = [r['id'] for r in client.post('/api/notes', json={'notes': [{'content': 'a'}, {'content': 'b'}]}).json['create']]
+    version = notes_version(1)
+    client.patch('/api/notes', json={'notes': [{'id': ids[0], 'content': 'A'}]})
+    client.delete('/api/notes', json={'ids': [ids[1]]})
+    new_version, changes = changes_since(1, version)
+    assert new_version == notes_version(1) > version
+    assert [(c['op'], c['id']) for c in changes] == [('upsert', ids[0]), ('delete', ids[1])]
+    assert changes[0]['note']['content'] == 'A'
+
+# happy_path - test_changes_collapse_per_note - Test that a note created and deleted after the version shows up once as deleted
+def test_changes_collapse_per_note(client):
+    note_id = client.post('/api/notes', json={'notes': [{'content': 'a'}]}).json['create'][0]['id']
+    client.delete('/api/notes', json={'ids': [note_id]})
+    _, changes = changes_since(1, 0)
+    assert [(c['op'], c['id']) for c in changes] == [('delete', note_id)]
+
+# happy_path - test_changes_endpoint_not_modified - Test that a current If-None-Match version gets a 304
+def test_changes_endpoint_not_modified(client):
+    client.post('/api/notes', json={'notes': [{'content': 'a'}]})
+    response = client.get('/api/notes/changes?since=0')
+    assert response.status_code == 200
+    assert len(response.json['changes']) == 1
+    version = response.json['version']
+    cached = client.get('/api/notes/changes?since={}'.format(version), headers={'If-None-Match': '"v{}"'.format(version)})
+    assert cached.status_code == 304
+    assert cached.data == b''
+
+# edge_case - test_versions_are_per_user - Test that another user's writes do not change our version
+def test_versions_are_per_user(client, app):
+    client.post('/api/notes', json={'notes': [{'content': 'a'}]})
+    assert notes_version(2) == 0
+    assert changes_since(2, 0) == (0, [])
+
+# happy_path - test_form_post_and_delete_are_logged - Test that the classic form and /delete-note also record changes
+def test_form_post_and_delete_are_logged(client):
+    response = client.post('/', data={'note': 'from the form'})
+    assert b'data-version="1"' in response.data
+    _, changes = changes_since(1, 0)
+    client.post('/delete-note', data='{"noteId": %d}' % changes[0]['id'])
+    assert changes_since(1, 1)[1][0]['op'] == 'delete'
@@ -0,0 +1,44 @@
+import pytest
+from sqlalchemy import text
+from website import create_app, db
+from website.database import database_uri, engine_options
+
+@pytest.fixture
+def config():
+    return {'SQLITE_PRAGMAS': {'busy_timeout': 2000}, 'DB_POOL_SIZE': 3, 'DB_MAX_OVERFLOW': 7, 'DB_POOL_RECYCLE': 60}
+
+# happy_path - test_database_uri_from_environment - Test that DATABASE_URL overrides the default and old postgres URLs are fixed
+def test_database_uri_from_environment(monkeypatch):
+    monkeypatch.delenv('DATABASE_URL', raising=False)
+    assert database_uri('sqlite:////tmp/notemaster.db') == 'sqlite:////tmp/notemaster.db'
+    monkeypatch.setenv('DATABASE_URL', 'postgres://u:p@db/notes')
+    assert database_uri('sqlite:////tmp/notemaster.db') == 'postgresql://u:p@db/notes'
+
+# happy_path - test_sqlite_file_engine_options - Test that a file database gets a bounded pool and a busy timeout
+def test_sqlite_file_engine_options(config):
+    config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:////tmp/notes.db'
+    options = engine_options(config)
+    assert options['pool_size'] == 3
+    assert options['max_overflow'] == 0
+    assert options['connect_args'] == {'timeout': 2.0}
+
+# happy_path - test_postgres_engine_options - Test that PostgreSQL gets pre-ping, recycling and overflow
+def test_postgres_engine_options(config):
+    config['SQLALCHEMY_DATABASE_URI'] = 'postgresql://u:p@db/notes'
+    config['SQLALCHEMY_ENGINE_OPTIONS'] = {'pool_size': 20}
+    options = engine_options(config)
+    assert options == {'pool_size': 20, 'max_overflow': 7, 'pool_pre_ping': True, 'pool_recycle': 60}
+
+# edge_case - test_memory_engine_options - Test that in-memory databases are left to Flask-SQLAlchemy
+def test_memory_engine_options(config):
+    config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+    assert engine_options(config) == {}
+
+# happy_path - test_sqlite_pragmas_applied - Test that every connection runs in WAL mode with the configured pragmas
+def test_sqlite_pragmas_applied(tmp_path):
+    app = create_app({'TESTING': True, 'SQLALCHEMY_DATABASE_URI': 'sqlite:///{}'.format(tmp_path / 'notes.db')})
+    with app.app_context():
+        with db.engine.connect() as connection:
+            assert connection.execute(text('PRAGMA journal_mode')).scalar() == 'wal'
+            assert connection.execute(text('PRAGMA synchronous')).scalar() == 1
+            assert connection.execute(text('PRAGMA busy_timeout')).scalar() == 5000
@@ -0,0 +1,76 @@
+import json
+import threading
+import pytest
+from website import db
+from website.events import ChangeBroker
+from website.changes import record_changes
+
+@pytest.fixture
+def app_config():
+    return {'SSE_MAX_DURATION': 0}
+
+def events(response):
+    '''(id, event, data) of every event in an SSE body'''
+    parsed = []
+    for block in response.get_data(as_text=True).split('\n\n'):
+        fields = dict(line.split(': ', 1) for line in block.splitlines() if not line.startswith(':'))
+        if 'data' in fields:
+            parsed.append((int(fields['id']), fields['event'], json.loads(fields['data'])))
+    return parsed
+
+# happy_path - test_stream_resumes_from_since - Test that the feed sends the changes after ?since= in seq order
+def test_stream_resumes_from_since(client):
+    ids = [r['id'] for r in client.post('/api/notes', json={'notes': [{'content': 'a'}, {'content': 'b'}]}).json['create']]
+    client.delete('/api/notes', json={'ids': [ids[0]]})
+    response = client.get('/api/notes/events?since=1')
+    assert response.mimetype == 'text/event-stream'
+    assert [(seq, op, change['id']) for seq, op, change in events(response)] == [(2, 'upsert', ids[1]), (3, 'delete', ids[0])]
+
+# happy_path - test_last_event_id_wins - Test that a reconnecting browser resumes after Last-Event-ID
+def test_last_event_id_wins(client):
+    client.post('/api/notes', json={'notes': [{'content': 'a'}, {'content': 'b'}]})
+    response = client.get('/api/notes/events?since=0', headers={'Last-Event-ID': '1'})
+    assert [seq for seq, _, _ in events(response)] == [2]
+
+# edge_case - test_stream_without_since_starts_now - Test that a fresh stream skips existing history
+def test_stream_without_since_starts_now(client):
+    client.post('/api/notes', json={'notes': [{'content': 'a'}]})
+    assert events(client.get('/api/notes/events')) == []
+
+# happy_path - test_commit_wakes_subscribers - Test that committing a note change publishes to that user's streams only
+def test_commit_wakes_subscribers(app, client):
+    broker = app.extensions['change_broker']
+    with broker.subscribe(1) as mine, broker.subscribe(2) as theirs:
+        client.post('/api/notes', json={'notes': [{'content': 'a'}]})
+        assert mine.wait(0)
+        assert not theirs.wait(0)
+    assert broker.stats() == {'users': 0, 'streams': 0, 'open': 0}
+
+# edge_case - test_rollback_publishes_nothing - Test that a rolled back change does not wake anyone
+def test_rollback_publishes_nothing(app):
+    with app.extensions['change_broker'].subscribe(1) as subscription:
+        record_changes(1, [1], 'upsert')
+        db.session.rollback()
+        db.session.commit()
+        assert not subscription.wait(0)
+
+# happy_path - test_publish_from_another_thread - Test that a waiting subscription wakes up as soon as a change is published
+def test_publish_from_another_thread():
+    broker = ChangeBroker()
+    with broker.subscribe(1) as subscription:
+        threading.Timer(0.05, broker.publish, args=(1,)).start()
+        assert subscription.wait(5)
+
+# edge_case - test_streams_are_capped_per_process - Test that streams beyond SSE_MAX_STREAMS get a 503 and closed ones free their slot
+def test_streams_are_capped_per_process(app, client):
+    broker = app.extensions['change_broker']
+    broker.max_streams = 1
+    assert broker.open_stream() # a stream held by another browser
+    refused = client.get('/api/notes/events')
+    assert refused.status_code == 503 and refused.headers['Retry-After'] == '0'
+    broker.close_stream()
+    response = client.get('/api/notes/events')
+    assert response.status_code == 200
+    response.get_data()
+    response.close()
+    assert broker.stats()['open'] == 0
@@ -0,0 +1,72 @@
+import pytest
+from sqlalchemy import event
+from website import db
+
+@pytest.fixture
+def client(login):
+    client = login(1)
+    client.post('/api/notes', json={'notes': [{'content': 'first note'}]})
+    return client
+
+@pytest.fixture
+def queries(app):
+    statements = []
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(db.engine, 'before_cursor_execute', record)
+    yield statements
+    event.remove(db.engine, 'before_cursor_execute', record)
+
+# happy_path - test_home_not_modified - Test that an unchanged notebook answers 304 with a single query
+def test_home_not_modified(client, queries):
+    response = client.get('/')
+    assert response.status_code == 200
+    assert response.headers['ETag'] == '"1-1"'
+    assert 'Last-Modified' in response.headers
+    assert 'private' in response.headers['Cache-Control']
+    del queries[:]
+    cached = client.get('/', headers={'If-None-Match': response.headers['ETag']})
+    assert cached.status_code == 304
+    assert len(queries) == 1
+
+# happy_path - test_home_etag_changes_on_write - Test that adding or deleting a note changes the ETag
+def test_home_etag_changes_on_write(client):
+    etag = client.get('/').headers['ETag']
+    note_id = client.post('/api/notes', json={'notes': [{'content': 'second note'}]}).json['create'][0]['id']
+    response = client.get('/', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert b'second note' in response.data
+    client.delete('/api/notes', json={'ids': [note_id]})
+    assert client.get('/', headers={'If-None-Match': response.headers['ETag']}).status_code == 200
+
+# happy_path - test_fragment_cache_skips_note_query - Test that a second render reuses the cached note list
+def test_fragment_cache_skips_note_query(client, queries):
+    client.get('/')
+    del queries[:]
+    response = client.get('/')
+    assert b'first note' in response.data
+    assert not any('FROM note ' in q and 'note_change' not in q for q in queries)
+
+# edge_case - test_flash_disables_not_modified - Test that a page showing a flash message is not answered with 304
+def test_flash_disables_not_modified(client):
+    etag = client.get('/').headers['ETag']
+    with client.session_transaction() as sess:
+        sess['_flashes'] = [('success', 'Logged In successfully. Welcome Back!')]
+    response = client.get('/', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert b'Welcome Back' in response.data
+    assert 'ETag' not in response.headers
+
+# happy_path - test_api_listing_not_modified - Test that the JSON listing honours If-None-Match too
+def test_api_listing_not_modified(client):
+    response = client.get('/api/notes')
+    assert client.get('/api/notes', headers={'If-None-Match': response.headers['ETag']}).status_code == 304
+
+# edge_case - test_new_asset_build_changes_page - Test that a new asset build changes the page ETag and skips the cached fragment
+def test_new_asset_build_changes_page(app, client):
+    etag = client.get('/').headers['ETag']
+    app.extensions['asset_build'] = '3f2a9c81d0b4' # workers restarted on a new build
+    response = client.get('/', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] == '"1-1-3f2a9c81d0b4"'
+    assert any(key.endswith(':3f2a9c81d0b4') for key in app.extensions['fragment_cache']._data)
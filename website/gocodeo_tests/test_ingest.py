@@ -0,0 +1,143 @@
+import json
+import os
+import pytest
+from website import db
+from website.models import Note, Tag, IngestCheckpoint
+from website.ingest import NoteWriter, write_batch
+from website.changes import notes_version
+
+@pytest.fixture
+def app_config(tmp_path):
+    return {'SQLALCHEMY_DATABASE_URI': 'sqlite:///{}'.format(tmp_path / 'notes.db'),
+            'INGEST_MODE': 'queue', 'INGEST_SPOOL_DIR': str(tmp_path / 'spool'), 'INGEST_MAX_DELAY': 0.2}
+
+@pytest.fixture
+def app(app):
+    yield app
+    app.extensions['note_writer'].stop()
+
+# happy_path - test_api_acknowledges_queued_notes - Test that queued notes get a 202 and are written by the group commit
+def test_api_acknowledges_queued_notes(app, client):
+    response = client.post('/api/notes', json={'notes': [{'content': 'a'}, {'content': ''}, {'content': 'b'}]})
+    assert response.status_code == 202
+    assert [r['status'] for r in response.json['create']] == ['queued', 'error', 'queued']
+    app.extensions['note_writer'].stop()
+    db.session.remove()
+    assert sorted(n.content for n in Note.query.filter_by(user_id=1)) == ['a', 'b']
+    assert notes_version(1) == 2
+
+# happy_path - test_group_commit_checkpoints_spool - Test that a burst is committed together and the spool offset recorded
+def test_group_commit_checkpoints_spool(app):
+    writer = app.extensions['note_writer']
+    for i in range(20):
+        writer.enqueue(1, 'note {}'.format(i))
+    writer.stop()
+    db.session.remove()
+    assert Note.query.count() == 20
+    checkpoint = IngestCheckpoint.query.one()
+    assert checkpoint.offset == os.path.getsize(os.path.join(writer.spool_dir, checkpoint.spool))
+
+# happy_path - test_queued_notes_keep_tags - Test that tags sent with queued notes are set by the group commit
+def test_queued_notes_keep_tags(app, client):
+    client.post('/api/notes', json={'notes': [{'content': 'a', 'tags': ['Later']}, {'content': 'b'}]})
+    app.extensions['note_writer'].stop()
+    db.session.remove()
+    assert {n.content: [t.name for t in n.tags] for n in Note.query} == {'a': ['later'], 'b': []}
+    assert Tag.query.one().note_count == 1
+
+# happy_path - test_form_post_queues_note - Test that the home form also uses the queue
+def test_form_post_queues_note(app, client):
+    response = client.post('/', data={'note': 'from the form'})
+    assert b'It will show up in a moment' in response.data
+    app.extensions['note_writer'].stop()
+    db.session.remove()
+    assert Note.query.one().content == 'from the form'
+
+# edge_case - test_recover_orphaned_spool - Test that an unlocked spool is replayed from its checkpoint only
+def test_recover_orphaned_spool(app):
+    app.extensions['note_writer'].stop() # its own startup recovery must not race this one
+    spool_dir = app.extensions['note_writer'].spool_dir
+    lines = [json.dumps({'user_id': 1, 'content': 'note {}'.format(i), 'date': '2024-01-01T00:00:00'}) + '\n' for i in range(3)]
+    with open(os.path.join(spool_dir, 'spool-1-1.ndjson'), 'w') as spool:
+        spool.write(''.join(lines) + '{"user_id": 1, "cont')  # the last write was torn
+    write_batch([(json.loads(lines[0]), len(lines[0]))], 'spool-1-1.ndjson') # committed before the crash
+    NoteWriter(app).recover()
+    db.session.remove()
+    assert [n.content for n in Note.query.order_by(Note.id)] == ['note 0', 'note 1', 'note 2']
+    assert not os.path.exists(os.path.join(spool_dir, 'spool-1-1.ndjson'))
+    assert db.session.get(IngestCheckpoint, 'spool-1-1.ndjson') is None
+
+# happy_path - test_spool_rotates_under_load - Test that full spools are replaced while notes keep coming and deleted once committed
+def test_spool_rotates_under_load(app):
+    writer = app.extensions['note_writer']
+    writer.rotate_bytes = 300
+    first = writer._spool_name
+    for i in range(40):
+        writer.enqueue(1, 'note {}'.format(i))
+    assert writer._spool_name != first # rotated while its notes were still queued
+    writer.stop()
+    db.session.remove()
+    assert Note.query.count() == 40
+    spools = [name for name in os.listdir(writer.spool_dir) if name.startswith('spool-')]
+    assert spools == [writer._spool_name]
+    assert [c.spool for c in IngestCheckpoint.query] in ([], [writer._spool_name])
+
+# edge_case - test_failing_note_is_dead_lettered - Test that a note that keeps failing goes to the dead-letter file and the rest are written
+def test_failing_note_is_dead_lettered(app, monkeypatch):
+    import website.ingest
+    insert_records = website.ingest._insert_records
+    def fussy(records):
+        if any(record['content'] == 'poison' for record in records):
+            raise ValueError('cannot store this one')
+        insert_records(records)
+    monkeypatch.setattr(website.ingest, '_insert_records', fussy)
+    writer = app.extensions['note_writer']
+    writer.max_retries = 1
+    for content in ('good', 'poison', 'also good'):
+        writer.enqueue(1, content)
+    writer.stop()
+    db.session.remove()
+    assert sorted(n.content for n in Note.query) == ['also good', 'good']
+    with open(writer.dead_letter) as dead_letter:
+        buried = [json.loads(line) for line in dead_letter]
+    assert [(r['content'], r['error'], r['spool']) for r in buried] == [('poison', 'ValueError: cannot store this one', writer._spool_name)]
+    assert IngestCheckpoint.query.one().offset == os.path.getsize(os.path.join(writer.spool_dir, writer._spool_name))
+
+# edge_case - test_outage_holds_batch_until_database_is_back - Test that notes queued during an outage are inserted once it ends, not dead-lettered
+def test_outage_holds_batch_until_database_is_back(app, monkeypatch):
+    import sqlite3
+    import time
+    import website.ingest
+    from sqlalchemy.exc import OperationalError
+    real_write_batch = website.ingest.write_batch
+    outage_ends = time.monotonic() + 1
+    def write_batch(*args):
+        if time.monotonic() < outage_ends:
+            raise OperationalError('INSERT INTO note', {}, sqlite3.OperationalError('database is locked'))
+        real_write_batch(*args)
+    monkeypatch.setattr(website.ingest, 'write_batch', write_batch)
+    writer = app.extensions['note_writer']
+    writer.max_retries = 0
+    for content in ('a', 'b', 'c'):
+        writer.enqueue(1, content)
+    writer.stop()
+    db.session.remove()
+    assert sorted(n.content for n in Note.query) == ['a', 'b', 'c']
+    assert not os.path.exists(writer.dead_letter)
+    assert IngestCheckpoint.query.one().offset == os.path.getsize(os.path.join(writer.spool_dir, writer._spool_name))
+
+# happy_path - test_replay_dead_letter - Test that flask ingest replay inserts dead-lettered notes once and keeps those that fail again
+def test_replay_dead_letter(app):
+    writer = app.extensions['note_writer']
+    records = [{'user_id': 1, 'content': 'lost', 'date': '2024-01-01T00:00:00', 'tags': ['x'], 'error': 'OperationalError: gone', 'spool': 's'},
+               {'user_id': 1, 'content': 'bad', 'date': 'not a date', 'error': 'ValueError', 'spool': 's'}]
+    with open(writer.dead_letter, 'w') as dead_letter:
+        dead_letter.write(''.join(json.dumps(record) + '\n' for record in records))
+    result = app.test_cli_runner().invoke(args=['ingest', 'replay'])
+    assert result.output == '1 notes inserted, 1 failed again\n'
+    assert [(n.content, [t.name for t in n.tags]) for n in Note.query] == [('lost', ['x'])]
+    with open(writer.dead_letter) as dead_letter:
+        assert [json.loads(line)['content'] for line in dead_letter] == ['bad']
+    assert [name for name in os.listdir(writer.spool_dir) if name.endswith('.replay')] == []
+    assert app.test_cli_runner().invoke(args=['ingest', 'replay']).output == '0 notes inserted, 1 failed again\n'
+    assert Note.query.count() == 1
@@ -0,0 +1,155 @@
+import os
+import sqlite3
+import time
+from datetime import timedelta
+import pytest
+from website import create_app, db
+from website.models import NoteChange, MaintenanceRun
+from website.changes import changes_since
+from website.maintenance import run_jobs, run_job, due_jobs, MaintenanceRunner, JOBS
+
+@pytest.fixture
+def app_config(tmp_path):
+    return {'SQLALCHEMY_DATABASE_URI': 'sqlite:///{}'.format(tmp_path / 'notes.db'),
+            'MAINTENANCE_BACKUP_DIR': str(tmp_path / 'backups'), 'MAINTENANCE_BACKUP_KEEP': 2,
+            'MAINTENANCE_LOCK_FILE': str(tmp_path / 'maintenance.lock'), 'RATELIMIT_ENABLED': False}
+
+def pragma(name):
+    return db.session.execute(db.text('PRAGMA {}'.format(name))).scalar()
+
+# happy_path - test_run_jobs_records_every_job - Test that all jobs run and are recorded with their duration
+def test_run_jobs_records_every_job(app, client):
+    client.post('/api/notes', json={'notes': [{'content': 'kept'}]})
+    runs = run_jobs(list(JOBS))
+    assert [run.job for run in runs] == list(JOBS)
+    assert all(run.ok and run.duration > 0 for run in runs), [run.result for run in runs]
+    assert MaintenanceRun.query.count() == len(JOBS)
+    assert due_jobs() == []
+
+# happy_path - test_backup_is_a_usable_copy - Test that the online backup holds the notes and old backups are pruned
+def test_backup_is_a_usable_copy(app, client, tmp_path):
+    client.post('/api/notes', json={'notes': [{'content': 'backed up'}]})
+    run_job('backup', 0)
+    backups = sorted(os.listdir(tmp_path / 'backups'))
+    assert len(backups) == 1 and backups[0].startswith('notes-') and backups[0].endswith('.db')
+    copy = sqlite3.connect(str(tmp_path / 'backups' / backups[0]))
+    assert copy.execute('SELECT content FROM note').fetchall() == [('backed up',)]
+    copy.close()
+    for stamp in ('20000101T000000', '20000102T000000'):
+        (tmp_path / 'backups' / 'notes-{}.db'.format(stamp)).write_bytes(b'')
+    run_job('backup', 0)
+    assert len(os.listdir(tmp_path / 'backups')) == 2 # MAINTENANCE_BACKUP_KEEP
+
+# happy_path - test_vacuum_frees_deleted_pages - Test that pages left by deleted notes are given back to the file system
+def test_vacuum_frees_deleted_pages(app, client):
+    assert pragma('auto_vacuum') == 2 # new databases are created with incremental auto_vacuum
+    ids = [r['id'] for r in client.post('/api/notes', json={'notes': [{'content': 'x' * 900 + str(i)} for i in range(300)]}).json['create']]
+    client.delete('/api/notes', json={'ids': ids})
+    assert pragma('freelist_count') > 0
+    run = run_job('vacuum', 0)
+    assert run.ok and run.result.endswith('pages freed') and not run.result.startswith('0 ')
+    assert pragma('freelist_count') == 0
+
+# edge_case - test_vacuum_switches_old_database - Test that a database made without auto_vacuum is switched over once
+def test_vacuum_switches_old_database(tmp_path):
+    path = tmp_path / 'old.db'
+    old = sqlite3.connect(str(path))
+    old.execute('CREATE TABLE leftover (x)')
+    old.close()
+    app = create_app({'TESTING': True, 'SQLALCHEMY_DATABASE_URI': 'sqlite:///{}'.format(path)})
+    with app.app_context():
+        db.create_all()
+        assert pragma('auto_vacuum') == 0
+        assert run_job('vacuum', 0).result.startswith('switched to incremental')
+        db.engine.dispose()
+        assert pragma('auto_vacuum') == 2
+
+# happy_path - test_purge_compacts_change_log - Test that superseded change entries go and clients see the same changes
+def test_purge_compacts_change_log(app, client):
+    note_id = client.post('/api/notes', json={'notes': [{'content': 'v1'}]}).json['create'][0]['id']
+    for i in range(2, 5):
+        client.patch('/api/notes', json={'notes': [{'id': note_id, 'content': 'v{}'.format(i)}]})
+    before = changes_since(1, 0)
+    assert NoteChange.query.count() == 4
+    assert 'changes 3' in run_job('purge', 0).result
+    assert NoteChange.query.count() == 1
+    assert changes_since(1, 0) == before
+
+# happy_path - test_due_jobs_follow_intervals - Test that jobs are due after their interval and disabled at 0
+def test_due_jobs_follow_intervals(app):
+    app.config['MAINTENANCE_JOBS'] = {'analyze': 60, 'backup': 0}
+    assert due_jobs() == ['analyze']
+    run_job('analyze', 0)
+    assert due_jobs() == []
+    run = MaintenanceRun.query.one()
+    run.started -= timedelta(minutes=2)
+    db.session.commit()
+    assert due_jobs() == ['analyze']
+
+# edge_case - test_failed_job_is_recorded - Test that a failing job is logged as failed without stopping the others
+def test_failed_job_is_recorded(app, monkeypatch):
+    def broken(shard):
+        raise RuntimeError('disk full')
+    monkeypatch.setitem(JOBS, 'analyze', broken)
+    runs = run_jobs(['analyze', 'fts_optimize'])
+    assert [(run.job, run.ok) for run in runs] == [('analyze', False), ('fts_optimize', True)]
+    assert runs[0].result == 'RuntimeError: disk full'
+
+# happy_path - test_only_one_runner_leads - Test that the lock file elects one leader until it goes away
+def test_only_one_runner_leads(app):
+    first, second = MaintenanceRunner(app), MaintenanceRunner(app)
+    assert first.is_leader() and first.is_leader()
+    assert not second.is_leader()
+    first._lock_file.close() # the leader's process exits
+    assert second.is_leader()
+    second._lock_file.close()
+
+# happy_path - test_runner_thread_runs_due_jobs - Test that the leader's thread runs due jobs on its own
+def test_runner_thread_runs_due_jobs(app):
+    app.config.update(MAINTENANCE_TICK=0.05, MAINTENANCE_JOBS={'analyze': 3600, 'fts_optimize': 3600})
+    runner = MaintenanceRunner(app)
+    runner.ensure_started()
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline and MaintenanceRun.query.count() < 2:
+        time.sleep(0.05)
+        db.session.rollback()
+    runner.stop()
+    runner._lock_file.close()
+    assert sorted(run.job for run in MaintenanceRun.query) == ['analyze', 'fts_optimize']
+
+# happy_path - test_cli_run_and_status - Test that the maintenance commands run jobs and report durations
+def test_cli_run_and_status(app):
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=['maintenance', 'run', 'analyze'])
+    assert result.exit_code == 0 and result.output.startswith('analyze shard 0: ')
+    status = runner.invoke(args=['maintenance', 'status'])
+    assert 'analyze shard 0: ' in status.output and ' ms, ok' in status.output
+
+# happy_path - test_jobs_run_on_every_shard - Test that every shard is maintained and runs are recorded in the main database
+def test_jobs_run_on_every_shard(tmp_path):
+    app = create_app({'TESTING': True, 'SQLALCHEMY_DATABASE_URI': 'sqlite:///{}'.format(tmp_path / 'main.db'),
+                      'SHARD_DATABASE_URIS': ['sqlite:///{}'.format(tmp_path / 'shard1.db')],
+                      'MAINTENANCE_BACKUP_DIR': str(tmp_path / 'backups')})
+    with app.app_context():
+        db.session.info['shard'] = 1 # as while serving a user on shard 1
+        runs = run_jobs(['purge', 'backup'])
+        assert [(run.job, run.shard, run.ok) for run in runs] == [('purge', 0, True), ('purge', 1, True),
+                                                                   ('backup', 0, True), ('backup', 1, True)]
+        assert sorted(name.split('-')[0] for name in os.listdir(tmp_path / 'backups')) == ['main', 'shard1']
+        shard_tables = app.extensions['shard_engines'][1].connect().exec_driver_sql("SELECT name FROM sqlite_master WHERE type = 'table'").scalars().all()
+        assert MaintenanceRun.query.count() == 4 and 'maintenance_run' not in shard_tables
+
+# edge_case - test_backup_keeps_shards_with_prefixed_names - Test that pruning one database's backups leaves those of a shard whose name starts the same
+def test_backup_keeps_shards_with_prefixed_names(tmp_path):
+    app = create_app({'TESTING': True, 'SQLALCHEMY_DATABASE_URI': 'sqlite:///{}'.format(tmp_path / 'notes.db'),
+                      'SHARD_DATABASE_URIS': ['sqlite:///{}'.format(tmp_path / 'notes-1.db')],
+                      'MAINTENANCE_BACKUP_DIR': str(tmp_path / 'backups'), 'MAINTENANCE_BACKUP_KEEP': 2})
+    os.makedirs(tmp_path / 'backups')
+    for name in ('notes-20000101T000000.db', 'notes-1-20000101T000000.db', 'notes-1-20000102T000000.db'):
+        (tmp_path / 'backups' / name).write_bytes(b'')
+    with app.app_context():
+        run_jobs(['backup'])
+    backups = sorted(os.listdir(tmp_path / 'backups'))
+    assert [name for name in backups if name.startswith('notes-1-')][:1] == ['notes-1-20000102T000000.db']
+    assert len([name for name in backups if name.startswith('notes-1-')]) == 2
+    assert len([name for name in backups if not name.startswith('notes-1-')]) == 2
@@ -0,0 +1,67 @@
+import pytest
+from website import create_app, db
+from website.models import Note
+from website.metrics import Registry
+
+@pytest.fixture
+def app_config(tmp_path):
+    return {'METRICS_ENABLED': True, 'METRICS_N_PLUS_ONE': 3, 'PROFILE_DIR': str(tmp_path / 'profiles')}
+
+# happy_path - test_registry_renders_histogram - Test that histograms are exported with cumulative buckets
+def test_registry_renders_histogram():
+    registry = Registry()
+    registry.observe('notemaster_request_duration_seconds', (('endpoint', 'views.home'),), 0.003)
+    registry.observe('notemaster_request_duration_seconds', (('endpoint', 'views.home'),), 20.0)
+    text = registry.render()
+    assert '# TYPE notemaster_request_duration_seconds histogram' in text
+    assert 'notemaster_request_duration_seconds_bucket{endpoint="views.home",le="0.005"} 1' in text
+    assert 'notemaster_request_duration_seconds_bucket{endpoint="views.home",le="+Inf"} 2' in text
+    assert 'notemaster_request_duration_seconds_count{endpoint="views.home"} 2' in text
+
+# happy_path - test_request_metrics_exported - Test that route timing, SQL and template metrics show up at /metrics
+def test_request_metrics_exported(client):
+    response = client.get('/')
+    assert 'db;dur=' in response.headers['Server-Timing']
+    text = client.get('/metrics').data.decode()
+    assert 'notemaster_request_duration_seconds_count{endpoint="views.home",method="GET",status="200"} 1' in text
+    assert 'notemaster_request_sql_queries_count{endpoint="views.home"} 1' in text
+    assert 'notemaster_template_render_seconds_count{template="home.html"} 1' in text
+    assert 'notemaster_password_hash_rejected 0' in text
+
+# happy_path - test_n_plus_one_detected - Test that repeating a SELECT in one request is counted
+def test_n_plus_one_detected(app, client):
+    @app.route('/n-plus-one')
+    def n_plus_one():
+        for note_id in range(5):
+            db.session.get(Note, note_id)
+        return 'ok'
+    client.get('/n-plus-one')
+    assert 'notemaster_n_plus_one_total{endpoint="n_plus_one"} 1' in client.get('/metrics').data.decode()
+
+# happy_path - test_sampling_profiler_dumps - Test that sampled requests leave a cProfile dump
+def test_sampling_profiler_dumps(app, client, tmp_path):
+    app.config['PROFILE_SAMPLE_RATE'] = 1.0
+    client.get('/api/notes')
+    assert list((tmp_path / 'profiles').glob('api.list_notes-*.prof'))
+
+# edge_case - test_metrics_token - Test that /metrics requires the bearer token when one is configured
+def test_metrics_token(app, client):
+    app.config['METRICS_TOKEN'] = 'secret'
+    assert client.get('/metrics').status_code == 403
+    assert client.get('/metrics', headers={'Authorization': 'Bearer secret'}).status_code == 200
+
+# edge_case - test_metrics_disabled_by_default - Test that the endpoint does not exist unless enabled
+def test_metrics_disabled_by_default():
+    app = create_app({'TESTING': True, 'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:'})
+    assert app.test_client().get('/metrics').status_code == 404
+
+# edge_case - test_failed_statements_leave_no_state - Test that statements that fail are not remembered on the pooled connection
+def test_failed_statements_leave_no_state(app, client):
+    for _ in range(3):
+        with pytest.raises(Exception):
+            db.session.execute(db.text('SELECT * FROM missing'))
+        db.session.rollback()
+    with db.engine.connect() as connection:
+        assert not connection.info.get('query_start')
+    response = client.get('/')
+    assert response.status_code == 200 and 'db;dur=' in response.headers['Server-Timing']
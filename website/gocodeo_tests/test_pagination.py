@@ -0,0 +1,87 @@
+import pytest
+from datetime import datetime, timedelta
+from website import db
+from website.models import Note
+from website.pagination import notes_page, encode_cursor, decode_cursor
+
+@pytest.fixture
+def app_config():
+    return {'NOTES_PAGE_SIZE': 3}
+
+@pytest.fixture
+def app(app):
+    start = datetime(2024, 1, 1)
+    # two notes share a timestamp so the id tie-breaker is exercised
+    for i in range(7):
+        db.session.add(Note(content='note {}'.format(i), user_id=1, date=start + timedelta(minutes=min(i, 5))))
+    db.session.commit()
+    return app
+
+# happy_path - test_notes_page_first_page - Test that the first page holds the newest notes
+def test_notes_page_first_page(app):
+    notes, next_cursor = notes_page(1, limit=3)
+    assert [n.content for n in notes] == ['note 6', 'note 5', 'note 4']
+    assert next_cursor == encode_cursor(notes[-1])
+    assert decode_cursor(next_cursor) == (notes[-1].date, notes[-1].id)
+
+# happy_path - test_notes_page_walks_all_notes - Test that following cursors visits every note exactly once
+def test_notes_page_walks_all_notes(app):
+    seen, after = [], None
+    while True:
+        notes, cursor = notes_page(1, after=after, limit=2)
+        seen.extend(n.content for n in notes)
+        if cursor is None:
+            break
+        after = decode_cursor(cursor)
+    assert seen == ['note {}'.format(i) for i in range(6, -1, -1)]
+
+# edge_case - test_notes_page_other_user - Test that another user's notes are never returned
+def test_notes_page_other_user(app):
+    notes, next_cursor = notes_page(2)
+    assert notes == []
+    assert next_cursor is None
+
+# happy_path - test_api_list_notes - Test that the JSON endpoint returns a page and a cursor
+def test_api_list_notes(client):
+    response = client.get('/api/notes?limit=2')
+    assert response.status_code == 200
+    assert [n['content'] for n in response.json['notes']] == ['note 6', 'note 5']
+    following = client.get('/api/notes?limit=2&after={}'.format(response.json['next']))
+    assert [n['content'] for n in following.json['notes']] == ['note 4', 'note 3']
+
+# happy_path - test_home_renders_one_page - Test that the home page only renders one page of notes
+def test_home_renders_one_page(client):
+    response = client.get('/')
+    assert response.status_code == 200
+    assert b'note 6' in response.data
+    assert b'note 3' not in response.data
+    assert b'Older notes' in response.data
+
+# edge_case - test_deleted_cursor_note_keeps_paging - Test that the next page still comes when the cursor's note is deleted
+@pytest.mark.parametrize('tag', [None, 'x'])
+def test_deleted_cursor_note_keeps_paging(client, tag):
+    if tag:
+        client.patch('/api/notes', json={'notes': [{'id': i, 'tags': [tag]} for i in range(1, 8)]})
+    query = '/api/notes?limit=2' + ('&tag=' + tag if tag else '')
+    first = client.get(query).json
+    client.delete('/api/notes', json={'ids': [first['notes'][-1]['id']]})
+    following = client.get(query + '&after=' + first['next'])
+    assert [n['content'] for n in following.json['notes']] == ['note 4', 'note 3']
+
+# edge_case - test_cursor_formats - Test that a bare id from an older client still pages and garbage is refused
+def test_cursor_formats(client):
+    assert [n['content'] for n in client.get('/api/notes?limit=2&after=6').json['notes']] == ['note 4', 'note 3']
+    assert client.get('/api/notes?after=not-a-cursor').status_code == 400
+
+# edge_case - test_deleted_cursor_note_with_server_dates - Test that notes dated by the database within one second page once each after the cursor's note is deleted
+def test_deleted_cursor_note_with_server_dates(login):
+    client = login(2)
+    client.post('/api/notes', json={'notes': [{'content': 'n{}'.format(i)} for i in range(6)]})
+    first = client.get('/api/notes?limit=2').json
+    assert [n['content'] for n in first['notes']] == ['n5', 'n4']
+    client.delete('/api/notes', json={'ids': [first['notes'][-1]['id']]})
+    following = client.get('/api/notes?limit=2&after=' + first['next'])
+    assert [n['content'] for n in following.json['notes']] == ['n3', 'n2']
+    second = client.get('/api/notes?limit=10').json['notes'][-1]['date'][:19] # stored without a fraction
+    assert client.get('/api/notes?to=' + second).json['notes'] == []
+    assert len(client.get('/api/notes?limit=10&from=' + second).json['notes']) == 5
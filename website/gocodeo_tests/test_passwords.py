@@ -0,0 +1,77 @@
+import time
+import pytest
+from werkzeug.security import generate_password_hash
+from website import db
+from website.models import User
+from website.passwords import PasswordHasher, HashingBusy
+
+FAST = 'pbkdf2:sha256:2000'
+
+@pytest.fixture
+def app_config():
+    return {'PASSWORD_HASH_METHOD': FAST, 'PASSWORD_HASH_WORKERS': 0}
+
+@pytest.fixture
+def app(app):
+    db.session.get(User, 1).password = generate_password_hash('correct_password', method='pbkdf2:sha256:1000')
+    db.session.commit()
+    return app
+
+# happy_path - test_hash_and_verify_inline - Test that a fresh hash verifies and needs no upgrade
+def test_hash_and_verify_inline():
+    hasher = PasswordHasher(method=FAST, workers=0)
+    stored = hasher.hash('secret123')
+    assert stored.startswith(FAST + '$')
+    assert hasher.verify(stored, 'secret123') == (True, None)
+    assert hasher.verify(stored, 'wrong') == (False, None)
+    assert hasher.stats()['hashes'] == 1
+    assert hasher.stats()['verifications'] == 2
+
+# happy_path - test_verify_in_process_pool - Test that hashing also works through the process pool
+def test_verify_in_process_pool():
+    hasher = PasswordHasher(method=FAST, workers=1)
+    assert hasher.verify(hasher.hash('secret123'), 'secret123') == (True, None)
+    assert hasher._executor._mp_context.get_start_method() == 'forkserver' # never forks the threaded app
+
+# happy_path - test_outdated_hash_is_upgraded - Test that a hash with an older cost comes back with a replacement
+def test_outdated_hash_is_upgraded():
+    hasher = PasswordHasher(method=FAST, workers=0)
+    ok, new_hash = hasher.verify(generate_password_hash('secret123', method='pbkdf2:sha256:1000'), 'secret123')
+    assert ok
+    assert new_hash.startswith(FAST + '$')
+    assert hasher.stats()['rehashes'] == 1
+
+# edge_case - test_full_queue_rejects - Test that hashing is refused instead of queued once the queue is full
+def test_full_queue_rejects():
+    hasher = PasswordHasher(method=FAST, workers=0, queue_size=1)
+    hasher._slots.acquire()
+    with pytest.raises(HashingBusy):
+        hasher.hash('secret123')
+    assert hasher.stats()['rejected'] == 1
+
+# happy_path - test_login_rehashes_password - Test that logging in stores the hash with the configured method
+def test_login_rehashes_password(app):
+    response = app.test_client().post('/login', data={'email': 'test@example.com', 'password': 'correct_password'})
+    assert response.status_code == 302
+    assert db.session.get(User, 1).password.startswith(FAST + '$')
+
+# edge_case - test_login_busy - Test that a saturated hasher answers 503 without checking the password
+def test_login_busy(app):
+    app.extensions['password_hasher'] = PasswordHasher(method=FAST, workers=0, queue_size=1)
+    app.extensions['password_hasher']._slots.acquire()
+    response = app.test_client().post('/login', data={'email': 'test@example.com', 'password': 'correct_password'})
+    assert response.status_code == 503
+
+# edge_case - test_timeout_is_busy_and_keeps_slot - Test that a slow hash answers HashingBusy and holds its slot until it ends
+def test_timeout_is_busy_and_keeps_slot():
+    hasher = PasswordHasher(method=FAST, workers=1, queue_size=1)
+    hasher.hash('warm up') # start the pool process
+    hasher.timeout = 0.05
+    with pytest.raises(HashingBusy):
+        hasher._run(time.sleep, 0.5)
+    assert hasher.stats()['timeouts'] == 1
+    with pytest.raises(HashingBusy): # the slow job still runs
+        hasher.hash('secret123')
+    time.sleep(1)
+    hasher.timeout = 10
+    assert hasher.verify(hasher.hash('secret123'), 'secret123') == (True, None)
@@ -0,0 +1,79 @@
+import pytest
+from unittest.mock import patch
+from website import create_app, db
+from website.ratelimit import MemoryStore
+
+@pytest.fixture
+def app_config():
+    return {'PASSWORD_HASH_WORKERS': 0, 'RATELIMIT_LOGIN_IP': (3, 60), 'RATELIMIT_LOGIN_EMAIL': (2, 60), 'RATELIMIT_WRITE_USER': (2, 60)}
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+    def __call__(self):
+        return self.now
+
+# happy_path - test_token_bucket_refills - Test that a bucket allows a burst, then one hit per refill interval
+def test_token_bucket_refills():
+    clock = Clock()
+    store = MemoryStore(clock=clock)
+    assert [store.hit('k', 2, 10) for _ in range(3)] == [0, 0, 5.0]
+    clock.now = 5.0
+    assert store.hit('k', 2, 10) == 0
+    assert store.hit('k', 2, 10) == 5.0
+    assert store.hit('other', 2, 10) == 0
+
+# edge_case - test_memory_store_is_bounded - Test that the least recently used keys are evicted
+def test_memory_store_is_bounded():
+    store = MemoryStore(maxsize=2)
+    for key in ('a', 'b', 'c'):
+        store.hit(key, 1, 60)
+    assert list(store._buckets) == ['b', 'c']
+
+# happy_path - test_login_limited_per_email_before_query - Test that attempts on one account are rejected without a query
+def test_login_limited_per_email_before_query(client):
+    for _ in range(2):
+        client.post('/login', data={'email': 'Test@example.com', 'password': 'wrong'})
+    with patch('website.auth.User') as user_model:
+        response = client.post('/login', data={'email': 'test@example.com ', 'password': 'wrong'})
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '30'
+    assert b'Too many attempts' in response.data
+    user_model.query.filter_by.assert_not_called()
+
+# happy_path - test_login_limited_per_ip - Test that many emails from one address hit the per-IP limit
+def test_login_limited_per_ip(client):
+    statuses = [client.post('/login', data={'email': 'user{}@example.com'.format(i), 'password': 'x'}).status_code for i in range(4)]
+    assert statuses == [200, 200, 200, 429]
+    assert client.get('/login').status_code == 200 # only attempts are counted
+
+# happy_path - test_api_writes_limited_per_user - Test that note writes get a JSON 429 once the user's budget is spent
+def test_api_writes_limited_per_user(client):
+    with client.session_transaction() as sess:
+        sess['_user_id'] = '1'
+    statuses = [client.post('/api/notes', json={'notes': [{'content': 'a'}]}).status_code for _ in range(3)]
+    assert statuses == [200, 200, 429]
+    assert client.delete('/api/notes', json={'ids': [1]}).json == {'error': 'Too many requests.'}
+    assert client.get('/api/notes').status_code == 200
+
+# edge_case - test_rate_limit_disabled - Test that RATELIMIT_ENABLED turns every limit off
+def test_rate_limit_disabled(app, client):
+    app.config['RATELIMIT_ENABLED'] = False
+    statuses = {client.post('/login', data={'email': 'test@example.com', 'password': 'x'}).status_code for _ in range(5)}
+    assert statuses == {200}
+
+# happy_path - test_proxy_fix_hops_limits_client_addresses - Test that behind a trusted proxy the per-IP limit counts each client
+def test_proxy_fix_hops_limits_client_addresses():
+    app = create_app({'TESTING': True, 'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:', 'PASSWORD_HASH_WORKERS': 0,
+                      'RATELIMIT_LOGIN_IP': (1, 60), 'PROXY_FIX_HOPS': 1})
+    with app.app_context():
+        db.create_all()
+        client = app.test_client()
+        def login(address):
+            return client.post('/login', data={'email': '{}@example.com'.format(address), 'password': 'x'},
+                               headers={'X-Forwarded-For': address}).status_code
+        assert [login('10.0.0.1'), login('10.0.0.2'), login('10.0.0.1')] == [200, 200, 429]
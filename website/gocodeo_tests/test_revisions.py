@@ -0,0 +1,89 @@
+import pytest
+from website import db
+from website.models import Note, NoteRevision
+from website.revisions import make_delta, apply_delta, materialize, purge_orphan_revisions
+
+@pytest.fixture
+def app_config():
+    return {'REVISION_SNAPSHOT_EVERY': 4}
+
+def edit(client, note_id, content):
+    return client.patch('/api/notes', json={'notes': [{'id': note_id, 'content': content}]})
+
+# happy_path - test_delta_round_trip - Test that applying a delta to the old text gives the new text
+@pytest.mark.parametrize('old,new', [('buy milk', 'buy oat milk'), ('abc', ''), ('', 'abc'),
+                                     ('line\n' * 400 + 'end', 'line\n' * 200 + 'middle\n' + 'line\n' * 200 + 'end')])
+def test_delta_round_trip(old, new):
+    assert apply_delta(old, make_delta(old, new)) == new
+
+# happy_path - test_edits_are_stored_as_deltas_with_snapshots - Test the snapshot/delta layout and materializing every revision
+def test_edits_are_stored_as_deltas_with_snapshots(client):
+    note_id = client.post('/api/notes', json={'notes': [{'content': 'version 0 of a fairly long note'}]}).json['create'][0]['id']
+    assert client.get('/api/notes/{}/revisions'.format(note_id)).json['revisions'] == []
+    for i in range(1, 7):
+        edit(client, note_id, 'version {} of a fairly long note'.format(i))
+    revisions = client.get('/api/notes/{}/revisions'.format(note_id)).json['revisions']
+    assert [r['number'] for r in revisions] == [7, 6, 5, 4, 3, 2, 1]
+    assert [r['kind'] for r in revisions] == ['delta', 'delta', 'snapshot', 'delta', 'delta', 'delta', 'snapshot']
+    for number in range(1, 8):
+        response = client.get('/api/notes/{}/revisions/{}'.format(note_id, number))
+        assert response.json['content'] == 'version {} of a fairly long note'.format(number - 1)
+
+# edge_case - test_unchanged_edit_adds_no_revision - Test that saving the same text records nothing
+def test_unchanged_edit_adds_no_revision(client):
+    note_id = client.post('/api/notes', json={'notes': [{'content': 'same'}]}).json['create'][0]['id']
+    edit(client, note_id, 'same')
+    assert NoteRevision.query.count() == 0
+
+# happy_path - test_long_note_history - Test that revisions of blob-backed notes hold the full text
+def test_long_note_history(client):
+    original = 'paragraph\n' * 300
+    note_id = client.post('/api/notes', json={'notes': [{'content': original}]}).json['create'][0]['id']
+    edit(client, note_id, original + 'one more line\n')
+    assert materialize(note_id, 1)[0] == original
+    assert materialize(note_id, 2)[0] == original + 'one more line\n'
+    assert db.session.get(NoteRevision, 2).kind == 'delta'
+
+# edge_case - test_revisions_of_other_users_note - Test that another user's history is not found
+def test_revisions_of_other_users_note(app, client):
+    db.session.add(Note(content='private', user_id=2))
+    db.session.commit()
+    assert client.get('/api/notes/1/revisions').status_code == 404
+    assert client.get('/api/notes/1/revisions/1').status_code == 404
+
+# edge_case - test_missing_revision - Test that a revision number past the history is not found
+def test_missing_revision(client):
+    note_id = client.post('/api/notes', json={'notes': [{'content': 'a'}]}).json['create'][0]['id']
+    edit(client, note_id, 'b')
+    assert client.get('/api/notes/{}/revisions/3'.format(note_id)).status_code == 404
+
+# happy_path - test_purge_orphan_revisions - Test that history left behind by deleted notes is purged
+def test_purge_orphan_revisions(client):
+    ids = [r['id'] for r in client.post('/api/notes', json={'notes': [{'content': 'a'}, {'content': 'b'}]}).json['create']]
+    for note_id in ids:
+        edit(client, note_id, 'edited')
+    db.session.add(NoteRevision(note_id=999, number=1, kind='snapshot', codec='zlib', data=b'')) # written before deletes dropped it
+    db.session.commit()
+    assert purge_orphan_revisions() == 1
+    assert {r.note_id for r in NoteRevision.query} == set(ids)
+
+# edge_case - test_deleted_note_history_is_not_inherited - Test that a note given a deleted note's id starts without history
+@pytest.mark.parametrize('delete', ['api', 'form'])
+def test_deleted_note_history_is_not_inherited(client, delete):
+    note_id = client.post('/api/notes', json={'notes': [{'content': 'A secret password is hunter2'}]}).json['create'][0]['id']
+    edit(client, note_id, 'nothing to see')
+    if delete == 'api':
+        client.delete('/api/notes', json={'ids': [note_id]})
+    else:
+        client.post('/delete-note', json={'noteId': note_id})
+    assert NoteRevision.query.count() == 0
+    # databases created before Note used AUTOINCREMENT hand the id out again
+    db.session.add(Note(id=note_id, content='new note', user_id=2))
+    db.session.commit()
+    assert materialize(note_id, 1) is None
+
+# happy_path - test_note_ids_are_not_reused - Test that new notes never get the id of a deleted one
+def test_note_ids_are_not_reused(client):
+    note_id = client.post('/api/notes', json={'notes': [{'content': 'a'}]}).json['create'][0]['id']
+    client.delete('/api/notes', json={'ids': [note_id]})
+    assert client.post('/api/notes', json={'notes': [{'content': 'b'}]}).json['create'][0]['id'] == note_id + 1
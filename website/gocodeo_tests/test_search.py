@@ -0,0 +1,78 @@
+import pytest
+from website import db, upgrade_database
+from website.models import Note
+from website.search import match_query, search_notes
+
+@pytest.fixture
+def app(app):
+    upgrade_database(app)
+    db.session.add_all([Note(content='Buy milk and <b>bread</b>', user_id=1),
+                        Note(content='Call the plumber about the kitchen', user_id=1),
+                        Note(content='Buy a kitchen table', user_id=1),
+                        Note(content='Buy milk for the neighbour', user_id=2)])
+    db.session.commit()
+    return app
+
+# happy_path - test_match_query_quotes_terms - Test that user input is quoted so FTS syntax cannot break the query
+def test_match_query_quotes_terms():
+    assert match_query('say "hi" OR') == '"say" """hi""" "OR"*'
+    assert match_query('   ') == ''
+
+# happy_path - test_search_only_own_notes - Test that search matches words and only returns the user's notes
+def test_search_only_own_notes(app):
+    results, next_offset = search_notes(1, 'milk')
+    assert len(results) == 1
+    assert next_offset is None
+    assert '<mark>milk</mark>' in results[0]['snippet']
+    assert '&lt;b&gt;' in results[0]['snippet']
+
+# happy_path - test_search_prefix_and_stemming - Test that the last word is prefix matched
+def test_search_prefix_and_stemming(app):
+    results, _ = search_notes(1, 'kitch')
+    assert len(results) == 2
+
+# happy_path - test_index_follows_updates_and_deletes - Test that the triggers keep the index in sync
+def test_index_follows_updates_and_deletes(app):
+    note = Note.query.filter_by(content='Buy a kitchen table').first()
+    note.content = 'Buy a desk'
+    db.session.commit()
+    assert len(search_notes(1, 'kitchen')[0]) == 1
+    db.session.delete(note)
+    db.session.commit()
+    assert search_notes(1, 'desk')[0] == []
+
+# happy_path - test_search_endpoint_pagination - Test that the endpoint pages through ranked results
+def test_search_endpoint_pagination(client):
+    first = client.get('/api/notes/search?q=buy&limit=1').json
+    assert len(first['results']) == 1
+    second = client.get('/api/notes/search?q=buy&limit=1&offset={}'.format(first['next'])).json
+    assert len(second['results']) == 1
+    assert second['next'] is None
+    assert first['results'][0]['id'] != second['results'][0]['id']
+
+# happy_path - test_long_notes_are_searched_in_full - Test that words past the stored preview of a long note are found
+def test_long_notes_are_searched_in_full(client):
+    content = 'filler ' * 300 + 'zanzibar at the very end'
+    note_id = client.post('/api/notes', json={'notes': [{'content': content}]}).json['create'][0]['id']
+    results, _ = search_notes(1, 'zanzibar')
+    assert [r['id'] for r in results] == [note_id]
+    assert '<mark>zanzibar</mark>' in results[0]['snippet']
+    client.patch('/api/notes', json={'notes': [{'id': note_id, 'content': 'filler ' * 300 + 'timbuktu instead'}]})
+    assert search_notes(1, 'zanzibar')[0] == []
+    assert [r['id'] for r in search_notes(1, 'timbuktu')[0]] == [note_id]
+    client.delete('/api/notes', json={'ids': [note_id]})
+    assert search_notes(1, 'timbuktu')[0] == []
+
+# edge_case - test_preview_index_is_rebuilt - Test that an index of note.content left by an older version is rebuilt over the full text
+def test_preview_index_is_rebuilt(app, client):
+    client.post('/api/notes', json={'notes': [{'content': 'filler ' * 300 + 'zanzibar'}]})
+    for trigger in ('note_fts_ai', 'note_fts_ad', 'note_fts_au'):
+        db.session.execute(db.text('DROP TRIGGER {}'.format(trigger)))
+    db.session.execute(db.text('DROP TABLE note_fts'))
+    db.session.execute(db.text("CREATE VIRTUAL TABLE note_fts USING fts5(content, content='note', content_rowid='id')"))
+    db.session.execute(db.text("INSERT INTO note_fts(note_fts) VALUES ('rebuild')"))
+    db.session.commit()
+    assert search_notes(1, 'zanzibar')[0] == []
+    upgrade_database(app)
+    assert len(search_notes(1, 'zanzibar')[0]) == 1
+    assert len(search_notes(1, 'milk')[0]) == 1
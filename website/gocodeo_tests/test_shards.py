@@ -0,0 +1,112 @@
+import pytest
+from website import create_app, db
+from website.models import User, Note, NoteBlob, NoteChange, Tag, NoteTag
+from website.shards import using_shard, choose_shard, move_user, rebalance, shard_loads
+from website.ingest import write_batch
+
+@pytest.fixture
+def app(tmp_path, app_config):
+    app = create_app(dict({'TESTING': True, 'SQLALCHEMY_DATABASE_URI': 'sqlite:///{}'.format(tmp_path / 'main.db'),
+                           'SHARD_DATABASE_URIS': ['sqlite:///{}'.format(tmp_path / 'shard1.db'),
+                                                   'sqlite:///{}'.format(tmp_path / 'shard2.db')],
+                           'PASSWORD_HASH_WORKERS': 0}, **app_config))
+    with app.app_context():
+        db.session.add_all([User(email='a@example.com', first_name='Ann', password='x', shard=0),
+                            User(email='b@example.com', first_name='Bob', password='x', shard=1)])
+        db.session.commit()
+    return app # requests get their own app context, so each one loads its own user
+
+def count(app, model, shard, **filters):
+    with app.app_context(), using_shard(shard):
+        return model.query.filter_by(**filters).count()
+
+def call(app, func, *args, **kwargs):
+    with app.app_context():
+        return func(*args, **kwargs)
+
+# happy_path - test_notes_are_written_to_the_users_shard - Test that each user's notes land on, and are read from, their shard
+def test_notes_are_written_to_the_users_shard(app, login):
+    login(1).post('/api/notes', json={'notes': [{'content': 'ann'}]})
+    bob = login(2)
+    bob.post('/api/notes', json={'notes': [{'content': 'bob'}, {'content': 'b' * 2000}]})
+    assert (count(app, Note, 0), count(app, Note, 1), count(app, Note, 2)) == (1, 2, 0)
+    assert count(app, NoteBlob, 1) == 1
+    assert [n['content'] for n in bob.get('/api/notes').json['notes']] == ['b' * 280, 'bob']
+    assert bob.get('/api/notes/search?q=bob').json['results'][0]['id'] == 1
+
+# happy_path - test_signup_picks_emptiest_shard - Test that new users go to the shard with the fewest users
+def test_signup_picks_emptiest_shard(app):
+    assert call(app, choose_shard) == 2
+    app.config['RATELIMIT_ENABLED'] = False
+    app.test_client().post('/signup', data={'email': 'new@example.com', 'firstName': 'Neo',
+                                            'password1': 'password1', 'password2': 'password1'})
+    with app.app_context():
+        assert User.query.filter_by(email='new@example.com').one().shard == 2
+
+# happy_path - test_move_user_keeps_notes_history_and_version - Test that a moved user's data follows them with a higher version
+def test_move_user_keeps_notes_history_and_version(app, login):
+    client = login(1)
+    ids = [r['id'] for r in client.post('/api/notes', json={'notes': [{'content': 'one'}, {'content': 'x' * 3000}]}).json['create']]
+    client.patch('/api/notes', json={'notes': [{'id': ids[0], 'content': 'one, edited'}]})
+    version = client.get('/api/notes/changes').json['version']
+    assert call(app, move_user, 1, 2) == 2
+    assert call(app, lambda: db.session.get(User, 1).shard) == 2
+    assert (count(app, Note, 0), count(app, Note, 2), count(app, NoteBlob, 0), count(app, NoteBlob, 2)) == (0, 2, 0, 1)
+    client = login(1)
+    changes = client.get('/api/notes/changes?since={}'.format(version)).json['changes']
+    notes = {n['content']: n['id'] for n in client.get('/api/notes').json['notes']}
+    assert sorted(c['id'] for c in changes if c['op'] == 'upsert') == sorted(notes.values())
+    assert all(c['seq'] > version for c in changes)
+    assert client.get('/api/notes/{}'.format(notes['one, edited'])).json['content'] == 'one, edited'
+    assert client.get('/api/notes/{}/revisions/1'.format(notes['one, edited'])).json['content'] == 'one'
+
+# edge_case - test_move_to_unknown_shard - Test that moving to a shard that does not exist is refused
+def test_move_to_unknown_shard(app):
+    with pytest.raises(ValueError):
+        call(app, move_user, 1, 3)
+
+# happy_path - test_rebalance_evens_out_shards - Test that rebalance moves users off the fullest shard
+def test_rebalance_evens_out_shards(app, login):
+    with app.app_context():
+        db.session.add(User(email='c@example.com', first_name='Cy', password='x', shard=1))
+        db.session.commit()
+    login(2).post('/api/notes', json={'notes': [{'content': str(i)} for i in range(6)]})
+    login(3).post('/api/notes', json={'notes': [{'content': str(i)} for i in range(4)]})
+    assert call(app, rebalance, dry_run=True) == [(3, 1, 0, 4)]
+    assert count(app, Note, 1) == 10
+    call(app, rebalance)
+    loads = call(app, shard_loads)
+    assert {shard: sum(users.values()) for shard, users in loads.items()} == {0: 4, 1: 6, 2: 0}
+
+# happy_path - test_write_batch_routes_by_shard - Test that write-behind batches are split and checkpointed per shard
+def test_write_batch_routes_by_shard(app):
+    entries = [({'user_id': 1, 'content': 'a', 'date': '2024-01-01T00:00:00'}, 10),
+               ({'user_id': 2, 'content': 'b', 'date': '2024-01-01T00:00:00'}, 20)]
+    call(app, write_batch, entries, 'spool-1-1.ndjson')
+    call(app, write_batch, entries, 'spool-1-1.ndjson') # replayed after a crash
+    assert (count(app, Note, 0, user_id=1), count(app, Note, 1, user_id=2)) == (1, 1)
+    assert count(app, NoteChange, 1) == 1
+
+# happy_path - test_move_user_keeps_tags - Test that tags and their counters follow a moved user
+def test_move_user_keeps_tags(app, login):
+    login(1).post('/api/notes', json={'notes': [{'content': 'a', 'tags': ['x', 'y']}, {'content': 'b', 'tags': ['x']}]})
+    call(app, move_user, 1, 2)
+    assert (count(app, Tag, 0), count(app, NoteTag, 0), count(app, NoteTag, 2)) == (0, 0, 3)
+    client = login(1)
+    assert client.get('/api/tags').json['tags'] == [{'name': 'x', 'count': 2}, {'name': 'y', 'count': 1}]
+    assert [n['content'] for n in client.get('/api/notes?tag=x').json['notes']] == ['b', 'a']
+
+# edge_case - test_shards_have_no_directory_foreign_keys - Test that notes go in on a shard enforcing foreign keys, whose user table is elsewhere
+@pytest.mark.parametrize('app_config', [{'SQLITE_PRAGMAS': {'foreign_keys': 'ON', 'journal_mode': 'WAL'}, 'RATELIMIT_ENABLED': False}])
+def test_shards_have_no_directory_foreign_keys(app, login):
+    with app.extensions['shard_engines'][1].connect() as connection:
+        assert connection.exec_driver_sql('PRAGMA foreign_keys').scalar() == 1
+        tables = connection.exec_driver_sql("SELECT name FROM sqlite_master WHERE type = 'table'").scalars().all()
+        assert 'user' not in tables and 'note' in tables
+    client = login(2) # Bob, on shard 1
+    response = client.post('/api/notes', json={'notes': [{'content': 'kept', 'tags': ['x']}, {'content': 'y' * 2000}]})
+    assert [r['status'] for r in response.json['create']] == ['created', 'created']
+    client.patch('/api/notes', json={'notes': [{'id': 1, 'content': 'kept, edited'}]})
+    client.delete('/api/notes', json={'ids': [2]})
+    assert [n['content'] for n in client.get('/api/notes').json['notes']] == ['kept, edited']
+    assert count(app, NoteTag, 1) == 1
@@ -0,0 +1,70 @@
+import json
+import sqlite3
+from website import create_app, db, upgrade_database
+from website.models import Note, NoteBlob, INLINE_LENGTH, MAX_NOTE_LENGTH
+from website.storage import split_content, purge_orphan_blobs, full_content, PREVIEW_LENGTH
+
+# happy_path - test_split_content_short_note_stays_inline - Test that short notes are stored as they are
+def test_split_content_short_note_stays_inline():
+    values, blob = split_content('x' * INLINE_LENGTH)
+    assert values == {'content': 'x' * INLINE_LENGTH, 'blob_hash': None}
+    assert blob is None
+
+# happy_path - test_split_content_long_note_gets_preview_and_blob - Test that long notes keep a preview and a compressed blob
+def test_split_content_long_note_gets_preview_and_blob():
+    values, blob = split_content('abc ' * 1000)
+    assert values['content'] == ('abc ' * 1000)[:PREVIEW_LENGTH]
+    assert values['blob_hash'] == blob['hash']
+    assert blob['size'] == 4000
+    assert len(blob['data']) < 200
+
+# happy_path - test_long_notes_are_deduplicated - Test that identical long notes share one blob and read back in full
+def test_long_notes_are_deduplicated(client):
+    content = 'same text ' * 500
+    response = client.post('/api/notes', json={'notes': [{'content': content}, {'content': content}]})
+    ids = [r['id'] for r in response.json['create']]
+    assert NoteBlob.query.count() == 1
+    listed = client.get('/api/notes').json['notes']
+    assert all(note['truncated'] and len(note['content']) == PREVIEW_LENGTH for note in listed)
+    assert client.get('/api/notes/{}'.format(ids[0])).json['content'] == content
+    assert full_content(db.session.get(Note, ids[1])) == content
+
+# edge_case - test_get_note_of_other_user - Test that another user's note is not found
+def test_get_note_of_other_user(app, client):
+    db.session.add(Note(content='private', user_id=2))
+    db.session.commit()
+    assert client.get('/api/notes/1').status_code == 404
+
+# happy_path - test_export_includes_full_content - Test that exports carry the whole text of long notes
+def test_export_includes_full_content(client):
+    content = 'long note ' * 300
+    client.post('/api/notes', json={'notes': [{'content': content}, {'content': 'short'}]})
+    lines = client.get('/api/notes/export').get_data(as_text=True).splitlines()
+    assert sorted(json.loads(line)['content'] for line in lines) == sorted([content, 'short'])
+
+# happy_path - test_purge_orphan_blobs - Test that blobs are removed once no note points to them
+def test_purge_orphan_blobs(client):
+    ids = [r['id'] for r in client.post('/api/notes', json={'notes': [{'content': 'a' * 2000}, {'content': 'b' * 2000}]}).json['create']]
+    client.patch('/api/notes', json={'notes': [{'id': ids[0], 'content': 'short now'}]})
+    assert purge_orphan_blobs() == 1
+    assert [blob.hash for blob in NoteBlob.query] == [db.session.get(Note, ids[1]).blob_hash]
+
+# edge_case - test_upgrade_adds_blob_hash_column - Test that an existing database gains the new column on startup
+def test_upgrade_adds_blob_hash_column(tmp_path):
+    path = tmp_path / 'old.db'
+    connection = sqlite3.connect(str(path))
+    connection.execute('CREATE TABLE note (id INTEGER PRIMARY KEY, content VARCHAR(1000), date DATETIME, user_id INTEGER)')
+    connection.execute("INSERT INTO note (content, user_id) VALUES ('old', 1)")
+    connection.commit()
+    connection.close()
+    app = create_app({'TESTING': True, 'SQLALCHEMY_DATABASE_URI': 'sqlite:///{}'.format(path)})
+    upgrade_database(app)
+    with app.app_context():
+        note = Note.query.one()
+        assert (note.content, note.blob_hash) == ('old', None)
+
+# edge_case - test_form_post_checks_note_length - Test that the home form refuses notes the API refuses
+def test_form_post_checks_note_length(client):
+    assert b'Note must be at most' in client.post('/', data={'note': 'x' * (MAX_NOTE_LENGTH + 1)}).data
+    assert b'Note is empty.' in client.post('/', data={}).data
+    assert Note.query.count() == 0
@@ -0,0 +1,121 @@
+from datetime import datetime
+from sqlalchemy import text
+from website import db
+from website.models import Note, Tag, NoteTag, tag_names, tags_error, MAX_TAGS_PER_NOTE
+from website.tags import user_tags, recount_tags, purge_unused_tags, set_note_tags, find_tag
+from website.pagination import notes_page
+
+def counts():
+    return {tag.name: tag.note_count for tag in Tag.query.filter_by(user_id=1)}
+
+# happy_path - test_tag_names_are_normalized - Test that tag names are trimmed, lower-cased and deduplicated
+def test_tag_names_are_normalized():
+    assert tag_names([' Work ', 'work', 'To  Do', '']) == ['work', 'to do']
+
+# edge_case - test_tags_error - Test that malformed or oversized tag lists are refused
+def test_tags_error():
+    assert tags_error(['a', 'b']) is None
+    assert tags_error('a') == "Tags must be a list of strings."
+    assert tags_error([1]) == "Tags must be a list of strings."
+    assert tags_error(['x' * 51]) is not None
+    assert tags_error([str(i) for i in range(MAX_TAGS_PER_NOTE + 1)]) is not None
+
+# happy_path - test_create_with_tags_maintains_counters - Test that creating tagged notes fills note_tag and the counters
+def test_create_with_tags_maintains_counters(client):
+    response = client.post('/api/notes', json={'notes': [{'content': 'a', 'tags': ['Work', 'urgent']},
+                                                         {'content': 'b', 'tags': ['work']},
+                                                         {'content': 'c'}]})
+    assert [r['status'] for r in response.json['create']] == ['created'] * 3
+    assert counts() == {'work': 2, 'urgent': 1}
+    notes = {n['content']: n['tags'] for n in client.get('/api/notes').json['notes']}
+    assert notes == {'a': ['urgent', 'work'], 'b': ['work'], 'c': []}
+    assert client.get('/api/tags').json['tags'] == [{'name': 'work', 'count': 2}, {'name': 'urgent', 'count': 1}]
+
+# happy_path - test_update_tags_only - Test that a PATCH with only tags retags the note and logs a change
+def test_update_tags_only(client):
+    note_id = client.post('/api/notes', json={'notes': [{'content': 'a', 'tags': ['x', 'y']}]}).json['create'][0]['id']
+    version = client.get('/api/notes/changes').json['version']
+    response = client.patch('/api/notes', json={'notes': [{'id': note_id, 'tags': ['y', 'z']}]})
+    assert response.json['update'] == [{'status': 'updated', 'id': note_id}]
+    assert counts() == {'x': 0, 'y': 1, 'z': 1}
+    changes = client.get('/api/notes/changes?since={}'.format(version)).json['changes']
+    assert [(c['id'], c['note']['tags'], c['note']['content']) for c in changes] == [(note_id, ['y', 'z'], 'a')]
+    assert client.get('/api/tags').json['tags'] == [{'name': 'y', 'count': 1}, {'name': 'z', 'count': 1}]
+
+# edge_case - test_update_needs_content_or_tags - Test that an update with neither content nor tags is an error
+def test_update_needs_content_or_tags(client):
+    note_id = client.post('/api/notes', json={'notes': [{'content': 'a'}]}).json['create'][0]['id']
+    response = client.patch('/api/notes', json={'notes': [{'id': note_id}, {'id': note_id, 'tags': 'x'}]})
+    assert [r['status'] for r in response.json['update']] == ['error', 'error']
+
+# happy_path - test_delete_counts_tags_down - Test that deleting notes removes their tags and lowers the counters
+def test_delete_counts_tags_down(app, client):
+    ids = [r['id'] for r in client.post('/api/notes', json={'notes': [{'content': 'a', 'tags': ['x']},
+                                                                     {'content': 'b', 'tags': ['x', 'y']}]}).json['create']]
+    client.delete('/api/notes', json={'ids': [ids[1]]})
+    assert counts() == {'x': 1, 'y': 0}
+    client.post('/delete-note', json={'noteId': ids[0]})
+    assert counts() == {'x': 0, 'y': 0}
+    assert NoteTag.query.count() == 0
+    assert purge_unused_tags() == 2
+    assert client.get('/api/tags').json['tags'] == []
+
+# happy_path - test_filter_by_tag_and_date - Test that listings filter by tag and date range and page through the tag index
+def test_filter_by_tag_and_date(app, client):
+    for day in range(1, 8):
+        db.session.add(Note(content='day {}'.format(day), user_id=1, date=datetime(2024, 1, day)))
+    db.session.commit()
+    client.patch('/api/notes', json={'notes': [{'id': i, 'tags': ['even']} for i in (2, 4, 6)]})
+    seen, after = [], ''
+    while after is not None:
+        page = client.get('/api/notes?tag=Even&limit=2' + after).json
+        seen += [n['content'] for n in page['notes']]
+        after = '&after={}'.format(page['next']) if page['next'] else None
+    assert seen == ['day 6', 'day 4', 'day 2']
+    dated = client.get('/api/notes?from=2024-01-03&to=2024-01-06').json['notes']
+    assert [n['content'] for n in dated] == ['day 5', 'day 4', 'day 3']
+    both = client.get('/api/notes?tag=even&from=2024-01-03T00:00:00%2B00:00').json['notes']
+    assert [n['content'] for n in both] == ['day 6', 'day 4']
+    assert client.get('/api/notes?tag=missing').json == {'notes': [], 'next': None}
+    assert client.get('/api/notes?from=yesterday').status_code == 400
+
+# happy_path - test_tag_listing_uses_tag_index - Test that the tag filter is answered from the note_tag index
+def test_tag_listing_uses_tag_index(app):
+    from website.pagination import notes_page_query
+    sql = str(notes_page_query(1, (datetime(2024, 1, 5), 5), 10, tag_id=1).compile(db.engine, compile_kwargs={'literal_binds': True}))
+    plan = ' '.join(row[-1] for row in db.session.execute(text('EXPLAIN QUERY PLAN ' + sql)))
+    assert 'ix_note_tag_tag_date_note' in plan
+    assert 'TEMP B-TREE' not in plan # no sort, rows come in index order
+
+# edge_case - test_tags_are_per_user - Test that tags and filters never reach another user's notes
+def test_tags_are_per_user(app, client):
+    client.post('/api/notes', json={'notes': [{'content': 'mine', 'tags': ['shared']}]})
+    theirs = Note(content='theirs', user_id=2)
+    db.session.add(theirs)
+    db.session.flush()
+    set_note_tags(2, {theirs.id: ['shared']})
+    set_note_tags(2, {1: ['stolen']}) # not their note
+    db.session.commit()
+    notes, _ = notes_page(2, tag_id=find_tag(2, 'shared'))
+    assert [n.content for n in notes] == ['theirs']
+    assert user_tags(2) == [{'name': 'shared', 'count': 1}]
+    assert Tag.query.filter_by(name='shared').count() == 2
+    assert [n['tags'] for n in client.get('/api/notes').json['notes']] == [['shared']]
+
+# happy_path - test_recount_tags_repairs_drift - Test that recount_tags rebuilds counters from note_tag
+def test_recount_tags_repairs_drift(app, client):
+    client.post('/api/notes', json={'notes': [{'content': 'a', 'tags': ['x']}]})
+    Tag.query.filter_by(name='x').update({'note_count': 7})
+    db.session.commit()
+    assert recount_tags() == 1
+    assert counts() == {'x': 1}
+    assert user_tags(1) == [{'name': 'x', 'count': 1}]
+
+# happy_path - test_home_page_tags_and_filter - Test that the home page creates tagged notes and filters by tag
+def test_home_page_tags_and_filter(client):
+    client.post('/', data={'note': 'tagged note', 'tags': 'Ideas, later'})
+    client.post('/', data={'note': 'plain note', 'tags': ''})
+    page = client.get('/?tag=ideas').get_data(as_text=True)
+    assert 'tagged note' in page and 'plain note' not in page
+    assert 'href="/?tag=later"' in page
+    assert counts() == {'ideas': 1, 'later': 1}
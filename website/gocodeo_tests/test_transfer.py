@@ -0,0 +1,73 @@
+import csv
+import io
+import json
+import pytest
+from website.models import Note
+from website.changes import notes_version
+
+# happy_path - test_import_ndjson_in_batches - Test that NDJSON lines are imported in batches and bad lines reported
+def test_import_ndjson_in_batches(client):
+    body = '\n'.join([json.dumps({'content': 'note {}'.format(i)}) for i in range(5)] + ['not json', '{"content": ""}', ''])
+    response = client.post('/api/notes/import?batch_size=2', data=body, content_type='application/x-ndjson')
+    assert response.json['imported'] == 5
+    assert response.json['skipped'] == 2
+    assert [e['line'] for e in response.json['errors']] == [6, 7]
+    assert Note.query.filter_by(user_id=1).count() == 5
+    assert notes_version(1) == 5
+
+# happy_path - test_import_csv_upload_keeps_dates - Test that an uploaded CSV file is imported with its dates
+def test_import_csv_upload_keeps_dates(client):
+    data = 'id,date,content\n7,2020-01-02T03:04:05,"hello, world"\n8,,"multi\nline"\n'
+    response = client.post('/api/notes/import', data={'file': (io.BytesIO(data.encode()), 'notes.csv')})
+    assert response.json == {'imported': 2, 'skipped': 0, 'errors': []}
+    notes = Note.query.order_by(Note.id).all()
+    assert notes[0].content == 'hello, world'
+    assert notes[0].date.year == 2020
+    assert notes[1].content == 'multi\nline'
+
+# happy_path - test_export_ndjson_round_trip - Test that exported NDJSON can be imported back
+def test_export_ndjson_round_trip(client):
+    client.post('/api/notes', json={'notes': [{'content': 'a'}, {'content': 'b "quoted"'}]})
+    response = client.get('/api/notes/export')
+    assert response.mimetype == 'application/x-ndjson'
+    lines = [json.loads(line) for line in response.data.decode().splitlines()]
+    assert [line['content'] for line in lines] == ['a', 'b "quoted"']
+    assert client.post('/api/notes/import', data=response.data).json['imported'] == 2
+
+# happy_path - test_export_csv - Test that the CSV export has a header and one row per note
+def test_export_csv(client):
+    client.post('/api/notes', json={'notes': [{'content': 'x,y'}]})
+    rows = list(csv.reader(io.StringIO(client.get('/api/notes/export?format=csv').data.decode())))
+    assert rows[0] == ['id', 'date', 'content', 'tags']
+    assert rows[1][2] == 'x,y'
+
+# edge_case - test_unknown_format - Test that unsupported formats are rejected
+def test_unknown_format(client):
+    assert client.get('/api/notes/export?format=xml').status_code == 400
+
+# happy_path - test_export_import_keeps_tags - Test that tags survive an export and import in both formats
+@pytest.mark.parametrize('fmt', ['ndjson', 'csv'])
+def test_export_import_keeps_tags(client, fmt):
+    ids = [r['id'] for r in client.post('/api/notes', json={'notes': [{'content': 'a', 'tags': ['work', 'Later']}, {'content': 'b'}]}).json['create']]
+    exported = client.get('/api/notes/export?format=' + fmt).data
+    client.delete('/api/notes', json={'ids': ids})
+    assert client.post('/api/notes/import?format=' + fmt, data=exported).json == {'imported': 2, 'skipped': 0, 'errors': []}
+    assert {n['content']: n['tags'] for n in client.get('/api/notes').json['notes']} == {'a': ['later', 'work'], 'b': []}
+    assert client.get('/api/tags').json['tags'] == [{'name': 'later', 'count': 1}, {'name': 'work', 'count': 1}]
+
+# edge_case - test_import_refuses_bad_tags - Test that rows with malformed tags are skipped and reported
+def test_import_refuses_bad_tags(client):
+    body = '\n'.join(json.dumps(item) for item in [{'content': 'a', 'tags': 'work'}, {'content': 'b', 'tags': ['ok']}])
+    response = client.post('/api/notes/import', data=body)
+    assert response.json == {'imported': 1, 'skipped': 1, 'errors': [{'line': 1, 'error': 'Tags must be a list of strings.'}]}
+
+# edge_case - test_import_reports_lines_that_are_not_utf8 - Test that undecodable lines are reported and the rest imported
+def test_import_reports_lines_that_are_not_utf8(client):
+    body = '{"content": "caf\xe9"}\n{"content": "ok"}\n'.encode('latin-1')
+    response = client.post('/api/notes/import', data=body)
+    assert response.status_code == 200
+    assert response.json == {'imported': 1, 'skipped': 1, 'errors': [{'line': 1, 'error': 'Invalid UTF-8.'}]}
+    data = 'id,date,content\n1,,"multi\ncaf\xe9"\n2,,fine\n'.encode('latin-1')
+    response = client.post('/api/notes/import', data={'file': (io.BytesIO(data), 'notes.csv')})
+    assert response.json == {'imported': 1, 'skipped': 1, 'errors': [{'line': 3, 'error': 'Invalid UTF-8.'}]}
+    assert sorted(n.content for n in Note.query) == ['fine', 'ok']
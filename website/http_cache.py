@@ -0,0 +1,33 @@
+from datetime import timezone
+from flask import request, session, Response
+
+
+'''Conditional GET support (ETag, Last-Modified, 304) for pages derived from a user's notes version'''
+
+
+def notes_etag(user_id, version, build=''):
+    # the user is part of the tag since several accounts may share one browser; pages add the
+    # asset build, as their asset URLs change with it
+    return '{}-{}-{}'.format(user_id, version, build) if build else '{}-{}'.format(user_id, version)
+
+
+def cacheable():
+    '''Only plain GETs without pending flash messages can be answered from the browser's copy'''
+    return request.method == 'GET' and not session.get('_flashes')
+
+
+def not_modified(etag, last_modified):
+    '''A 304 response when the request's validators match, otherwise None'''
+    response = set_validators(Response(), etag, last_modified)
+    response.make_conditional(request)
+    return response if response.status_code == 304 else None
+
+
+def set_validators(response, etag, last_modified):
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified.replace(tzinfo=timezone.utc) if last_modified.tzinfo is None else last_modified
+    # the page is per user and must be revalidated, which is cheap thanks to the ETag
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
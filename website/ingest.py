@@ -0,0 +1,324 @@
+import atexit
+import fcntl
+import glob
+import itertools
+import json
+import os
+import queue
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import insert
+from sqlalchemy.exc import DBAPIError, OperationalError
+from .models import Note, IngestCheckpoint
+from .changes import record_changes
+from .storage import prepare_rows, save_blobs
+from .tags import set_note_tags
+from .shards import shard_count, user_shards, using_shard
+from . import db
+
+
+'''Write-behind note ingestion: notes are acknowledged once spooled and queued, and a background
+thread inserts them in group commits of up to INGEST_MAX_BATCH notes or INGEST_MAX_DELAY seconds.
+
+Each process appends to its own spool file and holds an exclusive lock on it. Every group commit
+also stores how far into the spool it got (IngestCheckpoint) in the same transaction, one per
+shard. A spool that nobody holds a lock on belongs to a crashed process, and is replayed on startup
+with every shard skipping what its checkpoint covers. So nothing acknowledged is lost and nothing
+is inserted twice.
+
+Once a spool reaches INGEST_SPOOL_ROTATE bytes new notes go to a fresh one, and the full one is
+deleted when its last note is committed. While the database is unreachable or locked a group
+commit waits for it, retrying with backoff for as long as it takes. Any other error is retried
+INGEST_MAX_RETRIES times; then the notes are committed one by one, and those that still fail are
+appended to INGEST_DEAD_LETTER with the error, so one bad note cannot hold up the ones queued
+behind it. `flask ingest replay` inserts them once whatever stopped them is fixed.
+'''
+
+_STOP = object()
+
+
+class NoteWriter:
+
+    def __init__(self, app):
+        self.app = app
+        self.max_batch = app.config['INGEST_MAX_BATCH']
+        self.max_delay = app.config['INGEST_MAX_DELAY']
+        self.spool_dir = app.config['INGEST_SPOOL_DIR']
+        self.fsync = app.config['INGEST_SPOOL_FSYNC']
+        self.rotate_bytes = app.config['INGEST_SPOOL_ROTATE']
+        self.max_retries = app.config['INGEST_MAX_RETRIES']
+        self.dead_letter = dead_letter_path(app)
+        self._lock = threading.Lock()
+        self._pid = None
+        self._spool_name = None
+        self._full = {} # spool name -> (open file, size) of spools no longer written to, until committed
+
+    def enqueue(self, user_id, content, tags=None):
+        '''Spool and queue a note; once this returns the note will be stored even if the process dies'''
+        self.ensure_started()
+        record = {"user_id": user_id, "content": content,
+                  "date": datetime.now(timezone.utc).replace(tzinfo=None).isoformat()}
+        if tags:
+            record["tags"] = tags
+        line = (json.dumps(record) + '\n').encode('utf-8')
+        with self._lock:
+            self._spool.write(line)
+            self._spool.flush()
+            if self.fsync:
+                os.fsync(self._spool.fileno())
+            self._queue.put((record, self._spool_name, self._spool.tell()))
+            if self._spool.tell() >= self.rotate_bytes:
+                self._full[self._spool_name] = (self._spool, self._spool.tell()) # still locked, so nobody replays it
+                self._open_spool()
+
+    def ensure_started(self):
+        '''Start the writer in this process; a forked worker gets its own spool and thread'''
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            os.makedirs(self.spool_dir, exist_ok=True)
+            self._queue = queue.Queue()
+            self._full = {}
+            self._spool_numbers = itertools.count() # rotations may come within the same millisecond
+            self._open_spool()
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='note-writer', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=10):
+        '''Flush what is queued and stop the writer thread'''
+        if self._pid == os.getpid():
+            self._queue.put(_STOP)
+            self._thread.join(timeout)
+            self._pid = None
+
+    def _open_spool(self):
+        self._spool_name = 'spool-{}-{}-{}.ndjson'.format(os.getpid(), int(time.time() * 1000), next(self._spool_numbers))
+        self._spool = open(os.path.join(self.spool_dir, self._spool_name), 'ab')
+        fcntl.flock(self._spool.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB) # held while this process lives
+
+    def _run(self):
+        self.recover()
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch:
+                try:
+                    item = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            for spool_name in dict.fromkeys(spool_name for _, spool_name, _ in batch): # a batch may span a rotation
+                entries = [(record, offset) for record, name, offset in batch if name == spool_name]
+                self._flush(entries, spool_name)
+                self._retire(spool_name, entries[-1][1])
+
+    def _flush(self, entries, spool_name):
+        error = self._write_with_retry(entries, spool_name, self.max_retries)
+        if error is None:
+            return
+        self.app.logger.error("Group commit of %d notes failed %d times, committing them one by one", len(entries), self.max_retries + 1)
+        for entry in entries:
+            error = self._write_with_retry([entry], spool_name, 0)
+            if error is not None:
+                self._bury(entry, spool_name, error)
+
+    def _write_with_retry(self, entries, spool_name, retries, skip=False):
+        '''None once written, or the last error after `retries` more attempts. Outages do not count,
+        the batch is held until the database is back.'''
+        delay = 0.05
+        attempt = failures = 0
+        while True:
+            attempt += 1
+            try:
+                with self.app.app_context():
+                    write_batch(entries, spool_name, skip)
+                return None
+            except Exception as error:
+                if transient_error(error):
+                    self.app.logger.warning("Group commit of %d notes waits for the database (attempt %d): %s", len(entries), attempt, error)
+                else:
+                    self.app.logger.exception("Group commit of %d notes failed (attempt %d)", len(entries), attempt)
+                    failures += 1
+                    if failures > retries:
+                        return error
+                time.sleep(delay)
+                delay = min(delay * 2, 5)
+
+    def _bury(self, entry, spool_name, error):
+        '''Append a note that cannot be inserted to the dead-letter file and move its checkpoint past it'''
+        record, offset = entry
+        line = json.dumps(dict(record, error='{}: {}'.format(type(error).__name__, error), spool=spool_name)) + '\n'
+        with open(self.dead_letter, 'ab') as dead_letter:
+            dead_letter.write(line.encode('utf-8'))
+            dead_letter.flush()
+            if self.fsync:
+                os.fsync(dead_letter.fileno())
+        self.app.logger.error("Note of user %s moved to %s", record.get("user_id"), self.dead_letter)
+        if self._write_with_retry([entry], spool_name, 0, skip=True) is not None:
+            self.app.logger.error("Checkpoint not moved past a dead-lettered note, a replay of %s may insert it", spool_name)
+
+    def _retire(self, spool_name, committed):
+        '''Delete a full spool once everything in it is committed'''
+        with self._lock:
+            if spool_name not in self._full or committed < self._full[spool_name][1]:
+                return
+            old_file, _ = self._full.pop(spool_name)
+        os.remove(os.path.join(self.spool_dir, spool_name))
+        old_file.close()
+        with self.app.app_context():
+            drop_checkpoints(spool_name)
+
+    def recover(self):
+        '''Replay spools left behind by processes that died before committing everything'''
+        for path in sorted(glob.glob(os.path.join(self.spool_dir, 'spool-*.ndjson'))):
+            name = os.path.basename(path)
+            if name == self._spool_name:
+                continue
+            with open(path, 'rb') as spool:
+                try:
+                    fcntl.flock(spool.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    continue # its process is still alive
+                entries, offset = [], 0
+                for line in spool:
+                    if not line.endswith(b'\n'):
+                        break # torn write, never acknowledged
+                    offset += len(line)
+                    entries.append((json.loads(line), offset))
+                    if len(entries) >= self.max_batch:
+                        self._flush(entries, name)
+                        entries = []
+                if entries:
+                    self._flush(entries, name)
+                self.app.logger.info("Recovered spool %s", name)
+                os.remove(path)
+                with self.app.app_context():
+                    drop_checkpoints(name)
+
+
+def transient_error(error):
+    '''True for errors of a database that is down, restarting or locked, which go away by waiting'''
+    if isinstance(error, OperationalError):
+        return True
+    if isinstance(error, DBAPIError) and error.connection_invalidated:
+        return True
+    return 'database is locked' in str(error)
+
+
+def write_batch(entries, spool_name, skip=False):
+    '''Insert spooled notes, given as (record, spool offset after it). Each shard gets its notes and
+    its checkpoint in one transaction, and skips the records its checkpoint says it already has.
+    With skip=True only the checkpoints move past them.'''
+    shards = user_shards({record["user_id"] for record, _ in entries})
+    by_shard = defaultdict(list)
+    for record, offset in entries:
+        by_shard[shards.get(record["user_id"], 0)].append((record, offset))
+    for shard, shard_entries in by_shard.items():
+        with using_shard(shard):
+            checkpoint = db.session.get(IngestCheckpoint, spool_name)
+            done = checkpoint.offset if checkpoint else 0
+            records = [record for record, offset in shard_entries if offset > done]
+            if records and not skip:
+                _insert_records(records)
+            db.session.merge(IngestCheckpoint(spool=spool_name, offset=shard_entries[-1][1]))
+            db.session.commit()
+
+
+def _insert_records(records):
+    rows, blobs = prepare_rows([{"user_id": r["user_id"], "content": r["content"], "date": datetime.fromisoformat(r["date"])} for r in records])
+    save_blobs(blobs)
+    ids = db.session.execute(insert(Note).returning(Note.id, sort_by_parameter_order=True), rows).scalars().all()
+    by_user, tagged = defaultdict(list), defaultdict(dict)
+    for record, note_id in zip(records, ids):
+        by_user[record["user_id"]].append(note_id)
+        if record.get("tags"):
+            tagged[record["user_id"]][note_id] = record["tags"]
+    for user_id, note_ids in by_user.items():
+        set_note_tags(user_id, tagged[user_id])
+        record_changes(user_id, note_ids, "upsert")
+
+
+def drop_checkpoints(spool_name):
+    for shard in range(shard_count()):
+        with using_shard(shard):
+            IngestCheckpoint.query.filter_by(spool=spool_name).delete()
+            db.session.commit()
+
+
+def dead_letter_path(app):
+    return app.config['INGEST_DEAD_LETTER'] or os.path.join(app.config['INGEST_SPOOL_DIR'], 'dead-letter.ndjson')
+
+
+def replay_dead_letter(path):
+    '''Insert the notes of a dead-letter file, returning (inserted, failed). The file is renamed
+    first, so notes buried meanwhile start a new one, and failures are appended to that again.
+    Each note is checkpointed like a spool, so a replay that is cut short resumes where it was.'''
+    pending = sorted(glob.glob(path + '.*.replay')) # left by an interrupted replay
+    if os.path.exists(path):
+        pending.append('{}.{}.replay'.format(path, int(time.time() * 1000)))
+        os.replace(path, pending[-1])
+    inserted = failed = 0
+    for replay in pending:
+        name = os.path.basename(replay)
+        with open(replay, 'rb') as dead_letter:
+            offset = 0
+            for line in dead_letter:
+                offset += len(line)
+                entry = (json.loads(line), offset)
+                try:
+                    write_batch([entry], name)
+                    inserted += 1
+                except Exception as error:
+                    db.session.rollback()
+                    if transient_error(error):
+                        raise # the rest waits in the .replay file for the next run
+                    with open(path, 'ab') as again:
+                        again.write((json.dumps(dict(entry[0], error='{}: {}'.format(type(error).__name__, error))) + '\n').encode('utf-8'))
+                    write_batch([entry], name, skip=True)
+                    failed += 1
+        os.remove(replay)
+        drop_checkpoints(name)
+    return inserted, failed
+
+
+def init_ingest(app):
+    app.cli.add_command(ingest_cli)
+    if app.config['INGEST_MODE'] == 'queue':
+        writer = app.extensions['note_writer'] = NoteWriter(app)
+        writer.ensure_started()
+        atexit.register(writer.stop)
+
+
+def enqueue_note(app, user_id, content, tags=None):
+    '''True if the note was queued, False when ingestion is synchronous and the caller must insert it'''
+    writer = app.extensions.get('note_writer')
+    if writer is None:
+        return False
+    writer.enqueue(user_id, content, tags)
+    return True
+
+
+ingest_cli = AppGroup('ingest', help='Inspect and repair write-behind note ingestion.')
+
+
+@ingest_cli.command('replay')
+@click.argument('path', required=False)
+def replay_command(path):
+    '''Insert the notes in the dead-letter file (INGEST_DEAD_LETTER by default)'''
+    inserted, failed = replay_dead_letter(path or dead_letter_path(current_app))
+    click.echo('{} notes inserted, {} failed again'.format(inserted, failed))
@@ -0,0 +1,237 @@
+import fcntl
+import os
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import select, delete, func, text
+from .models import MaintenanceRun
+from .changes import compact_changes
+from .storage import purge_orphan_blobs
+from .revisions import purge_orphan_revisions
+from .tags import recount_tags, purge_unused_tags
+from .shards import shard_count, using_shard
+from . import db
+
+
+'''Background database maintenance.
+
+Every worker process runs a MaintenanceRunner thread, started by its first request. Each
+MAINTENANCE_TICK seconds it tries to take an exclusive lock on MAINTENANCE_LOCK_FILE; the worker
+holding it is the leader until it exits, and only the leader runs jobs. Every job runs on every
+shard and is recorded in maintenance_run (main database) with its duration, which is also how
+the next leader knows what is due. The lock is per machine, so with several app servers point
+MAINTENANCE_ENABLED=1 at one of them only.
+
+Jobs, in the order they run:
+- purge: orphaned blobs and revisions, unused tags, change log entries superseded by later ones
+- vacuum: PRAGMA incremental_vacuum, then a WAL checkpoint; a database created before
+  auto_vacuum=INCREMENTAL is switched over by one full VACUUM the first time
+- analyze: ANALYZE (sampled on SQLite through analysis_limit) so the planner keeps picking indexes
+- fts_optimize: merges the b-trees of the full-text index
+- backup: copy of each SQLite database through the online backup API, newest MAINTENANCE_BACKUP_KEEP kept
+'''
+
+ANALYSIS_LIMIT = 1000 # rows sampled per index by ANALYZE
+
+
+def purge(shard):
+    with using_shard(shard):
+        counts = (purge_orphan_blobs(), purge_orphan_revisions(), recount_tags(), purge_unused_tags(), compact_changes())
+    if shard == 0:
+        horizon = _now() - timedelta(days=current_app.config['MAINTENANCE_HISTORY_DAYS'])
+        db.session.execute(delete(MaintenanceRun).where(MaintenanceRun.started < horizon))
+        db.session.commit()
+    return 'blobs {}, revisions {}, tag counts fixed {}, tags {}, changes {}'.format(*counts)
+
+
+def vacuum(shard):
+    engine = _sqlite_engine(shard)
+    if engine is None:
+        return 'skipped'
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        free = connection.exec_driver_sql('PRAGMA freelist_count').scalar()
+        if connection.exec_driver_sql('PRAGMA auto_vacuum').scalar() != 2: # 2 is INCREMENTAL
+            connection.exec_driver_sql('PRAGMA auto_vacuum = INCREMENTAL')
+            connection.exec_driver_sql('VACUUM') # rewrites the file once, blocking writers meanwhile
+            return 'switched to incremental auto_vacuum, {} pages freed'.format(free)
+        # frees one page per step, and only executescript steps a statement without rows to the end
+        connection.connection.driver_connection.executescript('PRAGMA incremental_vacuum;')
+        connection.exec_driver_sql('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
+        return '{} pages freed'.format(free - connection.exec_driver_sql('PRAGMA freelist_count').scalar())
+
+
+def analyze(shard):
+    engine = current_app.extensions['shard_engines'][shard]
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        if engine.dialect.name == 'sqlite':
+            connection.exec_driver_sql('PRAGMA analysis_limit = {}'.format(ANALYSIS_LIMIT)).fetchall()
+        connection.exec_driver_sql('ANALYZE')
+    return 'ok'
+
+
+def fts_optimize(shard):
+    engine = _sqlite_engine(shard, memory=True)
+    if engine is None:
+        return 'skipped'
+    with engine.begin() as connection:
+        if not connection.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'note_fts'")).first():
+            return 'no index'
+        connection.execute(text("INSERT INTO note_fts(note_fts) VALUES ('optimize')"))
+    return 'ok'
+
+
+def backup(shard):
+    engine = _sqlite_engine(shard)
+    if engine is None:
+        return 'skipped'
+    directory = current_app.config['MAINTENANCE_BACKUP_DIR']
+    os.makedirs(directory, exist_ok=True)
+    stem = os.path.splitext(os.path.basename(engine.url.database))[0]
+    target = os.path.join(directory, '{}-{}.db'.format(stem, _now().strftime('%Y%m%dT%H%M%S')))
+    source = engine.raw_connection()
+    try:
+        copy = sqlite3.connect(target + '.part')
+        try:
+            source.driver_connection.backup(copy) # one step: a consistent snapshot, writers carry on under WAL
+        finally:
+            copy.close()
+    finally:
+        source.close()
+    os.replace(target + '.part', target)
+    # only this database's backups: a shard named notes-1.db must not count as one of notes.db
+    ours = re.compile(re.escape(stem) + r'-\d{8}T\d{6}\.db$')
+    for old in sorted(name for name in os.listdir(directory) if ours.match(name))[:-current_app.config['MAINTENANCE_BACKUP_KEEP']]:
+        os.remove(os.path.join(directory, old))
+    return '{} ({} bytes)'.format(os.path.basename(target), os.path.getsize(target))
+
+
+JOBS = {'purge': purge, 'vacuum': vacuum, 'analyze': analyze, 'fts_optimize': fts_optimize, 'backup': backup}
+
+
+def _sqlite_engine(shard, memory=False):
+    engine = current_app.extensions['shard_engines'][shard]
+    if engine.dialect.name != 'sqlite' or (not memory and engine.url.database in (None, '', ':memory:')):
+        return None
+    return engine
+
+
+def _now():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def run_job(name, shard):
+    '''Run one job on one shard and record how it went and how long it took'''
+    started, clock = _now(), time.perf_counter()
+    try:
+        result, ok = JOBS[name](shard), True
+    except Exception as error:
+        db.session.rollback()
+        current_app.logger.exception("Maintenance job %s failed on shard %d", name, shard)
+        result, ok = '{}: {}'.format(type(error).__name__, error), False
+    duration = time.perf_counter() - clock
+    current_app.logger.info("Maintenance %s on shard %d took %.0f ms: %s", name, shard, duration * 1000, result)
+    run = MaintenanceRun(job=name, shard=shard, started=started, duration=duration, ok=ok, result=result[:200])
+    db.session.add(run)
+    db.session.commit()
+    db.session.refresh(run)
+    db.session.expunge(run) # a plain record from here on, later commits and using_shard() leave it alone
+    return run
+
+
+def due_jobs():
+    '''Jobs whose MAINTENANCE_JOBS interval has passed since they last started'''
+    last = dict(db.session.execute(select(MaintenanceRun.job, func.max(MaintenanceRun.started)).group_by(MaintenanceRun.job)).all())
+    now = _now()
+    return [name for name, interval in current_app.config['MAINTENANCE_JOBS'].items()
+            if interval and name in JOBS and (last.get(name) is None or now - last[name] >= timedelta(seconds=interval))]
+
+
+def run_jobs(names):
+    '''Run jobs on every shard, in JOBS order; returns the MaintenanceRun rows'''
+    return [run_job(name, shard) for name in JOBS if name in names for shard in range(shard_count())]
+
+
+class MaintenanceRunner:
+
+    def __init__(self, app):
+        self.app = app
+        self.tick = app.config['MAINTENANCE_TICK']
+        self.lock_path = app.config['MAINTENANCE_LOCK_FILE']
+        self._lock = threading.Lock()
+        self._pid = None
+        self._lock_file = None
+
+    def ensure_started(self):
+        '''Start the runner in this process; every forked worker gets its own thread'''
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._lock_file = None # a copy inherited from the master is not our lock
+            self._stopping = threading.Event()
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='maintenance', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=10):
+        if self._pid == os.getpid():
+            self._stopping.set()
+            self._thread.join(timeout)
+            self._pid = None
+
+    def is_leader(self):
+        '''Take the lock if nobody holds it; the holder keeps it, and leads, until it exits'''
+        if self._lock_file is None:
+            lock_file = open(self.lock_path, 'a')
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                return False
+            self._lock_file = lock_file
+        return True
+
+    def _run(self):
+        while not self._stopping.wait(self.tick): # the first check waits a tick, startup stays quick
+            if not self.is_leader():
+                continue
+            try:
+                with self.app.app_context():
+                    run_jobs(due_jobs())
+            except Exception:
+                self.app.logger.exception("Maintenance run failed")
+
+
+def init_maintenance(app):
+    app.cli.add_command(maintenance_cli)
+    if not app.config['MAINTENANCE_ENABLED'] or app.testing: # tests call run_jobs themselves
+        return
+    runner = app.extensions['maintenance_runner'] = MaintenanceRunner(app)
+    app.before_request(runner.ensure_started) # in the workers, not in a preloading master
+
+
+maintenance_cli = AppGroup('maintenance', help='Run and inspect database maintenance jobs.')
+
+
+@maintenance_cli.command('run')
+@click.argument('jobs', nargs=-1, type=click.Choice(list(JOBS)))
+def run_command(jobs):
+    '''Run JOBS (all by default) now, on every shard'''
+    for run in run_jobs(jobs or list(JOBS)):
+        click.echo('{} shard {}: {:.0f} ms, {}{}'.format(run.job, run.shard, run.duration * 1000,
+                                                         '' if run.ok else 'FAILED ', run.result))
+
+
+@maintenance_cli.command('status')
+def status_command():
+    '''Latest run of every job on every shard'''
+    latest = select(func.max(MaintenanceRun.id)).group_by(MaintenanceRun.job, MaintenanceRun.shard)
+    for run in MaintenanceRun.query.filter(MaintenanceRun.id.in_(latest)).order_by(MaintenanceRun.job, MaintenanceRun.shard):
+        click.echo('{} shard {}: {} UTC, {:.0f} ms, {}{}'.format(run.job, run.shard, run.started.isoformat(' ', 'seconds'),
+                                                                run.duration * 1000, '' if run.ok else 'FAILED ', run.result))
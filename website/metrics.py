@@ -0,0 +1,189 @@
+import cProfile
+import os
+import random
+import time
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from threading import Lock
+from flask import Blueprint, Response, current_app, g, has_request_context, request, before_render_template, template_rendered
+from sqlalchemy import event
+
+
+'''Opt-in request instrumentation: route timing, SQL counts and durations, N+1 detection,
+template render time and a sampling profiler, exported in the Prometheus text format at /metrics.
+
+Every worker process keeps its own numbers, like the other in-process caches of this app.
+'''
+
+TIME_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 500)
+
+DESCRIPTIONS = {
+    'notemaster_request_duration_seconds': ('histogram', 'Time spent handling a request.'),
+    'notemaster_request_sql_queries': ('histogram', 'SQL statements executed per request.'),
+    'notemaster_request_sql_seconds': ('histogram', 'Time spent in SQL per request.'),
+    'notemaster_n_plus_one_total': ('counter', 'Requests that ran the same SELECT at least METRICS_N_PLUS_ONE times.'),
+    'notemaster_template_render_seconds': ('histogram', 'Time spent rendering a template.'),
+    'notemaster_profiles_total': ('counter', 'Requests profiled by the sampling profiler.'),
+}
+
+
+class Registry:
+    '''Thread-safe counters and histograms keyed by metric name and label values'''
+
+    def __init__(self):
+        self._lock = Lock()
+        self.counters = defaultdict(float)
+        self.histograms = {}
+
+    def inc(self, name, labels=(), value=1):
+        with self._lock:
+            self.counters[name, labels] += value
+
+    def observe(self, name, labels, value, buckets=TIME_BUCKETS):
+        with self._lock:
+            histogram = self.histograms.get((name, labels))
+            if histogram is None:
+                histogram = self.histograms[name, labels] = {'buckets': buckets, 'counts': [0] * len(buckets), 'sum': 0.0, 'count': 0}
+            index = bisect_left(buckets, value)
+            if index < len(buckets):
+                histogram['counts'][index] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def render(self, gauges=()):
+        '''The registry, plus extra (name, help, value) gauges, in the Prometheus text exposition format'''
+        lines = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items(), key=lambda item: item[0])
+            histograms = [(key, dict(h, counts=list(h['counts']))) for key, h in histograms]
+        described = set()
+        for (name, labels), value in counters:
+            _describe(lines, described, name)
+            lines.append('{}{} {}'.format(name, _labels(labels), _number(value)))
+        for (name, labels), histogram in histograms:
+            _describe(lines, described, name)
+            cumulative = 0
+            for bound, count in zip(histogram['buckets'], histogram['counts']):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(name, _labels(labels + (('le', _number(bound)),)), cumulative))
+            lines.append('{}_bucket{} {}'.format(name, _labels(labels + (('le', '+Inf'),)), histogram['count']))
+            lines.append('{}_sum{} {}'.format(name, _labels(labels), _number(histogram['sum'])))
+            lines.append('{}_count{} {}'.format(name, _labels(labels), histogram['count']))
+        for name, help_text, value in gauges:
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} gauge'.format(name))
+            lines.append('{} {}'.format(name, _number(value)))
+        return '\n'.join(lines) + '\n'
+
+
+def _describe(lines, described, name):
+    if name not in described and name in DESCRIPTIONS:
+        kind, help_text = DESCRIPTIONS[name]
+        lines.append('# HELP {} {}'.format(name, help_text))
+        lines.append('# TYPE {} {}'.format(name, kind))
+    described.add(name)
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels) + '}'
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+metrics = Blueprint('metrics', __name__)
+
+
+@metrics.route('/metrics')
+def export():
+    token = current_app.config.get('METRICS_TOKEN')
+    if token and request.headers.get('Authorization') != 'Bearer {}'.format(token):
+        return Response('Forbidden\n', status=403, mimetype='text/plain')
+    gauges = []
+    hasher = current_app.extensions.get('password_hasher')
+    if hasher:
+        for key, value in sorted(hasher.stats().items()):
+            gauges.append(('notemaster_password_hash_{}'.format(key), 'Password hasher {} in this worker.'.format(key.replace('_', ' ')), value))
+    body = current_app.extensions['metrics'].render(gauges)
+    return Response(body, mimetype='text/plain; version=0.0.4')
+
+
+def init_metrics(app):
+    '''Install the hooks; only called when METRICS_ENABLED is set, so there is no cost otherwise'''
+    registry = app.extensions['metrics'] = Registry()
+    app.register_blueprint(metrics)
+
+    # the start time lives on the statement's own execution context, so a statement that fails,
+    # which gets no after_cursor_execute, leaves nothing behind on the pooled connection
+    def start_query(conn, cursor, statement, parameters, context, executemany):
+        context._metrics_start = time.perf_counter()
+
+    def end_query(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - context._metrics_start
+        if has_request_context() and 'metrics_start' in g:
+            g.metrics_queries.append((statement, elapsed))
+
+    for engine in app.extensions['shard_engines']: # the main database and every shard
+        event.listen(engine, 'before_cursor_execute', start_query)
+        event.listen(engine, 'after_cursor_execute', end_query)
+
+    @app.before_request
+    def start_request():
+        g.metrics_start = time.perf_counter()
+        g.metrics_queries = []
+        g.metrics_templates = []
+        if random.random() < app.config['PROFILE_SAMPLE_RATE']:
+            g.metrics_profiler = cProfile.Profile()
+            g.metrics_profiler.enable()
+
+    @app.after_request
+    def end_request(response):
+        if 'metrics_start' not in g:
+            return response
+        elapsed = time.perf_counter() - g.metrics_start
+        endpoint = request.endpoint or 'unmatched'
+        queries = g.metrics_queries
+        sql_seconds = sum(duration for _, duration in queries)
+        registry.observe('notemaster_request_duration_seconds', (('endpoint', endpoint), ('method', request.method), ('status', response.status_code)), elapsed)
+        registry.observe('notemaster_request_sql_queries', (('endpoint', endpoint),), len(queries), COUNT_BUCKETS)
+        registry.observe('notemaster_request_sql_seconds', (('endpoint', endpoint),), sql_seconds)
+
+        repeated = [(statement, count) for statement, count in Counter(statement for statement, _ in queries).items()
+                    if count >= app.config['METRICS_N_PLUS_ONE'] and statement.lstrip().upper().startswith('SELECT')]
+        if repeated:
+            registry.inc('notemaster_n_plus_one_total', (('endpoint', endpoint),))
+            for statement, count in repeated:
+                app.logger.warning("Possible N+1 in %s: %d x %s", endpoint, count, ' '.join(statement.split())[:200])
+
+        response.headers['Server-Timing'] = 'app;dur={:.2f}, db;dur={:.2f};desc="{} queries"'.format(1000 * elapsed, 1000 * sql_seconds, len(queries))
+        profiler = g.pop('metrics_profiler', None)
+        if profiler:
+            profiler.disable()
+            _dump_profile(app, profiler, endpoint)
+            registry.inc('notemaster_profiles_total', (('endpoint', endpoint),))
+        return response
+
+    @before_render_template.connect_via(app)
+    def start_template(sender, template, context, **extra):
+        if 'metrics_templates' in g:
+            g.metrics_templates.append(time.perf_counter())
+
+    @template_rendered.connect_via(app)
+    def end_template(sender, template, context, **extra):
+        if g.get('metrics_templates'):
+            registry.observe('notemaster_template_render_seconds', (('template', template.name),), time.perf_counter() - g.metrics_templates.pop())
+
+    # blinker only keeps weak references, the app keeps the receivers alive
+    app.extensions['metrics_receivers'] = (start_template, end_template)
+
+
+def _dump_profile(app, profiler, endpoint):
+    directory = app.config['PROFILE_DIR']
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, '{}-{}-{}.prof'.format(endpoint, os.getpid(), int(time.time() * 1000)))
+    profiler.dump_stats(path) # open with `python -m pstats` or snakeviz
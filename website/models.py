@@ -4,12 +4,123 @@ from flask_login import UserMixin
 from sqlalchemy.sql import func
 
 
+MAX_NOTE_LENGTH = 100000
+INLINE_LENGTH = 1000 # longer notes keep only a preview in note.content, the full text lives in note_blob
+MAX_TAG_LENGTH = 50
+MAX_TAGS_PER_NOTE = 20
+
+
+def content_error(content):
+    '''Why `content` cannot be stored as a note, or None if it can'''
+    if not isinstance(content, str) or len(content) < 1:
+        return "Note is empty."
+    if len(content) > MAX_NOTE_LENGTH:
+        return "Note must be at most {} characters.".format(MAX_NOTE_LENGTH)
+    return None
+
+
+def tag_names(tags):
+    '''Tag names as stored: trimmed, lower case, single spaces, without duplicates'''
+    names = []
+    for tag in tags:
+        name = ' '.join(tag.split()).lower()
+        if name and name not in names:
+            names.append(name)
+    return names
+
+
+def tags_error(tags):
+    '''Why `tags` cannot be set on a note, or None if they can'''
+    if not isinstance(tags, list) or not all(isinstance(tag, str) for tag in tags):
+        return "Tags must be a list of strings."
+    names = tag_names(tags)
+    if len(names) > MAX_TAGS_PER_NOTE:
+        return "A note can have at most {} tags.".format(MAX_TAGS_PER_NOTE)
+    if any(len(name) > MAX_TAG_LENGTH for name in names):
+        return "Tags must be at most {} characters.".format(MAX_TAG_LENGTH)
+    return None
+
+
 class Note(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    content = db.Column(db.String(1000))
+    content = db.Column(db.String(INLINE_LENGTH)) # the whole note, or its preview when blob_hash is set
     date = db.Column(db.DateTime(timezone=True), default=func.now())
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     # In SQL, the User class will be represented as user table when given if foreign key
+    blob_hash = db.Column(db.String(64), index=True) # sha256 of the full text in note_blob
+    # serves the paginated listing; AUTOINCREMENT so a deleted note's id, still named by its change log, is never reused
+    __table_args__ = (db.Index('ix_note_user_date_id', 'user_id', 'date', 'id'), {'sqlite_autoincrement': True})
+    # read only, tags.py writes note_tag and the counters together; loaded with one extra query per batch of notes
+    tags = db.relationship('Tag', secondary='note_tag', lazy='selectin', viewonly=True, order_by='Tag.name')
+
+    def to_dict(self):
+        return {"id": self.id, "content": self.content, "date": self.date.isoformat() if self.date else None,
+                "truncated": self.blob_hash is not None, "tags": [tag.name for tag in self.tags]}
+
+
+class Tag(db.Model):
+    # a user's label for notes, note_count is maintained on every tag change so counts never scan note_tag
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    name = db.Column(db.String(MAX_TAG_LENGTH), nullable=False)
+    note_count = db.Column(db.Integer, nullable=False, default=0)
+    __table_args__ = (db.Index('ix_tag_user_name', 'user_id', 'name', unique=True),)
+
+
+class NoteTag(db.Model):
+    # which notes carry which tag; date is the note's, copied so a tag's notes are paged from this table's index alone
+    note_id = db.Column(db.Integer, db.ForeignKey('note.id'), primary_key=True)
+    tag_id = db.Column(db.Integer, db.ForeignKey('tag.id'), primary_key=True)
+    date = db.Column(db.DateTime(timezone=True))
+    __table_args__ = (db.Index('ix_note_tag_tag_date_note', 'tag_id', 'date', 'note_id'),)
+
+
+class NoteBlob(db.Model):
+    # compressed, content-addressed text of long notes; identical notes share one row
+    hash = db.Column(db.String(64), primary_key=True)
+    codec = db.Column(db.String(10), nullable=False) # 'zlib' or 'zstd'
+    size = db.Column(db.Integer, nullable=False) # uncompressed bytes
+    data = db.Column(db.LargeBinary, nullable=False)
+
+
+class NoteRevision(db.Model):
+    # edit history of a note: full snapshots every REVISION_SNAPSHOT_EVERY revisions, deltas against the previous one in between
+    id = db.Column(db.Integer, primary_key=True)
+    note_id = db.Column(db.Integer, nullable=False) # no foreign key, history outlives the note until purged
+    number = db.Column(db.Integer, nullable=False) # 1 is the text before the first edit
+    kind = db.Column(db.String(10), nullable=False) # 'snapshot' or 'delta'
+    codec = db.Column(db.String(10), nullable=False)
+    data = db.Column(db.LargeBinary, nullable=False) # compressed text or JSON delta
+    date = db.Column(db.DateTime(timezone=True), default=func.now())
+    __table_args__ = (db.Index('ix_note_revision_note_number', 'note_id', 'number', unique=True),)
+
+
+class NoteChange(db.Model):
+    # append-only log of note writes, seq is the version number clients sync from
+    seq = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    note_id = db.Column(db.Integer, nullable=False) # no foreign key, deleted notes keep their entries
+    op = db.Column(db.String(10), nullable=False) # 'upsert' or 'delete'
+    date = db.Column(db.DateTime(timezone=True), default=func.now())
+    __table_args__ = (db.Index('ix_note_change_user_seq', 'user_id', 'seq'), {'sqlite_autoincrement': True}) # seq never goes backwards
+
+
+class IngestCheckpoint(db.Model):
+    # bytes of a write-behind spool file already committed, updated in the same transaction as the notes
+    spool = db.Column(db.String(100), primary_key=True)
+    offset = db.Column(db.Integer, nullable=False)
+
+
+class MaintenanceRun(db.Model):
+    # one run of a maintenance job on one shard, kept in the main database; tells the runner what is due
+    id = db.Column(db.Integer, primary_key=True)
+    job = db.Column(db.String(30), nullable=False)
+    shard = db.Column(db.Integer, nullable=False, default=0)
+    started = db.Column(db.DateTime, nullable=False)
+    duration = db.Column(db.Float, nullable=False) # seconds
+    ok = db.Column(db.Boolean, nullable=False)
+    result = db.Column(db.String(200))
+    __table_args__ = (db.Index('ix_maintenance_run_job_started', 'job', 'started'),)
 
 
 class User(db.Model, UserMixin):
@@ -17,5 +128,6 @@ class User(db.Model, UserMixin):
     email = db.Column(db.String(150), unique=True) # email has maxlength 150 chars
     password = db.Column(db.String(150))
     first_name = db.Column(db.String(150))
+    shard = db.Column(db.Integer, index=True) # database holding this user's notes, None is the main one (shard 0)
     notes = db.relationship('Note') # id of every new note must be added to this field
 
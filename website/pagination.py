@@ -0,0 +1,104 @@
+import base64
+from datetime import datetime, timezone
+from sqlalchemy import and_, or_, select, func, type_coerce, types
+from .models import Note, NoteTag
+from . import db
+
+
+'''Keyset (cursor) pagination over a user's notes'''
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+def notes_page(user_id, after=None, limit=DEFAULT_PAGE_SIZE, tag_id=None, start=None, end=None):
+    '''Return one page of a user's notes (newest first) and the cursor of the next page.
+
+    `after` is the decoded cursor of the previous page, see decode_cursor. Rows are located through
+    the (user_id, date, id) index, or the (tag_id, date, note_id) one of note_tag when filtering
+    by tag, so every page costs the same no matter how deep it is. `start` (inclusive) and
+    `end` (exclusive) narrow it to a date range.
+    '''
+    limit = clamp_limit(limit)
+    return split_page(db.session.scalars(notes_page_query(user_id, after, limit, tag_id, start, end)).all(), limit)
+
+
+def clamp_limit(limit):
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def notes_page_query(user_id, after, limit, tag_id=None, start=None, end=None):
+    '''The SELECT behind notes_page, shared with the async handlers'''
+    query = select(Note).where(Note.user_id == user_id)
+    if tag_id is None:
+        date, note_id = Note.date, Note.id
+        anchor = select(Note.date).where(Note.user_id == user_id)
+    else: # walk the tag's index in note_tag and look up each note by id
+        query = query.join(NoteTag, NoteTag.note_id == Note.id).where(NoteTag.tag_id == tag_id)
+        date, note_id = NoteTag.date, NoteTag.note_id
+        anchor = select(NoteTag.date).where(NoteTag.tag_id == tag_id)
+    if start is not None:
+        query = query.where(date >= second_start(start))
+    if end is not None:
+        query = query.where(date < second_start(end))
+    if after is not None:
+        after_date, after_id = after
+        # compare against the stored date of the anchor note rather than a re-encoded value,
+        # and against the date carried by the cursor once that note is deleted or untagged
+        anchor = anchor.where(note_id == after_id).scalar_subquery()
+        if after_date is None:
+            query = query.where(or_(date < anchor, and_(date == anchor, note_id < after_id)))
+        else:
+            # notes from the cursor's second may be stored with or without a fraction: everything
+            # below the lower bound is older, and between the bounds the id decides
+            lower, upper = func.coalesce(anchor, second_start(after_date)), func.coalesce(anchor, after_date)
+            query = query.where(or_(date < lower, and_(date <= upper, note_id < after_id)))
+    return query.order_by(date.desc(), note_id.desc()).limit(limit + 1) # one extra row tells us if there is a next page
+
+
+class _SecondStart(types.TypeDecorator):
+    '''A whole-second datetime bound the way SQLite compares it with stored dates'''
+    impl = types.DateTime
+    cache_ok = True
+
+    def load_dialect_impl(self, dialect):
+        return dialect.type_descriptor(types.String() if dialect.name == 'sqlite' else types.DateTime())
+
+    def process_bind_param(self, value, dialect):
+        return value.strftime('%Y-%m-%d %H:%M:%S') if dialect.name == 'sqlite' else value
+
+
+def second_start(value):
+    '''`value` for comparisons with note dates. SQLite stores dates as text, 'YYYY-MM-DD HH:MM:SS'
+    from func.now() and with a '.ffffff' fraction from Python, so a whole second is bound without
+    the fraction, which sorts before both spellings of it.'''
+    return type_coerce(value, _SecondStart()) if value.microsecond == 0 else value
+
+
+def date_bound(value):
+    '''A ?from= or ?to= value (ISO 8601 date or time) as the naive UTC datetime notes are stored with'''
+    if not value:
+        return None
+    bound = datetime.fromisoformat(value) # ValueError when malformed
+    if bound.tzinfo is not None:
+        bound = bound.astimezone(timezone.utc).replace(tzinfo=None)
+    return bound
+
+
+def encode_cursor(note):
+    '''Opaque cursor holding the date and id of the last note of a page'''
+    raw = '{}|{}'.format(note.date.isoformat() if note.date else '', note.id)
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(value):
+    '''(date, id) from a cursor, ValueError when malformed; a bare id from an older client gives (None, id)'''
+    if value.isdigit():
+        return None, int(value)
+    date, note_id = base64.urlsafe_b64decode(value + '=' * (-len(value) % 4)).decode().rsplit('|', 1)
+    return (datetime.fromisoformat(date) if date else None), int(note_id)
+
+
+def split_page(notes, limit):
+    next_cursor = encode_cursor(notes[limit - 1]) if len(notes) > limit else None
+    return notes[:limit], next_cursor
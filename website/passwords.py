@@ -0,0 +1,121 @@
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from threading import BoundedSemaphore, Lock
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+'''Password hashing off the request thread, in a bounded process pool'''
+
+
+class HashingBusy(Exception):
+    '''Raised when too many hashes are already queued, or one takes longer than the timeout;
+    the caller should answer 503'''
+
+
+def _hash(password, method):
+    return generate_password_hash(password, method=method)
+
+
+def _verify(stored, password, method):
+    # runs in a pool process: verification and the optional upgrade cost a single round trip
+    if not check_password_hash(stored, password):
+        return False, None
+    if stored.split('$', 1)[0] != _method_prefix(method):
+        return True, generate_password_hash(password, method=method)
+    return True, None
+
+
+_prefixes = {}
+
+
+def _method_prefix(method):
+    '''The "pbkdf2:sha256:1000000" part werkzeug writes for a method, with its default costs filled in'''
+    if method not in _prefixes:
+        _prefixes[method] = generate_password_hash('', method=method).split('$', 1)[0]
+    return _prefixes[method]
+
+
+class PasswordHasher:
+    '''Hashes and verifies passwords with `workers` processes and at most `queue_size` pending jobs.
+
+    With workers=0 the work runs inline, which is what tests and the dev server use.
+    '''
+
+    def __init__(self, method='pbkdf2:sha256', workers=2, queue_size=32, timeout=10):
+        self.method = method
+        self.workers = workers
+        self.timeout = timeout
+        self._slots = BoundedSemaphore(queue_size)
+        self._executor = None
+        self._pid = None
+        self._lock = Lock()
+        self._stats = {'hashes': 0, 'verifications': 0, 'rehashes': 0, 'rejected': 0, 'timeouts': 0, 'total_seconds': 0.0, 'max_seconds': 0.0}
+
+    def hash(self, password):
+        return self._run(_hash, password, self.method)
+
+    def verify(self, stored, password):
+        '''Return (matches, new_hash); new_hash is set when the stored hash uses an outdated method or cost'''
+        ok, new_hash = self._run(_verify, stored, password, self.method)
+        if new_hash:
+            self._count('rehashes')
+        return ok, new_hash
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        calls = stats['hashes'] + stats['verifications']
+        stats['mean_seconds'] = stats['total_seconds'] / calls if calls else 0.0
+        return stats
+
+    def _run(self, func, *args):
+        if not self._slots.acquire(blocking=False):
+            self._count('rejected')
+            raise HashingBusy()
+        start = time.perf_counter()
+        if self.workers:
+            try:
+                future = self._pool().submit(func, *args)
+            except BaseException:
+                self._slots.release()
+                raise
+            # the slot stays taken until the job is really done, even if we stop waiting for it
+            future.add_done_callback(lambda future: self._slots.release())
+            try:
+                result = future.result(timeout=self.timeout)
+            except FutureTimeout:
+                future.cancel() # only helps while it is still queued
+                self._count('timeouts')
+                raise HashingBusy()
+        else:
+            try:
+                result = func(*args)
+            finally:
+                self._slots.release()
+        elapsed = time.perf_counter() - start # includes time spent waiting for a free process
+        with self._lock:
+            self._stats['hashes' if func is _hash else 'verifications'] += 1
+            self._stats['total_seconds'] += elapsed
+            self._stats['max_seconds'] = max(self._stats['max_seconds'], elapsed)
+        return result
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid(): # a forked worker needs its own processes
+                # forking this threaded process could copy a lock some other thread holds into the child
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('forkserver'))
+                self._pid = os.getpid()
+            return self._executor
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+
+def init_password_hasher(app):
+    app.extensions['password_hasher'] = PasswordHasher(method=app.config['PASSWORD_HASH_METHOD'],
+                                                       workers=app.config['PASSWORD_HASH_WORKERS'],
+                                                       queue_size=app.config['PASSWORD_HASH_QUEUE'],
+                                                       timeout=app.config['PASSWORD_HASH_TIMEOUT'])
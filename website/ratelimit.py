@@ -0,0 +1,123 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import current_app, request
+from flask_login import current_user
+from werkzeug.exceptions import TooManyRequests
+
+
+'''Rate limiting, checked before any query or password hash is spent on a request.
+
+A rule is a (limit, period) pair from the config, e.g. RATELIMIT_LOGIN_EMAIL = (5, 60) allows
+bursts of 5 attempts per email and refills one every 12 seconds. Counters live in this process
+(MemoryStore, token buckets) or, when RATELIMIT_STORAGE_URL points at Redis, are shared by every
+worker (RedisStore, sliding windows).
+'''
+
+
+class MemoryStore:
+    '''Token buckets in a bounded LRU, the least recently hit keys are forgotten first'''
+
+    blocking = False # hit() never waits on I/O
+
+    def __init__(self, maxsize=100000, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict() # key -> (tokens, time of last update)
+
+    def hit(self, key, limit, period):
+        '''Take a token for `key`; returns 0 if allowed, otherwise the seconds until one is available'''
+        now = self.clock()
+        rate = limit / period
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (limit, now))
+            tokens = min(limit, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        return 0 if allowed else (1 - tokens) / rate
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class RedisStore:
+    '''Sliding window counters in Redis (needs the `redis` package): the previous window's count
+    is weighted by how much of it still overlaps the last `period` seconds'''
+
+    blocking = True # a round trip to Redis, async callers run hit() in a thread
+
+    def __init__(self, url, prefix='notemaster:rl:', clock=time.time):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.clock = clock
+
+    def hit(self, key, limit, period):
+        now = self.clock()
+        window = int(now // period)
+        current_key = '{}{}:{}'.format(self.prefix, key, window)
+        pipe = self.client.pipeline()
+        pipe.incr(current_key)
+        pipe.expire(current_key, period * 2)
+        pipe.get('{}{}:{}'.format(self.prefix, key, window - 1))
+        current, _, previous = pipe.execute()
+        elapsed = now - window * period
+        estimate = int(previous or 0) * (period - elapsed) / period + current
+        if estimate <= limit:
+            return 0
+        return period - elapsed
+
+
+def make_store(config):
+    if config.get('RATELIMIT_STORAGE_URL'):
+        return RedisStore(config['RATELIMIT_STORAGE_URL'])
+    return MemoryStore()
+
+
+def init_rate_limiter(app):
+    app.extensions['rate_limiter'] = make_store(app.config)
+
+
+def retry_after(app, name, key):
+    '''Take a token of rule `name` for `key`; 0 if allowed, otherwise the seconds to wait'''
+    limit, period = app.config[name]
+    return app.extensions['rate_limiter'].hit('{}:{}'.format(name, key), limit, period)
+
+
+def by_ip():
+    return request.remote_addr # the client's address behind a proxy when PROXY_FIX_HOPS is set
+
+
+def by_email():
+    email = request.form.get('email')
+    return email.strip().lower() if email else None
+
+
+def by_user():
+    return str(current_user.id) if current_user.is_authenticated else None
+
+
+def rate_limit(*rules, methods=('POST', 'PATCH', 'DELETE')):
+    '''Decorator: answer 429 with Retry-After when any (config key, key function) rule is used up'''
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method in methods and current_app.config['RATELIMIT_ENABLED']:
+                for name, key_func in rules:
+                    key = key_func()
+                    if key is None:
+                        continue
+                    wait = retry_after(current_app, name, key)
+                    if wait:
+                        raise TooManyRequests(retry_after=math.ceil(wait))
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
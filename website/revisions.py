@@ -0,0 +1,124 @@
+import json
+from difflib import SequenceMatcher
+from flask import current_app
+from sqlalchemy import select, insert, delete, func, case
+from .models import Note, NoteRevision, INLINE_LENGTH
+from .storage import CODEC, compress, decompress, full_contents
+from . import db
+
+
+'''Revision history of edited notes.
+
+Only edits are recorded: the first one logs the old text as revision 1, so notes that are never
+edited cost nothing. Each revision is stored as a delta against the previous one; every
+REVISION_SNAPSHOT_EVERY revisions, or when the delta would not be smaller, a full snapshot is
+stored instead, so materializing any revision applies fewer than that many deltas.
+
+A delta is a JSON list: a positive int copies that many characters of the old text, a negative
+int skips them, a string is inserted.
+'''
+
+
+def make_delta(old, new):
+    # characters for short notes, lines for long ones so SequenceMatcher stays cheap
+    by_line = max(len(old), len(new)) > INLINE_LENGTH
+    a, b = (old.splitlines(True), new.splitlines(True)) if by_line else (old, new)
+    ops = []
+    for tag, i1, i2, j1, j2 in SequenceMatcher(None, a, b, autojunk=False).get_opcodes():
+        if tag == 'equal':
+            ops.append(len(''.join(a[i1:i2])))
+            continue
+        if i2 > i1:
+            ops.append(-len(''.join(a[i1:i2])))
+        if j2 > j1:
+            ops.append(''.join(b[j1:j2]))
+    return ops
+
+
+def apply_delta(old, ops):
+    parts, pos = [], 0
+    for op in ops:
+        if isinstance(op, str):
+            parts.append(op)
+        elif op > 0:
+            parts.append(old[pos:pos + op])
+            pos += op
+        else:
+            pos -= op
+    return ''.join(parts)
+
+
+def record_revisions(notes, contents):
+    '''Log edits of `notes`, loaded before the edit, to the new text in `contents` keyed by note id;
+    call it inside the transaction that makes them'''
+    old = full_contents(notes)
+    notes = [note for note in notes if contents[note.id] != old[note.id]]
+    if not notes:
+        return
+    every = current_app.config.get('REVISION_SNAPSHOT_EVERY', 20)
+    latest = {row.note_id: row for row in db.session.execute(
+        select(NoteRevision.note_id, func.max(NoteRevision.number).label('number'),
+               func.max(case((NoteRevision.kind == 'snapshot', NoteRevision.number))).label('snapshot'))
+        .where(NoteRevision.note_id.in_([note.id for note in notes]))
+        .group_by(NoteRevision.note_id)
+    )}
+    rows = []
+    for note in notes:
+        if note.id in latest:
+            number, snapshot = latest[note.id].number + 1, latest[note.id].snapshot
+        else: # first edit, keep the original text
+            rows.append(_revision_row(note.id, 1, 'snapshot', old[note.id], note.date))
+            number, snapshot = 2, 1
+        delta = json.dumps(make_delta(old[note.id], contents[note.id]), separators=(',', ':'))
+        if number - snapshot >= every or len(delta) >= len(contents[note.id]):
+            rows.append(_revision_row(note.id, number, 'snapshot', contents[note.id]))
+        else:
+            rows.append(_revision_row(note.id, number, 'delta', delta))
+    db.session.execute(insert(NoteRevision), rows)
+
+
+def _revision_row(note_id, number, kind, text, date=None):
+    row = {"note_id": note_id, "number": number, "kind": kind, "codec": CODEC, "data": compress(text.encode('utf-8'))}
+    if date is not None:
+        row["date"] = date
+    return row
+
+
+def list_revisions(note_id):
+    '''Revisions of a note, newest first'''
+    rows = db.session.execute(
+        select(NoteRevision.number, NoteRevision.kind, NoteRevision.date)
+        .where(NoteRevision.note_id == note_id).order_by(NoteRevision.number.desc())
+    ).all()
+    return [{"number": row.number, "kind": row.kind, "date": row.date.isoformat() if row.date else None} for row in rows]
+
+
+def materialize(note_id, number):
+    '''(text, date) of revision `number` of a note, or None if there is no such revision'''
+    start = (select(func.max(NoteRevision.number))
+             .where(NoteRevision.note_id == note_id, NoteRevision.number <= number, NoteRevision.kind == 'snapshot')
+             .scalar_subquery())
+    revisions = NoteRevision.query.filter(NoteRevision.note_id == note_id, NoteRevision.number >= start,
+                                          NoteRevision.number <= number).order_by(NoteRevision.number).all()
+    if not revisions or revisions[-1].number != number:
+        return None
+    text = None
+    for revision in revisions: # a snapshot, then at most REVISION_SNAPSHOT_EVERY - 1 deltas
+        payload = decompress(revision.codec, revision.data)
+        text = payload if revision.kind == 'snapshot' else apply_delta(text, json.loads(payload))
+    return text, revisions[-1].date
+
+
+def drop_revisions(note_ids, session=None):
+    '''Delete the history of deleted notes; call it in the transaction deleting them, so a new note
+    that gets a reused id never shows someone else's text. Also takes a sync session from run_sync.'''
+    session = session or db.session
+    if note_ids:
+        session.execute(delete(NoteRevision).where(NoteRevision.note_id.in_(note_ids)))
+
+
+def purge_orphan_revisions():
+    '''Delete the history of notes that no longer exist (left by older versions); returns how many revisions'''
+    result = db.session.execute(delete(NoteRevision).where(NoteRevision.note_id.not_in(select(Note.id))))
+    db.session.commit()
+    return result.rowcount
@@ -0,0 +1,110 @@
+from markupsafe import escape
+from sqlalchemy import event, text
+from sqlalchemy.engine import Engine
+from .models import Note
+from .storage import decompress
+from . import db
+
+
+'''Full-text search over notes, backed by an SQLite FTS5 index'''
+
+# the complete text of a note: long notes only keep a preview in note.content, the rest is in their
+# compressed blob, which note_decompress() (registered on every SQLite connection below) unpacks
+FULL_TEXT = "CASE WHEN {0}.blob_hash IS NULL THEN {0}.content ELSE (SELECT note_decompress(codec, data) FROM note_blob WHERE hash = {0}.blob_hash) END"
+
+# external-content FTS5 table: the text comes from the note_text view, the index only stores postings
+SEARCH_DDL = [
+    "CREATE VIEW IF NOT EXISTS note_text AS SELECT id, {} AS content FROM note".format(FULL_TEXT.format('note')),
+    "CREATE VIRTUAL TABLE IF NOT EXISTS note_fts USING fts5(content, content='note_text', content_rowid='id', tokenize='porter unicode61')",
+    # triggers keep the index in sync with every write path, including bulk SQL from the API; blobs
+    # are written before the notes pointing at them and purged only once no note does
+    """CREATE TRIGGER IF NOT EXISTS note_fts_ai AFTER INSERT ON note BEGIN
+        INSERT INTO note_fts(rowid, content) VALUES (new.id, {new});
+    END""".format(new=FULL_TEXT.format('new')),
+    """CREATE TRIGGER IF NOT EXISTS note_fts_ad AFTER DELETE ON note BEGIN
+        INSERT INTO note_fts(note_fts, rowid, content) VALUES ('delete', old.id, {old});
+    END""".format(old=FULL_TEXT.format('old')),
+    """CREATE TRIGGER IF NOT EXISTS note_fts_au AFTER UPDATE OF content, blob_hash ON note BEGIN
+        INSERT INTO note_fts(note_fts, rowid, content) VALUES ('delete', old.id, {old});
+        INSERT INTO note_fts(rowid, content) VALUES (new.id, {new});
+    END""".format(old=FULL_TEXT.format('old'), new=FULL_TEXT.format('new')),
+]
+SEARCH_TRIGGERS = ('note_fts_ai', 'note_fts_ad', 'note_fts_au')
+
+SEARCH_SQL = text("""
+    SELECT note.id, note.date, snippet(note_fts, 0, :open, :close, '...', 16) AS snippet
+    FROM note_fts JOIN note ON note.id = note_fts.rowid
+    WHERE note_fts MATCH :query AND note.user_id = :user_id
+    ORDER BY bm25(note_fts)
+    LIMIT :limit OFFSET :offset
+""")
+
+# control characters that cannot come from a form field, swapped for <mark> after escaping
+MARK_OPEN, MARK_CLOSE = '\x02', '\x03'
+
+
+def install_search_index(connection):
+    '''Create the FTS table and its triggers if missing; index existing notes the first time'''
+    if connection.dialect.name != 'sqlite':
+        return
+    tables = dict(connection.execute(text("SELECT name, sql FROM sqlite_master WHERE type = 'table'")).all())
+    if 'note' not in tables:
+        return
+    if 'note_fts' in tables and "content='note_text'" not in tables['note_fts']:
+        # an index of note.content, which misses all but the preview of long notes: start over
+        for trigger in SEARCH_TRIGGERS:
+            connection.execute(text('DROP TRIGGER IF EXISTS {}'.format(trigger)))
+        connection.execute(text('DROP TABLE note_fts'))
+        del tables['note_fts']
+    for statement in SEARCH_DDL:
+        connection.execute(text(statement))
+    if 'note_fts' not in tables:
+        connection.execute(text("INSERT INTO note_fts(note_fts) VALUES ('rebuild')"))
+
+
+def match_query(terms):
+    '''Turn free text into a safe FTS5 query: every word quoted, the last one prefix-matched'''
+    words = ['"{}"'.format(word.replace('"', '""')) for word in terms.split()]
+    if words:
+        words[-1] += '*'
+    return ' '.join(words)
+
+
+def search_notes(user_id, terms, limit=20, offset=0):
+    '''Return ranked matches as dicts with an HTML-safe highlighted snippet, and the next offset'''
+    query = match_query(terms)
+    if not query:
+        return [], None
+    if db.engine.dialect.name != 'sqlite':
+        return _search_like(user_id, terms, limit, offset)
+    rows = db.session.execute(SEARCH_SQL, {"open": MARK_OPEN, "close": MARK_CLOSE, "query": query,
+                                           "user_id": user_id, "limit": limit + 1, "offset": offset}).all()
+    results = [{"id": row.id, "date": str(row.date), "snippet": _highlight(row.snippet)} for row in rows[:limit]]
+    return results, offset + limit if len(rows) > limit else None
+
+
+def _highlight(snippet):
+    return str(escape(snippet)).replace(MARK_OPEN, '<mark>').replace(MARK_CLOSE, '</mark>')
+
+
+def _search_like(user_id, terms, limit, offset):
+    # other databases: unranked substring match, good enough until they get their own index
+    notes = (Note.query.filter(Note.user_id == user_id, Note.content.ilike('%{}%'.format(terms)))
+             .order_by(Note.date.desc(), Note.id.desc()).limit(limit + 1).offset(offset).all())
+    results = [{"id": note.id, "date": str(note.date), "snippet": str(escape(note.content))} for note in notes[:limit]]
+    return results, offset + limit if len(notes) > limit else None
+
+
+@event.listens_for(Note.__table__, 'after_create')
+def _create_search_index(target, connection, **kw):
+    install_search_index(connection)
+
+
+@event.listens_for(Engine, 'connect')
+def _register_functions(dbapi_connection, connection_record):
+    if hasattr(dbapi_connection, 'create_function'): # sqlite3, and SQLAlchemy's aiosqlite adapter
+        dbapi_connection.create_function('note_decompress', 2, _decompress_text, deterministic=True)
+
+
+def _decompress_text(codec, data):
+    return None if data is None else decompress(codec, data)
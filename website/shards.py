@@ -0,0 +1,213 @@
+from contextlib import contextmanager
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import select, insert, delete, func, text
+from .models import User, Note, NoteBlob, NoteChange, NoteRevision, Tag, NoteTag
+from .changes import notes_version
+from .storage import save_blobs, purge_orphan_blobs
+from . import db
+
+
+'''Sharding of notes by user.
+
+The user table in the main database is the directory: User.shard names the database holding a
+user's notes, change log, revisions and blobs. Shard 0 is the main database, shards 1..N come from
+SHARD_DATABASE_URLS and hold the note tables only (database.shard_metadata). ShardSession (database.py) sends note statements to the shard chosen with
+use_shard(), which the user loader does on every request.
+
+Moving a user copies their rows to the new shard, switches the directory, then deletes the old
+rows. Workers keep a cached user (and so its shard) for up to USER_CACHE_TTL seconds, so move
+users with a shared CACHE_URL, which is invalidated at once, or while the app is stopped.
+'''
+
+
+def shard_count():
+    return 1 + len(current_app.config['SHARD_DATABASE_URIS'])
+
+
+def use_shard(shard):
+    db.session.info['shard'] = shard or 0
+
+
+@contextmanager
+def using_shard(shard):
+    '''Run note statements on `shard` for code serving several users; commit before leaving'''
+    previous = db.session.info.get('shard')
+    use_shard(shard)
+    try:
+        yield
+    finally:
+        db.session.expunge_all() # the same primary key is another note on another shard
+        db.session.info['shard'] = previous
+
+
+def user_shards(user_ids):
+    '''{user id: shard} from the directory'''
+    if not user_ids:
+        return {}
+    return {user_id: shard or 0 for user_id, shard in db.session.execute(
+        select(User.id, User.shard).where(User.id.in_(user_ids)))}
+
+
+def choose_shard():
+    '''Shard for a new user: the one with the fewest users'''
+    if shard_count() == 1:
+        return 0
+    shard = func.coalesce(User.shard, 0)
+    counts = dict(db.session.execute(select(shard, func.count()).group_by(shard)).all())
+    return min(range(shard_count()), key=lambda n: counts.get(n, 0))
+
+
+def shard_loads():
+    '''{shard: {user id: number of notes}}'''
+    loads = {}
+    for shard in range(shard_count()):
+        with using_shard(shard):
+            loads[shard] = dict(db.session.execute(select(Note.user_id, func.count()).group_by(Note.user_id)).all())
+            db.session.rollback()
+    return loads
+
+
+def move_user(user_id, target, attempts=3):
+    '''Move a user's notes to shard `target`; returns how many notes moved'''
+    if not 0 <= target < shard_count():
+        raise ValueError("No shard {}.".format(target))
+    user = db.session.get(User, user_id)
+    if user is None:
+        raise ValueError("No user {}.".format(user_id))
+    source = user.shard or 0
+    if source == target:
+        return 0
+    for _ in range(attempts):
+        with using_shard(source):
+            rows = _user_rows(user_id)
+            db.session.rollback()
+        with using_shard(target):
+            _delete_user_rows(user_id) # leftovers of an interrupted move
+            _copy_user_rows(user_id, rows)
+            db.session.commit()
+        with using_shard(source):
+            changed = notes_version(user_id) != rows["version"]
+            db.session.rollback()
+        if not changed:
+            break
+        with using_shard(target): # written to meanwhile, copy again
+            _delete_user_rows(user_id)
+            db.session.commit()
+    else:
+        raise RuntimeError("User {} kept writing during the move, try again later.".format(user_id))
+    db.session.get(User, user_id).shard = target
+    db.session.commit()
+    with using_shard(source):
+        _delete_user_rows(user_id)
+        db.session.commit()
+        purge_orphan_blobs()
+    return len(rows["notes"])
+
+
+def _user_rows(user_id):
+    note_ids = select(Note.id).where(Note.user_id == user_id)
+    notes = [dict(row) for row in db.session.execute(
+        select(Note.__table__).where(Note.user_id == user_id).order_by(Note.id)).mappings()]
+    hashes = select(Note.blob_hash).where(Note.user_id == user_id, Note.blob_hash.is_not(None))
+    return {
+        "version": notes_version(user_id),
+        "notes": notes,
+        "blobs": [dict(row) for row in db.session.execute(select(NoteBlob.__table__).where(NoteBlob.hash.in_(hashes))).mappings()],
+        "revisions": [dict(row) for row in db.session.execute(
+            select(NoteRevision.__table__).where(NoteRevision.note_id.in_(note_ids))).mappings()],
+        "tags": [dict(row) for row in db.session.execute(select(Tag.__table__).where(Tag.user_id == user_id)).mappings()],
+        "note_tags": [dict(row) for row in db.session.execute(
+            select(NoteTag.__table__).where(NoteTag.note_id.in_(note_ids))).mappings()],
+    }
+
+
+def _copy_user_rows(user_id, rows):
+    '''Insert a user's rows under new ids, and log the move so synced clients swap old ids for new'''
+    save_blobs(rows["blobs"])
+    new_ids = {}
+    if rows["notes"]:
+        created = db.session.execute(insert(Note).returning(Note.id, sort_by_parameter_order=True),
+                                     [{k: v for k, v in note.items() if k != "id"} for note in rows["notes"]])
+        new_ids = dict(zip([note["id"] for note in rows["notes"]], created.scalars()))
+    if rows["revisions"]:
+        db.session.execute(insert(NoteRevision), [dict({k: v for k, v in revision.items() if k != "id"},
+                                                       note_id=new_ids[revision["note_id"]]) for revision in rows["revisions"]])
+    if rows["tags"]:
+        created = db.session.execute(insert(Tag).returning(Tag.id, sort_by_parameter_order=True),
+                                     [{k: v for k, v in tag.items() if k != "id"} for tag in rows["tags"]])
+        tag_ids = dict(zip([tag["id"] for tag in rows["tags"]], created.scalars()))
+        if rows["note_tags"]: # counters come along with the tags, they stay right
+            db.session.execute(insert(NoteTag), [dict(note_tag, note_id=new_ids[note_tag["note_id"]], tag_id=tag_ids[note_tag["tag_id"]])
+                                                 for note_tag in rows["note_tags"]])
+    # seqs continue above the old shard's, so clients resuming from their version miss nothing
+    seq = max(rows["version"], db.session.scalar(select(func.max(NoteChange.seq))) or 0) + 1
+    changes = [(old_id, "delete") for old_id in new_ids] + [(new_id, "upsert") for new_id in new_ids.values()]
+    if changes:
+        db.session.execute(insert(NoteChange), [{"seq": seq + i, "user_id": user_id, "note_id": note_id, "op": op}
+                                                for i, (note_id, op) in enumerate(changes)])
+        if db.engine.dialect.name == 'postgresql':
+            db.session.execute(text("SELECT setval(pg_get_serial_sequence('note_change', 'seq'), (SELECT max(seq) FROM note_change))"))
+
+
+def _delete_user_rows(user_id):
+    note_ids = select(Note.id).where(Note.user_id == user_id)
+    db.session.execute(delete(NoteRevision).where(NoteRevision.note_id.in_(note_ids)))
+    db.session.execute(delete(NoteTag).where(NoteTag.note_id.in_(note_ids)))
+    db.session.execute(delete(Tag).where(Tag.user_id == user_id))
+    db.session.execute(delete(NoteChange).where(NoteChange.user_id == user_id))
+    db.session.execute(delete(Note).where(Note.user_id == user_id))
+
+
+def rebalance(tolerance=0.1, dry_run=False):
+    '''Move users from the fullest to the emptiest shard until their note counts are within
+    `tolerance` of each other; returns the moves as (user id, from, to, notes)'''
+    loads = shard_loads()
+    totals = {shard: sum(users.values()) for shard, users in loads.items()}
+    moves = []
+    while True:
+        high, low = max(totals, key=totals.get), min(totals, key=totals.get)
+        gap = totals[high] - totals[low]
+        if gap <= tolerance * totals[high]:
+            break
+        # the biggest user that still narrows the gap
+        candidates = [(notes, user_id) for user_id, notes in loads[high].items() if notes * 2 <= gap]
+        if not candidates:
+            break
+        notes, user_id = max(candidates)
+        moves.append((user_id, high, low, notes))
+        loads[low][user_id] = loads[high].pop(user_id)
+        totals[high] -= notes
+        totals[low] += notes
+    if not dry_run:
+        for user_id, _, target, _ in moves:
+            move_user(user_id, target)
+    return moves
+
+
+shards_cli = AppGroup('shards', help='Inspect and rebalance the note shards.')
+
+
+@shards_cli.command('status')
+def status_command():
+    '''Users and notes on every shard'''
+    for shard, users in shard_loads().items():
+        click.echo('shard {}: {} users, {} notes'.format(shard, len(users), sum(users.values())))
+
+
+@shards_cli.command('move')
+@click.argument('user_id', type=int)
+@click.argument('shard', type=int)
+def move_command(user_id, shard):
+    '''Move USER_ID's notes to SHARD'''
+    click.echo('moved {} notes'.format(move_user(user_id, shard)))
+
+
+@shards_cli.command('rebalance')
+@click.option('--tolerance', default=0.1, help='Acceptable difference between shards, as a share of the fullest.')
+@click.option('--dry-run', is_flag=True, help='Only print the moves.')
+def rebalance_command(tolerance, dry_run):
+    '''Even out the number of notes on each shard'''
+    for user_id, source, target, notes in rebalance(tolerance, dry_run):
+        click.echo('user {}: shard {} -> {} ({} notes)'.format(user_id, source, target, notes))
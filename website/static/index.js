@@ -1,10 +1,177 @@
+function notesList()
+{
+    return document.getElementById("notes");
+}
+
+// resolves to the response body, or to null once a refused request is shown to the user
+function sendNotes(method, body)
+{
+    return fetch("/api/notes", {
+        method: method,
+        headers: { "Content-Type": "application/json" },
+        body: JSON.stringify(body),
+    }).then((res) => res.json().catch(() => ({})).then((data) => {
+        if (res.ok) return data;
+        let message = data.error || "Your notes could not be saved.";
+        const wait = res.headers.get("Retry-After");
+        if (res.status === 429 && wait) message += " Try again in " + wait + " seconds.";
+        showError(message);
+        return null;
+    }));
+}
+
+function showError(message)
+{
+    const alert = document.createElement("div");
+    alert.className = "alert alert-danger alert-dismissable fade show";
+    alert.setAttribute("role", "alert");
+    alert.textContent = message;
+    document.querySelector(".container").prepend(alert);
+}
+
+function preview(note)
+{
+    return note.truncated ? note.content + "\u2026" : note.content;
+}
+
+function showTags(item, note)
+{
+    const tags = item.querySelector(".note-tags");
+    tags.textContent = "";
+    note.tags.forEach((name) => {
+        const badge = document.createElement("a");
+        badge.className = "badge badge-secondary ml-1";
+        badge.href = "/?tag=" + encodeURIComponent(name);
+        badge.textContent = name;
+        tags.appendChild(badge);
+    });
+}
+
+function noteItem(note)
+{
+    const item = document.createElement("li");
+    item.className = "list-group-item";
+    item.dataset.id = note.id;
+    item.innerHTML =
+        '<span class="note-content"></span><span class="note-tags"></span>' +
+        '<button type="button" class="close"><span aria-hidden="true">&times;</span></button>' +
+        '<button type="button" class="close mr-2"><span aria-hidden="true" class="fa fa-pencil"></span></button>';
+    item.querySelector(".note-content").textContent = preview(note);
+    showTags(item, note);
+    const buttons = item.querySelectorAll("button");
+    buttons[0].onclick = () => deleteNote(note.id);
+    buttons[1].onclick = () => editNote(note.id);
+    return item;
+}
+
+function applyChange(list, change)
+{
+    const item = list.querySelector('[data-id="' + change.id + '"]');
+    const tag = list.dataset.tag;
+    if (change.op === "delete" || (tag && !change.note.tags.includes(tag))) {
+        if (item) item.remove(); // gone, or no longer in this filtered list
+    } else if (item) {
+        item.querySelector(".note-content").textContent = preview(change.note);
+        showTags(item, change.note);
+    } else if (list.dataset.firstPage === "true") {
+        list.prepend(noteItem(change.note)); // newest first, older pages never gain new notes
+    }
+}
+
+// apply the notes changed since our version, only what changed crosses the wire
+function syncNotes()
+{
+    const list = notesList();
+    if (!list) return Promise.resolve();
+    const version = list.dataset.version;
+    return fetch("/api/notes/changes?since=" + version, {
+        headers: { "If-None-Match": '"v' + version + '"' },
+    }).then((res) => {
+        if (res.status === 304 || !res.ok) return;
+        return res.json().then((data) => {
+            data.changes.forEach((change) => applyChange(list, change));
+            list.dataset.version = data.version;
+        });
+    });
+}
+
+// changes pushed by the server as they are committed, from any tab or device
+function listenForChanges()
+{
+    const list = notesList();
+    if (!list || !window.EventSource) return false;
+    const source = new EventSource("/api/notes/events?since=" + list.dataset.version);
+    const onChange = (event) => {
+        const change = JSON.parse(event.data);
+        if (change.seq <= Number(list.dataset.version)) return; // already applied by syncNotes
+        applyChange(list, change);
+        list.dataset.version = change.seq;
+    };
+    source.addEventListener("upsert", onChange);
+    source.addEventListener("delete", onChange);
+    source.addEventListener("error", () => {
+        if (source.readyState !== EventSource.CLOSED) return; // the browser reconnects by itself
+        live = false; // refused, the server has no thread to spare for us
+        syncWhenShown();
+        syncNotes();
+    });
+    return true;
+}
+
+// no push, pick up changes made in other tabs when coming back to this one
+function syncWhenShown()
+{
+    document.addEventListener("visibilitychange", () => {
+        if (document.visibilityState === "visible") syncNotes();
+    });
+}
+
+function addNote(event)
+{
+    event.preventDefault();
+    const textarea = document.getElementById("note");
+    const tags = document.getElementById("tags").value.split(",").filter((tag) => tag.trim());
+    sendNotes("POST", { notes: [{ content: textarea.value, tags: tags }] }).then((data) => {
+        if (!data) return; // keep the text so it can be sent again
+        const result = data.create[0];
+        if (result.status === "error") {
+            showError(result.error);
+            return;
+        }
+        textarea.value = "";
+        if (result.status === "queued") {
+            if (!live) setTimeout(syncNotes, 250); // written by the next group commit
+            return;
+        }
+        return syncNotes();
+    });
+}
+
 function deleteNote(noteId)
 {
-    fetch('/delete-note', {
-        method: "POST",
-        body: JSON.stringify({ noteId: noteId}),
-    }).then((_res) => {
-        window.location.href = "/";
+    sendNotes("DELETE", { ids: [noteId] }).then((data) => data && syncNotes());
+}
 
+function editNote(noteId)
+{
+    // the list may only hold a preview, edit the full text
+    fetch("/api/notes/" + noteId).then((res) => res.json()).then((note) => {
+        const content = window.prompt("Edit note", note.content);
+        if (content === null) return;
+        return sendNotes("PATCH", { notes: [{ id: noteId, content: content }] }).then((data) => {
+            if (!data) return;
+            const result = data.update[0];
+            if (result.status === "error") showError(result.error);
+            return syncNotes();
+        });
     });
-}
\ No newline at end of file
+}
+
+let live = false;
+
+document.addEventListener("DOMContentLoaded", () => {
+    const form = document.getElementById("note-form");
+    if (form) form.addEventListener("submit", addNote);
+    live = listenForChanges();
+    if (!live) syncWhenShown();
+});
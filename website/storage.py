@@ -0,0 +1,85 @@
+import zlib
+from hashlib import sha256
+from sqlalchemy import select, delete
+from .models import Note, NoteBlob, INLINE_LENGTH
+from .database import insert_ignore
+from . import db
+
+try:
+    import zstandard
+except ImportError: # optional, zlib is always there
+    zstandard = None
+
+
+'''Storage tier for long notes: compressed, deduplicated blobs plus a short inline preview'''
+
+PREVIEW_LENGTH = 280
+CODEC = 'zstd' if zstandard else 'zlib'
+
+
+def split_content(content):
+    '''Return (note column values, note_blob row or None) for storing `content`'''
+    if len(content) <= INLINE_LENGTH:
+        return {"content": content, "blob_hash": None}, None
+    data = content.encode('utf-8')
+    digest = sha256(data).hexdigest()
+    blob = {"hash": digest, "codec": CODEC, "size": len(data), "data": compress(data)}
+    return {"content": content[:PREVIEW_LENGTH], "blob_hash": digest}, blob
+
+
+def prepare_rows(rows):
+    '''Split the "content" of note rows for storage; returns (rows to write, blobs to save first)'''
+    prepared, blobs = [], []
+    for row in rows:
+        values, blob = split_content(row["content"])
+        prepared.append(dict(row, **values))
+        if blob:
+            blobs.append(blob)
+    return prepared, blobs
+
+
+def compress(data):
+    if CODEC == 'zstd':
+        return zstandard.ZstdCompressor(level=6).compress(data)
+    return zlib.compress(data, 6)
+
+
+def decompress(codec, data):
+    if codec == 'zstd':
+        return zstandard.ZstdDecompressor().decompress(data).decode('utf-8')
+    return zlib.decompress(data).decode('utf-8')
+
+
+def blob_insert(dialect_name):
+    '''INSERT into note_blob that skips hashes already stored, which is what deduplicates'''
+    return insert_ignore(NoteBlob, dialect_name, ['hash'])
+
+
+def save_blobs(blobs):
+    blobs = list({blob["hash"]: blob for blob in blobs if blob}.values())
+    if blobs:
+        db.session.execute(blob_insert(db.engine.dialect.name), blobs)
+
+
+def full_content(note):
+    '''The complete text of a note, reading its blob when the column only holds a preview'''
+    if note.blob_hash is None:
+        return note.content
+    blob = db.session.get(NoteBlob, note.blob_hash)
+    return decompress(blob.codec, blob.data)
+
+
+def full_contents(notes):
+    '''{note id: complete text} for many notes, reading their blobs in one query'''
+    hashes = {note.blob_hash for note in notes if note.blob_hash}
+    blobs = {blob.hash: blob for blob in NoteBlob.query.filter(NoteBlob.hash.in_(hashes))} if hashes else {}
+    return {note.id: decompress(blobs[note.blob_hash].codec, blobs[note.blob_hash].data) if note.blob_hash else note.content
+            for note in notes}
+
+
+def purge_orphan_blobs():
+    '''Delete blobs no note points to any more (after edits and deletes); returns how many'''
+    used = select(Note.blob_hash).where(Note.blob_hash.is_not(None))
+    result = db.session.execute(delete(NoteBlob).where(NoteBlob.hash.not_in(used)))
+    db.session.commit()
+    return result.rowcount
@@ -0,0 +1,114 @@
+from collections import Counter, defaultdict
+from sqlalchemy import select, insert, update, delete, func, literal, tuple_, bindparam
+from .models import Note, Tag, NoteTag, tag_names
+from .database import insert_ignore
+from . import db
+
+
+'''Tags on notes.
+
+Every tag change goes through set_note_tags() or untag_notes(), which keep Tag.note_count in step
+inside the same transaction, so per-tag counts are a read of the user's tag rows. Counts come from
+the rows each statement actually inserted or deleted (RETURNING), so concurrent writers cannot
+count a row twice. recount_tags() rebuilds them from note_tag should they ever drift.
+'''
+
+note_tag = NoteTag.__table__
+tag_table = Tag.__table__
+
+
+def tag_query(user_id, name):
+    '''SELECT of the id of a user's tag, shared with the async handlers'''
+    return select(Tag.id).where(Tag.user_id == user_id, Tag.name == name)
+
+
+def find_tag(user_id, name):
+    '''Id of the user's tag called `name`, None if they have none'''
+    names = tag_names([name])
+    return db.session.scalar(tag_query(user_id, names[0])) if names else None
+
+
+def user_tags(user_id):
+    '''The user's tags with the number of notes carrying them, most used first'''
+    rows = db.session.execute(
+        select(Tag.name, Tag.note_count).where(Tag.user_id == user_id, Tag.note_count > 0)
+        .order_by(Tag.note_count.desc(), Tag.name)
+    ).all()
+    return [{"name": row.name, "count": row.note_count} for row in rows]
+
+
+def ensure_tags(user_id, names, session=None):
+    '''{name: tag id} for `names`, creating the user's missing tags'''
+    session = session or db.session
+    if not names:
+        return {}
+    session.execute(insert_ignore(Tag, session.get_bind(Tag).dialect.name, ['user_id', 'name']),
+                    [{"user_id": user_id, "name": name, "note_count": 0} for name in names])
+    return dict(session.execute(select(Tag.name, Tag.id).where(Tag.user_id == user_id, Tag.name.in_(names))).all())
+
+
+def set_note_tags(user_id, tags_by_note, session=None):
+    '''Replace the tags of the user's notes, given as {note id: [names]}; call it inside the
+    transaction that writes the notes. Also takes a sync session from AsyncSession.run_sync.'''
+    session = session or db.session
+    if not tags_by_note:
+        return
+    tags_by_note = {note_id: tag_names(names) for note_id, names in tags_by_note.items()}
+    ids = ensure_tags(user_id, sorted({name for names in tags_by_note.values() for name in names}), session)
+    current = defaultdict(set)
+    # only the user's own tags can be removed, and added rows are limited to their notes below
+    for note_id, tag_id in session.execute(select(NoteTag.note_id, NoteTag.tag_id).join(Tag, Tag.id == NoteTag.tag_id)
+                                           .where(NoteTag.note_id.in_(tags_by_note), Tag.user_id == user_id)):
+        current[note_id].add(tag_id)
+    added, removed = defaultdict(list), []
+    for note_id, names in tags_by_note.items():
+        wanted = {ids[name] for name in names}
+        for tag_id in wanted - current[note_id]:
+            added[tag_id].append(note_id)
+        removed += [(note_id, tag_id) for tag_id in current[note_id] - wanted]
+    counts = Counter()
+    if removed:
+        counts.subtract(session.execute(
+            delete(note_tag).where(tuple_(note_tag.c.note_id, note_tag.c.tag_id).in_(removed)).returning(note_tag.c.tag_id)
+        ).scalars())
+    for tag_id, note_ids in added.items():
+        # INSERT ... SELECT copies each note's stored date as it is, so keyset cursors compare equal values
+        counts.update(session.execute(
+            insert(note_tag).from_select(['note_id', 'tag_id', 'date'], select(Note.id, literal(tag_id), Note.date)
+                                         .where(Note.id.in_(note_ids), Note.user_id == user_id))
+            .returning(note_tag.c.tag_id)
+        ).scalars())
+    _adjust_counts(session, counts)
+
+
+def untag_notes(note_ids, session=None):
+    '''Drop the tags of deleted notes and count them down; call it in the transaction deleting them'''
+    session = session or db.session
+    if note_ids:
+        counts = Counter()
+        counts.subtract(session.execute(
+            delete(note_tag).where(note_tag.c.note_id.in_(note_ids)).returning(note_tag.c.tag_id)).scalars())
+        _adjust_counts(session, counts)
+
+
+def _adjust_counts(session, counts):
+    rows = [{"tag": tag_id, "delta": delta} for tag_id, delta in counts.items() if delta]
+    if rows: # relative updates, so concurrent writers add up instead of overwriting each other
+        session.execute(update(tag_table).where(tag_table.c.id == bindparam('tag'))
+                        .values(note_count=tag_table.c.note_count + bindparam('delta')), rows)
+
+
+def recount_tags():
+    '''Rebuild every tag counter from note_tag; returns how many were wrong'''
+    actual = select(func.count()).where(note_tag.c.tag_id == tag_table.c.id).scalar_subquery()
+    result = db.session.execute(update(tag_table).where(tag_table.c.note_count != actual).values(note_count=actual))
+    db.session.commit()
+    return result.rowcount
+
+
+def purge_unused_tags():
+    '''Delete tags no note carries any more; returns how many'''
+    result = db.session.execute(delete(tag_table).where(tag_table.c.note_count <= 0,
+                                                        tag_table.c.id.not_in(select(note_tag.c.tag_id))))
+    db.session.commit()
+    return result.rowcount
@@ -0,0 +1,152 @@
+import csv
+import io
+import json
+from collections import defaultdict
+from datetime import datetime
+from sqlalchemy import insert, select
+from .models import Note, NoteBlob, NoteTag, Tag, content_error, tags_error
+from .changes import record_changes
+from .storage import prepare_rows, save_blobs, decompress
+from .tags import set_note_tags
+from . import db
+
+
+'''Streaming export and batched import of notes as NDJSON or CSV. Tags are a list in NDJSON and a
+JSON array in the "tags" column of CSV.'''
+
+FORMATS = ('ndjson', 'csv')
+CSV_FIELDS = ('id', 'date', 'content', 'tags')
+MAX_REPORTED_ERRORS = 100
+
+
+def export_notes(user_id, fmt, chunk_rows=1000):
+    '''Yield the user's notes as text chunks; rows come from a server-side cursor, so memory stays flat'''
+    rows = db.session.execute(
+        select(Note.id, Note.date, Note.content, NoteBlob.codec, NoteBlob.data)
+        .outerjoin(NoteBlob, NoteBlob.hash == Note.blob_hash) # long notes are exported in full
+        .where(Note.user_id == user_id).order_by(Note.id)
+        .execution_options(yield_per=chunk_rows) # fetch in chunks instead of buffering the whole result
+    )
+    buffer = io.StringIO()
+    writer = csv.writer(buffer) if fmt == 'csv' else None
+    if writer:
+        writer.writerow(CSV_FIELDS)
+    for chunk in rows.partitions():
+        tags = _note_tags([row.id for row in chunk]) # one query per chunk
+        for row in chunk:
+            date = row.date.isoformat() if row.date else None
+            content = decompress(row.codec, row.data) if row.data is not None else row.content
+            if writer:
+                writer.writerow((row.id, date or '', content, json.dumps(tags[row.id]) if tags[row.id] else ''))
+            else:
+                buffer.write(json.dumps({"id": row.id, "date": date, "content": content, "tags": tags[row.id]}) + '\n')
+        yield _drain(buffer)
+    yield _drain(buffer)
+
+
+def _note_tags(note_ids):
+    tags = defaultdict(list)
+    for note_id, name in db.session.execute(select(NoteTag.note_id, Tag.name).join(Tag, Tag.id == NoteTag.tag_id)
+                                            .where(NoteTag.note_id.in_(note_ids)).order_by(Tag.name)):
+        tags[note_id].append(name)
+    return tags
+
+
+def import_notes(user_id, stream, fmt, batch_size):
+    '''Insert notes read from a binary stream, committing every `batch_size` rows; returns a summary dict'''
+    summary = {"imported": 0, "skipped": 0, "errors": []}
+    batch = []
+    for line, item in _parse(stream, fmt):
+        error = item if isinstance(item, str) else content_error(item.get("content"))
+        tags = None if error else _tags(item.get("tags"), fmt)
+        if not error and tags is not None:
+            error = tags_error(tags)
+        if error:
+            summary["skipped"] += 1
+            if len(summary["errors"]) < MAX_REPORTED_ERRORS:
+                summary["errors"].append({"line": line, "error": error})
+            continue
+        row = {"user_id": user_id, "content": item["content"]}
+        date = _parse_date(item.get("date"))
+        if date:
+            row["date"] = date # keep original dates when migrating from another account
+        batch.append((row, tags))
+        if len(batch) >= batch_size:
+            summary["imported"] += _insert_batch(user_id, batch)
+            batch = []
+    if batch:
+        summary["imported"] += _insert_batch(user_id, batch)
+    return summary
+
+
+def _insert_batch(user_id, batch):
+    # bulk INSERT ... RETURNING per batch, one commit each, so a failure only loses the current batch
+    rows, blobs = prepare_rows([row for row, _ in batch])
+    save_blobs(blobs)
+    ids = list(db.session.execute(insert(Note).returning(Note.id, sort_by_parameter_order=True), rows).scalars())
+    set_note_tags(user_id, {note_id: tags for note_id, (_, tags) in zip(ids, batch) if tags})
+    record_changes(user_id, ids, "upsert")
+    db.session.commit()
+    return len(ids)
+
+
+def _parse(stream, fmt):
+    '''Yield (line number, row dict) pairs, or (line number, error message) for unreadable rows'''
+    undecodable = set()
+    text = _decode_lines(stream, undecodable)
+    if fmt == 'csv':
+        reader = csv.DictReader(text)
+        first = 2 # the row after the header
+        for row in reader:
+            # a quoted field can span lines, the row is refused if any of them was not UTF-8
+            bad = any(line in undecodable for line in range(first, reader.line_num + 1))
+            yield reader.line_num, "Invalid UTF-8." if bad else row
+            first = reader.line_num + 1
+        return
+    for line, raw in enumerate(text, 1):
+        if line in undecodable:
+            yield line, "Invalid UTF-8."
+            continue
+        if not raw.strip():
+            continue
+        try:
+            item = json.loads(raw)
+        except ValueError:
+            yield line, "Invalid JSON."
+            continue
+        yield line, item if isinstance(item, dict) else "Expected a JSON object."
+
+
+def _decode_lines(stream, undecodable):
+    '''Lines of a binary stream as text; those that are not UTF-8 are decoded with replacement
+    characters and their numbers added to `undecodable`'''
+    for line, raw in enumerate(stream, 1):
+        try:
+            yield raw.decode('utf-8')
+        except UnicodeDecodeError:
+            undecodable.add(line)
+            yield raw.decode('utf-8', errors='replace')
+
+
+def _tags(value, fmt):
+    '''The tags of an imported row, None when it has none; CSV holds them as a JSON array'''
+    if fmt == 'csv' and isinstance(value, str):
+        try:
+            return json.loads(value) if value.strip() else None
+        except ValueError:
+            return value # refused by tags_error
+    return value
+
+
+def _parse_date(value):
+    try:
+        return datetime.fromisoformat(value) if value else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _drain(buffer):
+    chunk = buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+    return chunk
@@ -1,6 +1,15 @@
-from flask import Blueprint, render_template, flash, request, jsonify
+from flask import Blueprint, render_template, flash, request, jsonify, current_app, make_response
 from flask_login import login_required, current_user
-from .models import Note
+from .models import Note, content_error, tags_error, tag_names
+from .pagination import notes_page, decode_cursor, DEFAULT_PAGE_SIZE
+from .changes import record_changes, notes_version_info
+from .cache import cached_fragment
+from .ingest import enqueue_note
+from .storage import split_content, save_blobs
+from .revisions import drop_revisions
+from .http_cache import notes_etag, cacheable, not_modified, set_validators
+from .ratelimit import rate_limit, by_user
+from .tags import find_tag, set_note_tags, untag_notes
 from . import db
 import json
 
@@ -12,29 +21,72 @@ views = Blueprint('views', __name__)
 
 @views.route('/', methods=["GET", "POST"]) #endpoint for home page
 @login_required
+@rate_limit(('RATELIMIT_WRITE_USER', by_user))
 def home():
     '''Function to be called when home page is hit'''
+    conditional = cacheable()
     if request.method == 'POST':
         note = request.form.get('note')
-        if len(note) < 1:
-            flash("Note is empty.", category="error")
+        tags = tag_names(request.form.get('tags', '').split(',')) # comma separated
+        if content_error(note): # the same limits as the API and imports
+            flash(content_error(note), category="error")
+        elif tags_error(tags):
+            flash(tags_error(tags), category="error")
+        elif enqueue_note(current_app, current_user.id, note, tags):
+            flash("Noted! It will show up in a moment.", category="success")
         else:
-            new_note = Note(content=note, user_id=current_user.id)
+            values, blob = split_content(note)
+            save_blobs([blob])
+            new_note = Note(user_id=current_user.id, **values)
             db.session.add(new_note)
+            db.session.flush()
+            set_note_tags(current_user.id, {new_note.id: tags})
+            record_changes(current_user.id, [new_note.id], "upsert")
             db.session.commit()
             flash("Noted!", category="success")
-    return render_template("home.html", user=current_user) #reference current user and check if it is authenticated to get their notes
+    after = request.args.get('after', type=decode_cursor) # a malformed cursor shows the first page
+    tag = next(iter(tag_names([request.args.get('tag', '')])), None) # show only the notes carrying this tag
+    version, changed_at = notes_version_info(current_user.id) # read first, so a concurrent write is fetched again rather than missed
+    build = current_app.extensions['asset_build']
+    etag = notes_etag(current_user.id, version, build)
+    if conditional:
+        response = not_modified(etag, changed_at)
+        if response:
+            return response # the browser already has this version of the page
+
+    limit = current_app.config.get('NOTES_PAGE_SIZE', DEFAULT_PAGE_SIZE)
+    notes_html = cached_fragment('notes:{}:{}:{}:{}:{}:{}'.format(current_user.id, version, after, limit, tag or '', build),
+                                 lambda: render_notes(current_user.id, version, after, limit, tag))
+    response = make_response(render_template("home.html", user=current_user, notes_html=notes_html, tag=tag)) #only one page of notes is loaded and rendered
+    if conditional:
+        set_validators(response, etag, changed_at)
+    return response
+
+
+def render_notes(user_id, version, after, limit, tag=None):
+    tag_id = find_tag(user_id, tag) if tag else None
+    if tag and tag_id is None:
+        notes, next_cursor = [], None
+    else:
+        notes, next_cursor = notes_page(user_id, after=after, limit=limit, tag_id=tag_id)
+    return render_template("notes_list.html", notes=notes, after=after, next_cursor=next_cursor, version=version, tag=tag)
 
 
 @views.route('/delete-note', methods=['POST'])
+@rate_limit(('RATELIMIT_WRITE_USER', by_user))
 def delete_note():
     data = json.loads(request.data)
     note_id = data['noteId']
-    print("deleting note", note_id)
-    note = Note.query.get(note_id)
+    current_app.logger.debug("deleting note %s", note_id)
+    if not current_user.is_authenticated:
+        return jsonify({})
+    note = Note.query.get(note_id) # after loading the user, which picks the shard to look on
     if note:
         if note.user_id == current_user.id:
+            untag_notes([note.id])
+            drop_revisions([note.id])
             db.session.delete(note)
+            record_changes(current_user.id, [note.id], "delete")
             db.session.commit()
 
     return jsonify({})